@@ -0,0 +1,187 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Salt engine that keeps the NGINX upstream definitions of all HTTP services in
+the `microservices` pillar in sync with the Consul health state.
+
+For each service, the engine watches the service's healthy instances using a
+Consul blocking query. When the set of healthy instances changes, the
+service's upstream file (`/etc/nginx/upstreams/service_<service>.conf`) is
+re-rendered; upstream files of other services are not touched. NGINX is
+reloaded once the changes have settled for `debounce` seconds. When none of a
+service's instances is healthy, the upstream contains all instances at the
+ports recorded in the placement file (see `microservice.instance_ports`).
+
+The pillar is re-read every `refresh` seconds; watchers of services that were
+removed from the pillar stop, and changed service definitions are applied when
+the current blocking query of the service returns.
+
+Enable this engine in the minion configuration and set the
+`nginx:consul_upstreams` pillar to `True`, so that highstates do not overwrite
+the upstream files:
+
+.. code-block:: yaml
+
+    engines:
+      - consul_upstreams:
+          debounce: 2
+"""
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import jinja2
+    import requests
+except ImportError:
+    def __virtual__():
+        return False, ["The jinja2 and requests packages are required"]
+
+
+log = logging.getLogger(__name__)
+
+
+def start(consul_url='http://localhost:8500', wait='5m', debounce=2, refresh=60,
+          template='salt://mwms/nginx/files/upstream.j2', upstream_dir='/etc/nginx/upstreams'):
+    """
+    Starts the engine.
+
+    :param consul_url: The URL of the Consul HTTP API
+    :param wait: The maximum duration of a blocking query
+    :param debounce: How long (in seconds) to wait for further changes before
+        reloading NGINX
+    :param refresh: How often (in seconds) to re-read the pillar
+    :param template: The template from which to render the upstream files
+    :param upstream_dir: The directory containing the upstream files
+    """
+    upstream_template = jinja2.Template(__salt__['cp.get_file_str'](template))
+    session = requests.Session()
+    # Consul adds a random jitter of up to 1/16 of the wait time to blocking
+    # queries.
+    timeout = (5, _duration(wait) * 17 / 16.0 + 5)
+    service_definitions = {}
+    watchers = {}
+    changed = {'at': None}
+    changed_lock = threading.Lock()
+
+    def notify():
+        with changed_lock:
+            changed['at'] = time.time()
+
+    def watch(service_name):
+        path = "%s/service_%s.conf" % (upstream_dir, service_name)
+        index = 0
+        rendered_config = None
+        while True:
+            service_config = service_definitions.get(service_name)
+            if service_config is None:
+                log.info("Service %s was removed from the pillar; no longer watching it" % service_name)
+                watchers.pop(service_name, None)
+                return
+
+            try:
+                r = session.get('%s/v1/health/service/%s' % (consul_url, service_name),
+                                params={'passing': 1, 'index': index, 'wait': wait}, timeout=timeout)
+                r.raise_for_status()
+            except requests.RequestException as e:
+                log.warning("Could not query health of service %s: %s" % (service_name, e))
+                time.sleep(5)
+                continue
+
+            service_config = service_definitions.get(service_name, service_config)
+            new_index = int(r.headers.get('X-Consul-Index', 0))
+            if new_index == index and service_config == rendered_config:
+                continue
+            # The index may go backwards (for example, after a Consul restart)
+            index = new_index if new_index >= index else 0
+            rendered_config = service_config
+
+            servers = sorted(set(
+                "%s:%d" % (entry['Service'].get('Address') or 'localhost', entry['Service']['Port'])
+                for entry in r.json()
+            ))
+            if len(servers) == 0:
+                log.warning("No healthy instances of service %s; using all configured instances" % service_name)
+                servers = ["localhost:%d" % port
+                           for port in __salt__['microservice.instance_ports'](service_name, service_config)]
+
+            content = upstream_template.render(service_name=service_name, service_config=service_config,
+                                               upstream=service_config.get('upstream', {}), servers=servers)
+            if _write_if_changed(path, content):
+                log.info("Updated upstreams of service %s: %s" % (service_name, ', '.join(servers)))
+                notify()
+
+    def refresh_watchers():
+        try:
+            pillar = __salt__['pillar.items']()
+        except Exception as e:
+            log.warning("Could not read the pillar: %s" % e)
+            return
+
+        http_services = dict(
+            (service_name, service_config)
+            for service_name, service_config in pillar.get('microservices', {}).items()
+            if any(c.get('http') for c in service_config['containers'].values())
+        )
+        for service_name in list(service_definitions):
+            if service_name not in http_services:
+                del service_definitions[service_name]
+        service_definitions.update(http_services)
+
+        for service_name in http_services:
+            if service_name not in watchers:
+                watcher = threading.Thread(target=watch, args=(service_name,),
+                                           name='consul-upstreams-%s' % service_name)
+                watcher.daemon = True
+                watcher.start()
+                watchers[service_name] = watcher
+
+    last_refresh = 0
+    while True:
+        if time.time() - last_refresh > refresh:
+            refresh_watchers()
+            last_refresh = time.time()
+
+        with changed_lock:
+            due = changed['at'] is not None and time.time() - changed['at'] >= debounce
+            if due:
+                changed['at'] = None
+
+        if due:
+            log.info("Reloading NGINX")
+            __salt__['service.reload']('nginx')
+
+        time.sleep(0.5)
+
+
+def _duration(value):
+    """
+    Converts a duration in Consul's format (like "30s" or "5m") into seconds.
+    """
+    value = str(value)
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    for unit in ('ms', 's', 'm', 'h'):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+def _write_if_changed(path, content):
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+
+    partial = path + '.tmp'
+    with open(partial, 'w') as f:
+        f.write(content)
+    os.rename(partial, path)
+    return True
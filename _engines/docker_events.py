@@ -0,0 +1,141 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Salt engine that watches the Docker event stream for changes of service
+containers and fires an event for each affected service, so that a reactor
+can re-apply the states of only that service.
+
+Only events of containers that carry the `service` label (which is attached by
+the `mwms.services` SLS) are considered, and only for services that are
+defined in the `microservices` pillar (other containers, like the registry
+mirror or the Prometheus containers, use the label as well); the pillar is
+re-read every `refresh` seconds. Events are coalesced per service:
+an event is fired `window` seconds after the first container event of a
+service, and at most once every `cooldown` seconds per service, so that a
+crash-looping container does not flood the master.
+
+The fired event's tag is `mwms/docker/service/<service>`; its data contains
+the service name, the affected containers and the observed actions.
+
+.. code-block:: yaml
+
+    engines:
+      - docker_events:
+          window: 10
+          cooldown: 60
+          refresh: 60
+"""
+
+import logging
+import threading
+import time
+
+try:
+    import docker
+except ImportError:
+    def __virtual__():
+        return False, ["The docker package is required"]
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ACTIONS = ('die', 'oom', 'kill', 'stop', 'destroy', 'health_status')
+
+
+def start(window=10, cooldown=60, actions=DEFAULT_ACTIONS, tag_prefix='mwms/docker/service', refresh=60):
+    """
+    Starts the engine.
+
+    :param window: How long (in seconds) to collect further events of a
+        service before firing an event
+    :param cooldown: The minimum time (in seconds) between two events fired
+        for the same service
+    :param actions: The container actions that should trigger an event
+    :param tag_prefix: The tag prefix of the fired events
+    :param refresh: How often (in seconds) to re-read the services defined in
+        the pillar
+    """
+    base_url = __salt__['config.get']('mwdocker.base_url', 'unix://var/run/docker.sock')
+    pending = {}
+    last_fired = {}
+    pending_lock = threading.Lock()
+    pillar_services = {'names': None, 'at': 0}
+
+    def known_services():
+        if pillar_services['names'] is None or time.time() - pillar_services['at'] >= refresh:
+            try:
+                pillar_services['names'] = set(__salt__['pillar.items']().get('microservices', {}))
+                pillar_services['at'] = time.time()
+            except Exception as e:
+                # Without a pillar, events are fired for all services
+                log.warning("Could not read the pillar: %s" % e)
+        return pillar_services['names']
+
+    def collect(event):
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        service_name = attributes.get('service')
+        action = event.get('Action', event.get('status', '')).split(':')[0]
+        if not service_name or action not in actions:
+            return
+
+        with pending_lock:
+            if service_name not in pending:
+                pending[service_name] = {'since': time.time(), 'containers': set(), 'actions': set()}
+            pending[service_name]['containers'].add(attributes.get('name', event.get('id', '')))
+            pending[service_name]['actions'].add(action)
+
+    def flush():
+        now = time.time()
+        due = []
+        with pending_lock:
+            for service_name, changes in list(pending.items()):
+                if now - changes['since'] < window:
+                    continue
+                if now - last_fired.get(service_name, 0) < cooldown:
+                    continue
+                del pending[service_name]
+                last_fired[service_name] = now
+                due.append((service_name, changes))
+
+        services = known_services() if len(due) > 0 else None
+        for service_name, changes in due:
+            if services is not None and service_name not in services:
+                log.debug("Ignoring changed containers of service %s, which is not in the pillar" % service_name)
+                continue
+            log.info("Containers of service %s changed (%s); requesting reconciliation" %
+                     (service_name, ', '.join(sorted(changes['actions']))))
+            __salt__['event.send']('%s/%s' % (tag_prefix, service_name), {
+                'service': service_name,
+                'containers': sorted(changes['containers']),
+                'actions': sorted(changes['actions'])
+            })
+
+    def flusher():
+        while True:
+            try:
+                flush()
+            except Exception as e:
+                log.exception("Could not fire service event: %s" % e)
+            time.sleep(1)
+
+    flush_thread = threading.Thread(target=flusher, name='docker-events-flush')
+    flush_thread.daemon = True
+    flush_thread.start()
+
+    client = docker.Client(base_url=base_url, timeout=None)
+    since = int(time.time())
+    while True:
+        try:
+            # Resume at the last seen event after the stream was interrupted,
+            # so that no events are lost.
+            for event in client.events(since=since, filters={'type': 'container', 'label': 'service'},
+                                       decode=True):
+                since = event.get('time', since)
+                collect(event)
+        except Exception as e:
+            log.warning("Docker event stream interrupted: %s" % e)
+            time.sleep(5)
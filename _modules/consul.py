@@ -4,9 +4,255 @@
 # Docker-based microservice deployment with service discovery
 # This code is MIT-licensed. See the LICENSE.txt for more information
 
+import hashlib
+import json
+import logging
+import threading
+
+try:
+	import requests
+	import requests.adapters
+except ImportError:
+	requests = None
+
+
+log = logging.getLogger(__name__)
+
+__session = None
+__session_lock = threading.Lock()
+__agent_services_lock = threading.Lock()
+
+# Consul limits the number of operations in a single transaction
+TXN_MAX_OPS = 64
+
+# Service metadata key under which a hash of the registered definition is stored
+DEFINITION_HASH_META = 'mwms-hash'
+
+# Keys of the configuration file format that are not simply capitalized in the
+# HTTP API
+__api_keys = {'id': 'ID', 'http': 'HTTP', 'tcp': 'TCP', 'ttl': 'TTL', 'tlsskipverify': 'TLSSkipVerify'}
+
+
 def reload():
 	"""
 	Reloads the consul configuration. This command requires the Consul
 	executable to be installed on the node.
 	"""
 	__salt__['cmd.run']('consul reload')
+
+
+def catalog_nodes(datacenter=None):
+	"""
+	Lists all nodes in the Consul catalog.
+
+	:param datacenter: The datacenter whose catalog to read (defaults to the
+	    agent's datacenter)
+	:return: A dictionary of node definitions (with the keys "Node", "Address"
+	    and, depending on the Consul version, "Datacenter"), indexed by node name
+	"""
+	r = _session().get(_url('/v1/catalog/nodes'), params=_datacenter_params(datacenter))
+	_check_status(r)
+	return dict((n['Node'], n) for n in r.json() or [])
+
+
+def catalog_service(name, datacenter=None):
+	"""
+	Lists all instances of a service in the Consul catalog.
+
+	:param name: The service name
+	:param datacenter: The datacenter whose catalog to read (defaults to the
+	    agent's datacenter)
+	:return: A list of service instances, as returned by Consul's
+	    `/v1/catalog/service/<name>` endpoint
+	"""
+	r = _session().get(_url('/v1/catalog/service/%s' % name), params=_datacenter_params(datacenter))
+	_check_status(r)
+	return r.json() or []
+
+
+def catalog_register(registrations):
+	"""
+	Registers a number of nodes (and optionally, one service per node) in the
+	Consul catalog. When the Consul agent supports transactions on catalog
+	entries, the registrations of each datacenter are written in as few
+	transactions as possible; otherwise, each registration is written using an
+	individual `/v1/catalog/register` call.
+
+	:param registrations: A list of registrations in the format expected by
+	    Consul's `/v1/catalog/register` endpoint
+	"""
+	by_datacenter = {}
+	for registration in registrations:
+		by_datacenter.setdefault(registration.get('Datacenter'), []).append(registration)
+
+	session = _session()
+	for datacenter, datacenter_registrations in sorted(by_datacenter.items(), key=lambda r: r[0] or ''):
+		ops = []
+		for registration in datacenter_registrations:
+			node = dict((k, registration[k]) for k in ('Node', 'Address', 'Datacenter') if k in registration)
+			ops.append({"Node": {"Verb": "set", "Node": node}})
+
+			if registration.get('Service') is not None:
+				service = dict(registration['Service'])
+				service.setdefault('Service', service['ID'])
+				ops.append({"Service": {"Verb": "set", "Node": registration['Node'], "Service": service}})
+
+		# Transactions are applied in the datacenter they are sent to,
+		# regardless of the nodes' "Datacenter" fields.
+		for i in range(0, len(ops), TXN_MAX_OPS):
+			r = session.put(_url('/v1/txn'), params=_datacenter_params(datacenter),
+							data=json.dumps(ops[i:i + TXN_MAX_OPS]))
+			if r.status_code in (400, 404, 405) and i == 0:
+				# Older Consul versions do not support transactions (at all, or for
+				# catalog entries).
+				log.info("Consul does not support catalog transactions (status %d), registering nodes individually" % r.status_code)
+				for registration in datacenter_registrations:
+					r = session.put(_url('/v1/catalog/register'), data=json.dumps(registration))
+					_check_status(r)
+				break
+			_check_status(r)
+
+
+def agent_services(refresh=False):
+	"""
+	Lists the services registered with the local Consul agent. The list is
+	read once per run (it is kept in the run's context, as the agent may
+	deregister services between runs) and kept up to date by
+	`service_register` and `service_deregister`.
+
+	:param refresh: Set to `True` to re-read the list from the agent
+	:return: A dictionary of service definitions indexed by service ID
+	"""
+	with __agent_services_lock:
+		if 'consul.agent_services' not in __context__ or refresh:
+			r = _session().get(_url('/v1/agent/services'))
+			_check_status(r)
+			__context__['consul.agent_services'] = r.json() or {}
+		return __context__['consul.agent_services']
+
+
+def service_registered(definition):
+	"""
+	Checks if a service is registered with the local Consul agent exactly as
+	described by a service definition.
+
+	:param definition: A service definition (see `service_register`)
+	:return: `True` when the service is registered and up to date
+	"""
+	definition = _normalize_service_definition(definition)
+	existing = agent_services().get(definition['ID'])
+	if existing is None:
+		return False
+
+	meta = existing.get('Meta')
+	if meta is not None:
+		return meta.get(DEFINITION_HASH_META) == definition['Meta'][DEFINITION_HASH_META]
+
+	# Consul versions without service metadata support; checks cannot be
+	# compared here.
+	return existing.get('Service') == definition['Name'] and \
+		existing.get('Port') == definition.get('Port') and \
+		(existing.get('Tags') or []) == (definition.get('Tags') or [])
+
+
+def service_register(definition):
+	"""
+	Registers a service (and its health checks) with the local Consul agent,
+	without reloading the agent's configuration.
+
+	:param definition: A service definition in the format of Consul's service
+	    definition files (with the keys `name`, `id`, `port`, `tags` and
+	    `checks`; capitalized keys are accepted, as well)
+	:return: The service ID
+	"""
+	definition = _normalize_service_definition(definition)
+	r = _session().put(_url('/v1/agent/service/register'), data=json.dumps(definition))
+	_check_status(r)
+
+	with __agent_services_lock:
+		if 'consul.agent_services' in __context__:
+			__context__['consul.agent_services'][definition['ID']] = {
+				'ID': definition['ID'],
+				'Service': definition['Name'],
+				'Port': definition.get('Port'),
+				'Tags': definition.get('Tags'),
+				'Meta': definition['Meta']
+			}
+
+	return definition['ID']
+
+
+def service_deregister(service_id):
+	"""
+	Deregisters a service (and its health checks) from the local Consul agent.
+
+	:param service_id: The service ID
+	"""
+	r = _session().put(_url('/v1/agent/service/deregister/%s' % service_id))
+	_check_status(r)
+
+	with __agent_services_lock:
+		if 'consul.agent_services' in __context__:
+			__context__['consul.agent_services'].pop(service_id, None)
+
+
+def _normalize_service_definition(definition):
+	normalized = _normalize_keys(definition)
+	normalized.setdefault('ID', normalized['Name'])
+	if 'Checks' in normalized:
+		normalized['Checks'] = [_normalize_keys(c) for c in normalized['Checks']]
+
+	meta = dict(normalized.get('Meta') or {})
+	meta.pop(DEFINITION_HASH_META, None)
+	normalized['Meta'] = meta
+	meta[DEFINITION_HASH_META] = hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+	return normalized
+
+
+def _normalize_keys(definition):
+	"""
+	Converts the keys of a definition in Consul's configuration file format
+	(like "name", "http" or "deregister_critical_service_after") into the
+	format used by the HTTP API (like "Name", "HTTP" or
+	"DeregisterCriticalServiceAfter").
+	"""
+	normalized = {}
+	for key, value in definition.items():
+		camel_case = ''.join(part[:1].upper() + part[1:] for part in key.split('_'))
+		normalized[__api_keys.get(key.lower().replace('_', ''), camel_case)] = value
+	return normalized
+
+
+def _session():
+	"""
+	Returns a HTTP session (with a keep-alive connection pool) that is shared
+	by all functions of this module.
+	"""
+	global __session
+
+	if requests is None:
+		raise Exception('The requests package is not installed')
+
+	with __session_lock:
+		if __session is None:
+			pool_size = int(__salt__['config.get']('consul.pool_size', 10))
+			session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+			session.mount('http://', adapter)
+			session.mount('https://', adapter)
+			__session = session
+	return __session
+
+
+def _datacenter_params(datacenter):
+	return {'dc': datacenter} if datacenter else None
+
+
+def _url(path):
+	return __salt__['config.get']('consul.url', 'http://localhost:8500').rstrip('/') + path
+
+
+def _check_status(r):
+	if r.status_code != 200:
+		raise Exception('Unexpected status from Consul: %d (%s)' % (r.status_code, r.text))
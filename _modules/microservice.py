@@ -4,23 +4,48 @@
 # Docker-based microservice deployment with service discovery
 # This code is MIT-licensed. See the LICENSE.txt for more information
 
+import fcntl
+import glob
+import json
 import logging
-import docker
-import docker.errors
+import multiprocessing
+import os
+import time
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
+CPUSET_LIMITS = ('cpuset_cpus', 'cpuset_mems')
 
-def redeploy(service_name, tag_override='latest'):
+
+def redeploy(service_name, tag_override='latest', max_unavailable=1):
     """
     Re-deploys a service. This module tries to pull the Docker image from which
     an application container is created. If a newer version of the image could
-    be pulled, this module will sequentially delete the containers and re-create
-    them.
+    be pulled, this module will delete the containers and re-create them in a
+    rolling fashion, updating at most `max_unavailable` instances of a
+    container at the same time.
+
+    Containers are updated in dependency order: a container that links to
+    another container (or uses its volumes) is updated after that container.
+
+    Before pulling, the digest of each image in its registry is compared to the
+    local image. When no image has changed and all containers are running the
+    current images, this module returns early with `unchanged` set to `True`.
+
+    HTTP containers with the `blue_green` option are not re-created in place.
+    Instead, a new generation of containers is started on an alternate port
+    range. When all of them are ready, the NGINX upstream and the Consul
+    registrations are switched to the new generation, and the old generation
+    is removed after `drain_wait` seconds. Containers that link to a container
+    whose generation was switched are re-created afterwards, even when their
+    image did not change.
 
     :param service_name: The name of the service to re-deploy
     :param tag_override: The default tag to use (if no image tag was specified)
         in the service definition pillar.
+    :param max_unavailable: How many instances of a container may be re-created
+        concurrently.
     """
 
     try:
@@ -32,103 +57,873 @@ def redeploy(service_name, tag_override='latest'):
             "comment": "service is not registered on this host"
         }
 
-    client = docker.Client(base_url='unix://var/run/docker.sock')
+    max_unavailable = max(1, int(max_unavailable))
+    redeploy_started = time.time()
     result = {
         "container_images": {},
-        "container_ids": {}
+        "container_ids": {},
+        "timings": {},
+        "unchanged": False
     }
 
-    for key, container_config in service_definition['containers'].items():
-        image_name = container_config['docker_image']
+    deploy_order = _deploy_order(service_definition['containers'])
+    placement = _read_placements().get(service_name, {})
+    image_names = {}
+    image_ids = {}
+    images_unchanged = True
+
+    for key in deploy_order:
+        image_name = service_definition['containers'][key]['docker_image']
 
-        if ':' not in image_name:
+        if ':' not in image_name.rsplit('/', 1)[-1]:
             image_name += ":%s" % tag_override
 
-        __salt__['mwdocker.pull_image'](image_name, force=True)
-        current_image_id = __salt__['mwdocker.image_id'](image_name)
+        # Comparing the registry's manifest digest with the local image is a
+        # lot cheaper than a forced pull, which most of the time would not
+        # yield a new image anyway.
+        if __salt__['mwdocker.image_up_to_date'](image_name):
+            logger.info("Image %s is up to date, not pulling" % image_name)
+        else:
+            __salt__['mwdocker.pull_image'](image_name, force=True, service=service_name)
+            images_unchanged = False
+
+        image_names[key] = image_name
+        image_ids[key] = __salt__['mwdocker.image_id'](image_name)
+
+    if images_unchanged and _containers_use_images(service_name, service_definition, image_ids, placement):
+        result["unchanged"] = True
+        result["comment"] = "all containers are running the current images"
+        return result
+
+    switched = set()
+    for key in deploy_order:
+        container_config = service_definition['containers'][key]
+        image_name = image_names[key]
+        current_image_id = image_ids[key]
+
+        # Docker links point at a container, not at its name, so containers
+        # that link to a switched container would keep using the old
+        # generation (and lose it when it is removed).
+        relink = any(linked in switched for linked in container_config.get('links', {}))
+
+        if _uses_blue_green(container_config):
+            if _blue_green_deploy(service_name, service_definition, key, image_name, current_image_id,
+                                  max_unavailable, result, force=relink):
+                switched.add(key)
+            placement = _read_placements().get(service_name, {})
+        else:
+            def redeploy_instance(container_number):
+                instance = _instance_placement(placement, service_name, key, container_config, container_number)
+                start = time.time()
+                _redeploy_instance(service_name, service_definition, key, container_config, image_name,
+                                   current_image_id, instance, container_number, placement, result, force=relink)
+                result["timings"][instance["container"]] = round(time.time() - start, 3)
+
+            instances = list(range(container_config['instances']))
+            _in_batches(redeploy_instance, instances, max_unavailable)
+
+        _redeploy_standbys(service_name, service_definition, key, image_name, current_image_id, placement, result,
+                           force=relink)
+
+    __salt__['mwdocker.observe_metric']('redeploy_duration_seconds', time.time() - redeploy_started, service_name)
+
+    logger.debug("Docker API calls during redeploy of %s: %s" % (service_name, __salt__['mwdocker.api_calls']()))
+    return result
+
+
+def record_promotion(service_name, key, instance, container, port, test=None):
+    """
+    Promotes a warm standby container (see the `standby` option of container
+    definitions) to an instance that does not have a container yet, by
+    recording the standby's container and port as the instance's placement.
+    This is done by the `microservice.standby_promoted` state, which the
+    `mwms.services` state generates for each instance that a running standby
+    takes over.
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :param instance: The instance number
+    :param container: The standby container's name
+    :param port: The standby container's host port
+    :param test: Set to `True` to only report the change (defaults to the
+        `test` option of the current run)
+    :return: A dictionary with the old and new container of the instance, or
+        an empty dictionary if the standby is already the instance's container
+    """
+    if test is None:
+        test = __opts__.get('test', False)
+
+    placed = _read_placements().get(service_name, {}).get(key, {}).get(str(instance), {})
+    if placed.get("container") == container:
+        return {}
+    if "container" in placed:
+        raise Exception("Instance %s-%s-%s already runs in container %s" %
+                        (service_name, key, instance, placed["container"]))
+
+    info = __salt__['mwdocker.inspect_container'](container)
+    if info is None or not info['State']['Running']:
+        raise Exception("Standby container %s is not running" % container)
+
+    if not test:
+        def promote(placements):
+            placed = placements.setdefault(service_name, {}).setdefault(key, {}).setdefault(str(instance), {})
+            placed.update({"container": container, "port": port})
+        _update_placements(promote)
+        logger.info("Promoted standby %s to %s-%s-%s" % (container, service_name, key, instance))
+
+    return {"old": None, "new": container}
 
-        for container_number in range(container_config['instances']):
-            container_name = "%s-%s-%d" % (service_name, key, container_number)
-
-            try:
-                existing_container_info = client.inspect_container(container_name)
-                used_image_id = existing_container_info['Image']
-                result["container_ids"][container_name] = {"old": existing_container_info["Id"]}
-            except docker.errors.NotFound:
-                existing_container_info = None
-                used_image_id = None
-                result["container_ids"][container_name] = {"old": None}
-
-            result["container_images"][container_name] = {
-                "old": used_image_id,
-                "new": current_image_id
-            }
 
-            if used_image_id == current_image_id:
-                result["container_ids"][container_name]["new"] = result["container_ids"][container_name]["old"]
-                if 'volumes_from' not in container_config:
+def instances(services=None):
+    """
+    Determines the containers that run the instances and warm standbys of all
+    (or some) services, as used by the `mwcompiler` module.
+
+    :param services: An optional list of service names to limit the result to
+    :return: A dictionary mapping each service name to a list with one
+        dictionary per container (in deployment order) with the keys `key`,
+        `instances` and `standbys`. Each instance and standby is a dictionary
+        with the keys `container`, `port`, `pinning` (the CPUs assigned to the
+        instance, see `record_cpu_allocation`) and `resources`. Instances also
+        have the key `promoted`, which is `True` when a running standby will
+        take over the instance (see `record_promotion`); standbys have the key
+        `missing`, which is `True` when the standby's container does not
+        exist.
+
+    Instances without a container are taken over by running standbys, so
+    that raising `instances` does not need to wait for new containers.
+    """
+    service_definitions = __salt__['pillar.get']('microservices', {})
+    placements = _read_placements()
+
+    result = {}
+    for service_name, service_config in service_definitions.items():
+        if services is not None and service_name not in services:
+            continue
+        result[service_name] = _service_instances(service_name, service_config, placements.get(service_name, {}),
+                                                  promote=True)
+    return result
+
+
+def record_cpu_allocation(service_name, allocation, test=None):
+    """
+    Records the CPUs assigned to the instances of a service (see the
+    `mwms:cpu_pinning` pillar) in the placement file, so that they are kept
+    when other instances are added or removed. CPUs recorded for instances
+    that are not part of `allocation` (any more) are released.
+
+    :param service_name: The service name
+    :param allocation: A dictionary mapping container key and (as string)
+        instance number to the instance's `cpuset_cpus` and `cpuset_mems`
+    :param test: Set to `True` to only report the changes (defaults to the
+        `test` option of the current run)
+    :return: A dictionary mapping the changed instances (as
+        `<service>-<key>-<instance>`) to their old and new CPUs
+    """
+    if test is None:
+        test = __opts__.get('test', False)
+
+    changes = {}
+
+    def record(placements):
+        placement = placements.get(service_name, {})
+        for key in sorted(set(placement) | set(allocation)):
+            for container_number in sorted(set(placement.get(key, {})) | set(allocation.get(key, {}))):
+                instance = placement.get(key, {}).get(container_number, {})
+                old = dict((limit, instance[limit]) for limit in CPUSET_LIMITS if limit in instance) or None
+                new = allocation.get(key, {}).get(container_number)
+                if old == new:
                     continue
 
-            if existing_container_info is not None:
-                if 'stateful' in container_config and container_config['stateful']:
-                    logger.warn("Container %s needs to be updates (current image version is %s), but is stateful. Please upgrade yourself." % (container_name, current_image_id))
-                    result["container_ids"][container_name]["new"] = None
+                changes["%s-%s-%s" % (service_name, key, container_number)] = {"old": old, "new": new}
+                if test:
                     continue
-                logger.info("Deleting container %s" % container_name)
-                __salt__['mwdocker.delete_container'](container_name)
-
-            links = {}
-            if 'links' in container_config:
-                for linked_container, alias in sorted(container_config['links'].items()):
-                    linked_container_name = "%s-%s-0" % (service_name, linked_container)
-                    links[linked_container_name] = alias
-
-            volumes_from = None
-            if 'volumes_from' in container_config:
-                volumes_from = []
-                for volume_container in container_config['volumes_from']:
-                    volume_container_name = "%s-%s-0" % (service_name, volume_container)
-                    volumes_from.append(volume_container_name)
-
-            volumes = []
-            if "volumes" in container_config:
-                volumes = []
-                for dir, mount, mode in container_config["volumes"]:
-                    source_dir = "/var/lib/services/%s/%s" % (service_name, dir)
-                    volumes.append("%s:%s:%s" % (source_dir, mount, mode))
-
-            ports = []
-            if 'http' in container_config and container_config['http']:
-                base_port = container_config['base_port']
-                host_port = base_port + container_number
-
-                container_http_port = 80
-                if 'http_internal_port' in container_config:
-                    container_http_port = container_config['http_internal_port']
-
-                ports.append({"address": "0.0.0.0", "port": container_http_port, "host_port": host_port})
-            elif 'ports' in container_config:
-                ports += container_config['ports']
-
-            container_id = __salt__['mwdocker.create_container'](
-                name=container_name,
-                image=image_name,
-                environment=container_config["environment"] if "environment" in container_config else None,
-                links=links,
-                volumes=volumes,
-                volumes_from=volumes_from,
-                udp_ports=[],
-                tcp_ports=ports,
-                restart=container_config["restart"] if "restart" in container_config else True,
-                user=container_config["user"] if "user" in container_config else None,
-                command=container_config["command"] if "command" in container_config else None,
-                dns=[__salt__['grains.get']('ip4_interfaces:eth0')[0]],
-                domain="consul"
-            )
-            result["container_ids"][container_name]["new"] = container_id
-
-            __salt__['mwdocker.start_container'](container_name)
-            logger.info("Created container %s with id %s" % (container_name, container_id))
 
+                instance = dict((k, v) for k, v in instance.items() if k not in CPUSET_LIMITS)
+                instance.update(new or {})
+                if len(instance) > 0:
+                    placements.setdefault(service_name, {}).setdefault(key, {})[container_number] = instance
+                else:
+                    del placements[service_name][key][container_number]
+                    if len(placements[service_name][key]) == 0:
+                        del placements[service_name][key]
 
-    return result
+    if test:
+        record(_read_placements())
+    else:
+        _update_placements(record)
+    return changes
+
+
+def instance_container(service_name, key, instance=0):
+    """
+    Gets the name of the container that currently runs an instance of a
+    service's container. This is `<service>-<key>-<instance>`, unless the
+    instance was moved to another container (for example, by a blue-green
+    deployment).
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :param instance: The instance number
+    :return: The container name
+    """
+    container_config = __salt__['pillar.get']('microservices:%s:containers:%s' % (service_name, key), {})
+    placement = _read_placements().get(service_name, {})
+    return _instance_placement(placement, service_name, key, container_config, int(instance))["container"]
+
+
+def instance_ports(service_name, service_config=None):
+    """
+    Lists the host ports of all instances of a service's HTTP containers, as
+    recorded in the placement file.
+
+    :param service_name: The service name
+    :param service_config: The service definition (defaults to the service's
+        pillar)
+    :return: A sorted list of ports
+    """
+    if service_config is None:
+        service_config = __salt__['pillar.get']('microservices:%s' % service_name)
+    placement = _read_placements().get(service_name, {})
+
+    ports = []
+    for key, container_config in service_config['containers'].items():
+        if not container_config.get('http'):
+            continue
+        for container_number in range(container_config['instances']):
+            ports.append(_instance_placement(placement, service_name, key, container_config, container_number)["port"])
+    return sorted(ports)
+
+
+def _in_batches(function, items, batch_size):
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    if batch_size == 1:
+        for batch in batches:
+            function(batch[0])
+        return
+
+    pool = ThreadPool(min(batch_size, max(1, len(items))))
+    try:
+        for batch in batches:
+            pool.map(function, batch)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _redeploy_instance(service_name, service_definition, key, container_config, image_name, current_image_id,
+                       instance, container_number, placement, result, force=False):
+    container_name = instance["container"]
+    haproxy_server = _haproxy_server(service_name, key, container_config, container_number)
+    existing_container_info = __salt__['mwdocker.inspect_container'](container_name)
+    if existing_container_info is not None:
+        used_image_id = existing_container_info['Image']
+        result["container_ids"][container_name] = {"old": existing_container_info["Id"]}
+    else:
+        used_image_id = None
+        result["container_ids"][container_name] = {"old": None}
+
+    result["container_images"][container_name] = {
+        "old": used_image_id,
+        "new": current_image_id
+    }
+
+    if used_image_id == current_image_id:
+        result["container_ids"][container_name]["new"] = result["container_ids"][container_name]["old"]
+        if not force and 'volumes_from' not in container_config:
+            return
+
+    if existing_container_info is not None:
+        if 'stateful' in container_config and container_config['stateful']:
+            logger.warn("Container %s needs to be updates (current image version is %s), but is stateful. Please upgrade yourself." % (container_name, current_image_id))
+            result["container_ids"][container_name]["new"] = None
+            return
+        if haproxy_server is not None:
+            logger.info("Draining HAProxy server %s/%s" % haproxy_server)
+            _haproxy('drain_server', *haproxy_server, timeout=int(container_config.get('drain_wait', 10)))
+        logger.info("Deleting container %s" % container_name)
+        __salt__['mwdocker.delete_container'](container_name)
+
+    container_id = _create_instance(service_name, service_definition, key, image_name, instance, container_number,
+                                    placement)
+    result["container_ids"][container_name]["new"] = container_id
+
+    if haproxy_server is not None:
+        _haproxy('enable_server', *haproxy_server)
+
+
+def _redeploy_standbys(service_name, service_definition, key, image_name, current_image_id, placement, result,
+                       force=False):
+    """
+    Re-creates the standby containers of a container that do not run the
+    current image (or all of them, with `force`), so that promoted standbys
+    never run an outdated image.
+    """
+    for standby in _standby_placements(placement, service_name, key, service_definition['containers'][key]):
+        info = __salt__['mwdocker.inspect_container'](standby["container"])
+        if not force and info is not None and info["Image"] == current_image_id:
+            continue
+
+        result["container_ids"][standby["container"]] = {"old": info["Id"] if info is not None else None}
+        if info is not None:
+            __salt__['mwdocker.delete_container'](standby["container"])
+
+        container_id = _create_instance(service_name, service_definition, key, image_name, standby, None, placement)
+        result["container_ids"][standby["container"]]["new"] = container_id
+
+
+def _haproxy_server(service_name, key, container_config, container_number):
+    """
+    Determines the HAProxy backend and server name of a service instance (as
+    defined in `mwms/haproxy/files/haproxy.conf.j2`), or `None` if the instance
+    is not served by HAProxy.
+    """
+    if not container_config.get('http') or 'mwhaproxy.available' not in __salt__ or \
+            not __salt__['mwhaproxy.available']():
+        return None
+    return "%s_%s" % (service_name, key), "%s-%s-%d" % (service_name, key, container_number)
+
+
+def _haproxy(function, *args, **kwargs):
+    # HAProxy is optional; a server that HAProxy does not know about (yet)
+    # must not fail the deployment.
+    try:
+        return __salt__['mwhaproxy.%s' % function](*args, **kwargs)
+    except Exception as e:
+        logger.warning("Could not update HAProxy server %s: %s" % ('/'.join(args[:2]), e))
+
+
+def _create_instance(service_name, service_definition, key, image_name, instance, container_number, placement):
+    """
+    Creates and starts the container of a service instance and waits until it
+    is ready.
+
+    :param instance: The instance's placement (container name and port)
+    :param container_number: The instance number (`None` for standbys)
+    :param placement: The placement of the service's instances, used to
+        determine the names of linked containers
+    :return: The ID of the new container
+    """
+    container_config = service_definition['containers'][key]
+    container_name = instance["container"]
+
+    links = {}
+    if 'links' in container_config:
+        for linked_container, alias in sorted(container_config['links'].items()):
+            linked_container_name = _instance_placement(placement, service_name, linked_container,
+                                                        service_definition['containers'].get(linked_container, {}),
+                                                        0)["container"]
+            links[linked_container_name] = alias
+
+    volumes_from = None
+    if 'volumes_from' in container_config:
+        volumes_from = []
+        for volume_container in container_config['volumes_from']:
+            volume_container_name = _instance_placement(placement, service_name, volume_container,
+                                                        service_definition['containers'].get(volume_container, {}),
+                                                        0)["container"]
+            volumes_from.append(volume_container_name)
+
+    volumes = []
+    if "volumes" in container_config:
+        volumes = []
+        for dir, mount, mode in container_config["volumes"]:
+            source_dir = "/var/lib/services/%s/%s" % (service_name, dir)
+            volumes.append("%s:%s:%s" % (source_dir, mount, mode))
+
+    ports = []
+    check_url = None
+    if 'http' in container_config and container_config['http']:
+        host_port = instance["port"]
+        check_url = "http://localhost:%d%s" % (host_port, service_definition['check_url'] if 'check_url' in service_definition else '/status')
+
+        container_http_port = 80
+        if 'http_internal_port' in container_config:
+            container_http_port = container_config['http_internal_port']
+
+        ports.append({"address": "0.0.0.0", "port": container_http_port, "host_port": host_port})
+    elif 'ports' in container_config:
+        ports += container_config['ports']
+
+    container_id = __salt__['mwdocker.create_container'](
+        name=container_name,
+        image=image_name,
+        environment=container_config["environment"] if "environment" in container_config else None,
+        links=links,
+        volumes=volumes,
+        volumes_from=volumes_from,
+        udp_ports=[],
+        tcp_ports=ports,
+        restart=container_config["restart"] if "restart" in container_config else True,
+        user=container_config["user"] if "user" in container_config else None,
+        command=container_config["command"] if "command" in container_config else None,
+        dns=[__salt__['grains.get']('ip4_interfaces:eth0')[0]],
+        domain="consul",
+        labels={
+            "service": service_name,
+            "service_group": "%s-%s-%s" % (service_name, service_name, key)
+        },
+        resources=_instance_resources(container_config,
+                                      None if container_number is None else
+                                      _cpu_allocation().get(service_name, {}).get(key, {}).get(str(container_number)))
+    )
+
+    __salt__['mwdocker.start_container'](container_name, check_url=check_url)
+    logger.info("Created container %s with id %s" % (container_name, container_id))
+    return container_id
+
+
+def _uses_blue_green(container_config):
+    return bool(container_config.get('blue_green')) and bool(container_config.get('http')) and \
+        not container_config.get('stateful')
+
+
+def _blue_green_deploy(service_name, service_definition, key, image_name, current_image_id, max_unavailable,
+                       result, force=False):
+    """
+    Starts a new generation of a container's instances and switches traffic to
+    it (see `redeploy`). Unless `force` is set, nothing is done when all
+    instances already run the current image.
+
+    :return: `True` if the container's generation was switched
+    """
+    container_config = service_definition['containers'][key]
+    placement = _read_placements().get(service_name, {})
+    instances = list(range(container_config['instances']))
+
+    old = {}
+    new = {}
+    for container_number in instances:
+        old[container_number] = _instance_placement(placement, service_name, key, container_config, container_number)
+        new[container_number] = _alternate_placement(service_name, key, container_config, container_number,
+                                                     old[container_number])
+
+    old_infos = dict((n, __salt__['mwdocker.inspect_container'](old[n]["container"])) for n in instances)
+    for n in instances:
+        result["container_images"][new[n]["container"]] = {
+            "old": old_infos[n]["Image"] if old_infos[n] is not None else None,
+            "new": current_image_id
+        }
+
+    if not force and all(info is not None and info["Image"] == current_image_id for info in old_infos.values()):
+        for n in instances:
+            result["container_ids"][old[n]["container"]] = {"old": old_infos[n]["Id"], "new": old_infos[n]["Id"]}
+        return False
+
+    created = {}
+
+    def start_new_instance(container_number):
+        instance = new[container_number]
+        start = time.time()
+
+        # Left over from an earlier, failed deployment
+        if __salt__['mwdocker.inspect_container'](instance["container"]) is not None:
+            __salt__['mwdocker.delete_container'](instance["container"])
+
+        created[container_number] = _create_instance(service_name, service_definition, key, image_name, instance,
+                                                     container_number, placement)
+        result["timings"][instance["container"]] = round(time.time() - start, 3)
+
+    try:
+        _in_batches(start_new_instance, instances, max_unavailable)
+    except Exception:
+        logger.error("New generation of %s-%s did not become ready; keeping the current generation" %
+                     (service_name, key))
+        for container_number in created:
+            __salt__['mwdocker.delete_container'](new[container_number]["container"])
+        raise
+
+    def switch(placements):
+        service_placement = placements.setdefault(service_name, {})
+        current = service_placement.get(key, {})
+        service_placement[key] = {}
+        for n in instances:
+            # The instance keeps its CPUs
+            instance = dict(new[n])
+            for limit in CPUSET_LIMITS:
+                if limit in current.get(str(n), {}):
+                    instance[limit] = current[str(n)][limit]
+            service_placement[key][str(n)] = instance
+
+    placements = _update_placements(switch)
+    _switch_traffic(service_name, service_definition, placements.get(service_name, {}))
+
+    for n in instances:
+        haproxy_server = _haproxy_server(service_name, key, container_config, n)
+        if haproxy_server is not None:
+            _haproxy('set_address', *haproxy_server, address='127.0.0.1', port=new[n]["port"])
+            _haproxy('enable_server', *haproxy_server)
+
+    for n in instances:
+        result["container_ids"][new[n]["container"]] = {
+            "old": old_infos[n]["Id"] if old_infos[n] is not None else None,
+            "new": created[n]
+        }
+
+    # Requests that are still being served by the old generation (for
+    # example, by old NGINX workers) may be completed in the meantime.
+    drain_wait = int(container_config.get('drain_wait', 10))
+    logger.info("Draining old generation of %s-%s for %d seconds" % (service_name, key, drain_wait))
+    time.sleep(drain_wait)
+
+    for n in instances:
+        if old_infos[n] is not None:
+            __salt__['mwdocker.delete_container'](old[n]["container"])
+    return True
+
+
+def _switch_traffic(service_name, service_definition, placement):
+    """
+    Points the NGINX upstream and the Consul registrations of a service at the
+    containers given by `placement`, re-using the states that `mwms.services`
+    would generate.
+    """
+    states = __salt__['mwcompiler.service_states'](
+        service_name, service_definition,
+        _service_instances(service_name, service_definition, placement))["states"]
+
+    for state_id, state in sorted(states.items()):
+        if 'consul.service_registered' in state:
+            args = _state_args(state['consul.service_registered'])
+            __salt__['consul.service_register']({
+                'name': args['name'],
+                'id': args['service_id'],
+                'port': args['port'],
+                'checks': args['checks']
+            })
+
+    upstream_file = "/etc/nginx/upstreams/service_%s.conf" % service_name
+    if upstream_file in states and not __salt__['pillar.get']('nginx:consul_upstreams', False):
+        args = _state_args(states[upstream_file]['file.managed'])
+        partial = upstream_file + '.tmp'
+        __salt__['cp.get_template'](args['source'], partial, template='jinja', **args['context'])
+        os.rename(partial, upstream_file)
+        __salt__['service.reload']('nginx')
+
+
+def _state_args(arguments):
+    args = {}
+    for argument in arguments:
+        args.update(argument)
+    return args
+
+
+def _containers_use_images(service_name, service_definition, image_ids, placement):
+    for key, container_config in service_definition['containers'].items():
+        for container_number in range(container_config['instances']):
+            container_name = _instance_placement(placement, service_name, key, container_config,
+                                                 container_number)["container"]
+            info = __salt__['mwdocker.inspect_container'](container_name)
+            if info is None or info['Image'] != image_ids[key]:
+                return False
+    return True
+
+
+def _instance_placement(placement, service_name, key, container_config, container_number):
+    """
+    Determines the container name and (for HTTP containers) the host port of a
+    service instance. Instances that were not moved to another container run in
+    `<service>-<key>-<instance>` on `base_port + instance`.
+    """
+    instance = placement.get(key, {}).get(str(container_number), {})
+    if "container" in instance:
+        return instance
+
+    port = None
+    if container_config.get('http'):
+        port = container_config['base_port'] + container_number
+
+    # The placement of an instance that was not moved may still contain the
+    # CPUs assigned to it (see _cpu_allocation).
+    default = {"container": "%s-%s-%d" % (service_name, key, container_number), "port": port}
+    default.update(instance)
+    return default
+
+
+def _alternate_placement(service_name, key, container_config, container_number, current):
+    default = _instance_placement({}, service_name, key, container_config, container_number)
+    if current["container"] != default["container"]:
+        return default
+
+    green_base_port = container_config.get('green_base_port', container_config['base_port'] + 1000)
+    return {
+        "container": "%s-%s-%d-green" % (service_name, key, container_number),
+        "port": green_base_port + container_number
+    }
+
+
+def _standby_placements(placement, service_name, key, container_config):
+    """
+    Determines the containers of a container's warm standby pool. Standbys run
+    in `<service>-<key>-standby-<n>` on `standby_base_port + n`; standbys that
+    have been promoted to instances are replaced with the next free number.
+    """
+    if not _uses_standby(container_config):
+        return []
+
+    count = int(container_config['standby'])
+    base_port = container_config.get('standby_base_port', container_config['base_port'] + 2000)
+    in_use = set(instance.get("container") for instance in placement.get(key, {}).values())
+
+    standbys = []
+    n = 0
+    while len(standbys) < count:
+        container = "%s-%s-standby-%d" % (service_name, key, n)
+        if container not in in_use:
+            standbys.append({"container": container, "port": base_port + n})
+        n += 1
+    return standbys
+
+
+def _service_instances(service_name, service_config, placement, promote=False):
+    allocation = _cpu_allocation().get(service_name, {})
+
+    containers = []
+    for key in _deploy_order(service_config['containers']):
+        container_config = service_config['containers'][key]
+        promoted = set()
+        if promote and _uses_standby(container_config):
+            placement, promoted = _plan_promotions(placement, service_name, key, container_config)
+
+        instances = []
+        for container_number in range(container_config['instances']):
+            instance = _instance_placement(placement, service_name, key, container_config, container_number)
+            pinning = allocation.get(key, {}).get(str(container_number))
+            instances.append({
+                "container": instance["container"],
+                "port": instance["port"],
+                "pinning": pinning,
+                "resources": _instance_resources(container_config, pinning),
+                "promoted": container_number in promoted
+            })
+
+        standbys = []
+        for standby in _standby_placements(placement, service_name, key, container_config):
+            standby["pinning"] = None
+            standby["resources"] = _instance_resources(container_config, None)
+            standby["missing"] = promote and __salt__['mwdocker.inspect_container'](standby["container"]) is None
+            standbys.append(standby)
+
+        containers.append({"key": key, "instances": instances, "standbys": standbys})
+    return containers
+
+
+def _plan_promotions(placement, service_name, key, container_config):
+    """
+    Determines which instances of a container will be taken over by running
+    standbys, without changing anything.
+
+    :return: A tuple of the service's placement including the planned
+        promotions and the set of promoted instance numbers
+    """
+    planned = dict(placement)
+    planned[key] = dict((n, dict(instance)) for n, instance in placement.get(key, {}).items())
+    promoted = set()
+
+    standbys = [standby for standby in _standby_placements(placement, service_name, key, container_config)
+                if (__salt__['mwdocker.inspect_container'](standby["container"]) or {}).get('State', {}).get('Running')]
+
+    for container_number in range(container_config['instances']):
+        if len(standbys) == 0:
+            break
+
+        instance = _instance_placement(planned, service_name, key, container_config, container_number)
+        if "container" in planned[key].get(str(container_number), {}) or \
+                __salt__['mwdocker.inspect_container'](instance["container"]) is not None:
+            continue
+
+        standby = standbys.pop(0)
+        planned[key].setdefault(str(container_number), {}).update(standby)
+        promoted.add(container_number)
+
+    return planned, promoted
+
+
+def _uses_standby(container_config):
+    return int(container_config.get('standby', 0)) > 0 and bool(container_config.get('http')) and \
+        not container_config.get('stateful')
+
+
+def _instance_resources(container_config, pinning):
+    """
+    Determines the resource limits of a service instance: the `resources` of
+    its container definition, plus the CPUs and memory nodes assigned to the
+    instance by `_cpu_allocation` (unless set explicitly).
+    """
+    resources = dict(container_config.get('resources', {}))
+    resources.pop('cpus', None)
+    for limit, value in (pinning or {}).items():
+        resources.setdefault(limit, value)
+    return resources or None
+
+
+def _cpu_allocation():
+    """
+    Assigns dedicated CPUs to all instances of containers that request them
+    (using the `cpus` resource, without setting `cpuset_cpus` explicitly) when
+    the `mwms:cpu_pinning` pillar is set.
+
+    CPUs that were assigned to an instance before (and recorded in the
+    placement file by the `microservice.cpus_allocated` state) are kept as long
+    as the instance exists, so that adding or removing instances never moves
+    the containers of other instances. Each new instance gets the least used
+    CPUs of the NUMA node with the lowest share of assigned CPUs; the memory
+    of an instance is taken from the same node. When more CPUs are requested
+    than available, CPUs are shared.
+
+    :return: A dictionary mapping service name, container key and (as string)
+        instance number to the instance's `cpuset_cpus` and `cpuset_mems`
+    """
+    if 'microservice.cpu_allocation' in __context__:
+        return __context__['microservice.cpu_allocation']
+
+    allocation = {}
+    if __salt__['pillar.get']('mwms:cpu_pinning', False):
+        reserved = set(int(cpu) for cpu in __salt__['pillar.get']('mwms:reserved_cpus', []))
+        nodes = [(node, [cpu for cpu in cpus if cpu not in reserved]) for node, cpus in _cpu_topology()]
+        nodes = [(node, cpus) for node, cpus in nodes if len(cpus) > 0]
+        usage = dict((cpu, 0) for node, cpus in nodes for cpu in cpus)
+        placements = _read_placements()
+        unassigned = []
+
+        service_definitions = __salt__['pillar.get']('microservices', {})
+        for service_name, service_config in sorted(service_definitions.items()):
+            for key, container_config in sorted(service_config['containers'].items()):
+                resources = container_config.get('resources', {})
+                count = int(resources.get('cpus', 0))
+                if count == 0 or 'cpuset_cpus' in resources or len(nodes) == 0:
+                    continue
+
+                for container_number in range(container_config.get('instances', 1)):
+                    recorded = placements.get(service_name, {}).get(key, {}).get(str(container_number), {})
+                    if not _usable_cpus(recorded, nodes, count):
+                        unassigned.append((service_name, key, container_number, count))
+                        continue
+
+                    for cpu in _parse_cpu_list(recorded['cpuset_cpus']):
+                        usage[cpu] += 1
+                    allocation.setdefault(service_name, {}).setdefault(key, {})[str(container_number)] = \
+                        dict((limit, recorded[limit]) for limit in CPUSET_LIMITS)
+
+        for service_name, key, container_number, count in unassigned:
+            node, cpus = min(nodes, key=lambda n: (float(sum(usage[cpu] for cpu in n[1])) / len(n[1]), n[0]))
+            instance_cpus = sorted(sorted(cpus, key=lambda cpu: (usage[cpu], cpu))[:count])
+            if any(usage[cpu] > 0 for cpu in instance_cpus):
+                logger.warning("NUMA node %d is overcommitted; %s-%s-%d shares CPUs with other containers" %
+                               (node, service_name, key, container_number))
+            for cpu in instance_cpus:
+                usage[cpu] += 1
+
+            allocation.setdefault(service_name, {}).setdefault(key, {})[str(container_number)] = {
+                "cpuset_cpus": ",".join(str(cpu) for cpu in instance_cpus),
+                "cpuset_mems": str(node)
+            }
+
+    __context__['microservice.cpu_allocation'] = allocation
+    return allocation
+
+
+def _usable_cpus(recorded, nodes, count):
+    """
+    Checks if the CPUs recorded for an instance can still be used: they must
+    all be (unreserved) CPUs of the recorded node, and as many as requested
+    (or all CPUs of the node, if it has fewer).
+    """
+    if 'cpuset_cpus' not in recorded or 'cpuset_mems' not in recorded:
+        return False
+
+    node_cpus = dict(nodes).get(int(recorded['cpuset_mems']))
+    cpus = _parse_cpu_list(recorded['cpuset_cpus'])
+    return node_cpus is not None and set(cpus) <= set(node_cpus) and len(cpus) == min(count, len(node_cpus))
+
+
+def _cpu_topology():
+    """
+    Reads the host's NUMA nodes and their CPUs from sysfs. Hosts without NUMA
+    information are treated as a single node with all CPUs.
+
+    :return: A list of (node, CPUs) tuples
+    """
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        with open(path) as f:
+            nodes.append((node, _parse_cpu_list(f.read())))
+
+    if len(nodes) == 0:
+        nodes.append((0, list(range(multiprocessing.cpu_count()))))
+    return sorted(nodes)
+
+
+def _parse_cpu_list(cpu_list):
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def _placement_file():
+    return __salt__['config.get']('microservice.placement_file', '/var/lib/mwms/placement.json')
+
+
+def _read_placements():
+    try:
+        with open(_placement_file()) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def _update_placements(update):
+    placement_file = _placement_file()
+    if not os.path.isdir(os.path.dirname(placement_file)):
+        os.makedirs(os.path.dirname(placement_file))
+
+    # Several services may be re-deployed at the same time.
+    with open(placement_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            placements = _read_placements()
+            update(placements)
+
+            partial = placement_file + '.tmp'
+            with open(partial, 'w') as f:
+                json.dump(placements, f, indent=2, sort_keys=True)
+            os.rename(partial, placement_file)
+            return placements
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _deploy_order(containers):
+    """
+    Sorts the container keys of a service so that each container comes after
+    the containers that it links to or uses volumes from.
+    """
+    order = []
+    visiting = set()
+
+    def visit(key):
+        if key in order:
+            return
+        if key in visiting:
+            raise Exception('Circular links or volumes_from between containers: %s' % ', '.join(sorted(visiting)))
+
+        visiting.add(key)
+        container_config = containers[key]
+        dependencies = list(container_config.get('links', {}).keys()) + list(container_config.get('volumes_from', []))
+        for dependency in sorted(dependencies):
+            if dependency in containers:
+                visit(dependency)
+        visiting.remove(key)
+        order.append(key)
+
+    for key in sorted(containers.keys()):
+        visit(key)
+
+    return order
@@ -0,0 +1,661 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import datetime
+import filecmp
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+BACKUP_ROOT = '/var/backups/service'
+CHUNK_SIZE = 1024 * 1024
+SNAPSHOT_PATTERN = re.compile(r'^(\d{8})(\.tar\.gz|\.manifest\.json\.gz)?$')
+
+
+def run(service_name=None, concurrency=None, stagger=None):
+    """
+    Runs the backups of all containers that have a `backup` configuration in
+    the `microservices` pillar. At most `concurrency` backups are run at the
+    same time, and consecutive backups are started at least `stagger` seconds
+    apart to spread the I/O load.
+
+    :param service_name: Only back up the containers of this service
+    :param concurrency: How many backups to run at once. Defaults to the
+        `mwbackup.concurrency` minion option (or 2, if that is not set)
+    :param stagger: Minimum delay in seconds between starting two backups.
+        Defaults to the `mwbackup.stagger` minion option (or 30, if that is not
+        set)
+    :return: A dictionary with the result of each backup, indexed by
+        "<service>/<container>"
+    """
+    if concurrency is None:
+        concurrency = int(__salt__['config.get']('mwbackup.concurrency', 2))
+    if stagger is None:
+        stagger = float(__salt__['config.get']('mwbackup.stagger', 30))
+
+    jobs = []
+    service_definitions = __salt__['pillar.get']('microservices', {})
+    for name, service_config in sorted(service_definitions.items()):
+        if service_name is not None and name != service_name:
+            continue
+        for key, container_config in sorted(service_config['containers'].items()):
+            if "backup" in container_config:
+                jobs.append((name, key))
+
+    if len(jobs) == 0:
+        return {}
+
+    schedule = {'next': time.time()}
+    schedule_lock = threading.Lock()
+
+    def run_job(job):
+        with schedule_lock:
+            start_at = max(time.time(), schedule['next'])
+            schedule['next'] = start_at + stagger
+        time.sleep(max(0, start_at - time.time()))
+
+        try:
+            return job, backup(job[0], job[1])
+        except Exception as e:
+            log.error("Backup of %s/%s failed: %s" % (job[0], job[1], e))
+            return job, {"result": False, "comment": str(e)}
+
+    pool = ThreadPool(max(1, min(int(concurrency), len(jobs))))
+    try:
+        results = pool.map(run_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(("%s/%s" % job, result) for job, result in results)
+
+
+def backup(service_name, key):
+    """
+    Backs up the volumes of the first instance of a container.
+
+    When the container's `backup` configuration contains a `docker_image`, a
+    temporary container is created from that image that has the source
+    container's volumes, a link to the source container (as "source") and a
+    `/target` directory into which the backup is expected to be written. If a
+    `command` is configured, that command is run in the temporary container
+    and the contents of `/target` are afterwards streamed as tar archive out of
+    the container; otherwise, the image's default command is run with the
+    backup directory `<date>` mounted at `/target`. In incremental mode, files
+    of such backup directories that did not change since the previous backup
+    are replaced with hardlinks to the previous backup's files.
+
+    Without a `docker_image`, the contents of all of the container's volumes
+    are streamed as tar archive out of a temporary container created from the
+    `mwbackup.helper_image` image (`busybox` by default).
+
+    Streamed backups are compressed on the fly into `<date>.tar.gz`, so that
+    no uncompressed copy is written to disk. In incremental mode, the file
+    contents are instead stored in a content-addressed store (each distinct
+    file content is stored only once) and the backup consists of a
+    `<date>.manifest.json.gz` file listing the archive's members; unchanged
+    files are not stored again.
+
+    After the backup, old backups are pruned according to the `retention`
+    setting of the backup configuration.
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :return: A dictionary describing the backup
+    """
+    backup_config = __salt__['pillar.get']('microservices:%s:containers:%s:backup' % (service_name, key))
+    if not backup_config:
+        raise Exception('No backup configured for container %s of service %s' % (key, service_name))
+
+    source_container = __salt__['microservice.instance_container'](service_name, key, 0)
+    backup_dir = _backup_dir(service_name, key)
+    date = time.strftime('%Y%m%d')
+    incremental = backup_config.get("incremental", False)
+
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+
+    start = time.time()
+    if "docker_image" in backup_config and "command" not in backup_config:
+        target = "%s/%s" % (backup_dir, date)
+        previous = _latest_snapshot(backup_dir, before=date)
+        _run_image_backup(source_container, backup_config, target)
+        size = _directory_size(target)
+        written = size
+        if incremental and previous is not None and os.path.isdir(previous[1]):
+            written -= _link_unchanged_files(previous[1], target)
+    elif incremental:
+        target = "%s/%s.manifest.json.gz" % (backup_dir, date)
+        size, written = _run_incremental_stream_backup(source_container, backup_config, backup_dir, target)
+    else:
+        target = "%s/%s.tar.gz" % (backup_dir, date)
+        size, written = _run_stream_backup(source_container, backup_config, target)
+    duration = time.time() - start
+
+    log.info("Backup of %s/%s finished: %d bytes (%d bytes written) in %.1f seconds (%.2f MB/s)" % (
+        service_name, key, size, written, duration, size / max(duration, 0.001) / 1024 / 1024))
+
+    pruned = []
+    if "retention" in backup_config:
+        pruned = prune(service_name, key)
+
+    return {
+        "result": True,
+        "target": target,
+        "bytes": size,
+        "bytes_written": written,
+        "duration": round(duration, 3),
+        "pruned": pruned
+    }
+
+
+def snapshots(service_name, key):
+    """
+    Lists the available backups of a container.
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :return: A sorted list of backup dates (in the format "YYYYMMDD")
+    """
+    return [date for date, path in _snapshots(_backup_dir(service_name, key))]
+
+
+def prune(service_name, key, daily=None, weekly=None):
+    """
+    Deletes old backups of a container. The `daily` most recent backups are
+    kept, plus the most recent backup of each of the `weekly` most recent
+    weeks. By default, both values are read from the `retention` setting of the
+    container's backup configuration. File contents in the content-addressed
+    store that are not used by any remaining backup are deleted, as well.
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :param daily: How many daily backups to keep
+    :param weekly: How many weekly backups to keep
+    :return: The list of deleted backup dates
+    """
+    if daily is None or weekly is None:
+        retention = __salt__['pillar.get']('microservices:%s:containers:%s:backup:retention' % (service_name, key), {})
+        if daily is None:
+            daily = int(retention.get('daily', 7))
+        if weekly is None:
+            weekly = int(retention.get('weekly', 0))
+
+    backup_dir = _backup_dir(service_name, key)
+    existing = _snapshots(backup_dir)
+    dates = sorted(set(date for date, path in existing), reverse=True)
+
+    keep = set(dates[:daily])
+    weeks = set()
+    for date in dates:
+        week = datetime.datetime.strptime(date, '%Y%m%d').isocalendar()[:2]
+        if week not in weeks and len(weeks) < weekly:
+            weeks.add(week)
+            keep.add(date)
+
+    pruned = []
+    for date, path in existing:
+        if date in keep:
+            continue
+        log.info("Pruning backup %s" % path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        pruned.append(date)
+
+    store = "%s/store" % backup_dir
+    if os.path.isdir(store):
+        _collect_garbage(backup_dir, store)
+
+    return sorted(set(pruned))
+
+
+def restore(service_name, key, target, snapshot=None):
+    """
+    Restores a backup of a container. For backups that were written into a
+    backup directory, that directory is copied to `target`. For streamed
+    backups, the backed-up contents are either extracted into the directory
+    `target`, or, if `target` ends with ".tar.gz", written as compressed tar
+    archive. Archive members with absolute paths or that would be extracted
+    outside of `target` (including links pointing outside of it) are refused.
+
+    :param service_name: The service name
+    :param key: The container name (within the service)
+    :param target: The directory or archive file to restore into
+    :param snapshot: The date of the backup to restore (in the format
+        "YYYYMMDD"). Defaults to the most recent backup
+    :return: The path of the restored backup
+    """
+    backup_dir = _backup_dir(service_name, key)
+    candidates = [(d, p) for d, p in _snapshots(backup_dir) if snapshot is None or d == str(snapshot)]
+    if len(candidates) == 0:
+        raise Exception('No backup %sof container %s of service %s found' % (
+            '' if snapshot is None else '%s ' % snapshot, key, service_name))
+
+    date, path = candidates[-1]
+    as_archive = target.endswith('.tar.gz')
+    log.info("Restoring backup %s into %s" % (path, target))
+
+    if os.path.isdir(path):
+        shutil.copytree(path, target, symlinks=True)
+    elif path.endswith('.tar.gz'):
+        if as_archive:
+            shutil.copyfile(path, target)
+        else:
+            with tarfile.open(path, 'r:gz') as archive:
+                _extract_archive(archive, target)
+    else:
+        manifest = _read_manifest(path)
+        store = "%s/store" % backup_dir
+        if as_archive:
+            _write_archive_from_manifest(manifest, store, target)
+        else:
+            _extract_manifest(manifest, store, target)
+
+    return target
+
+
+def _backup_dir(service_name, key):
+    return "%s/%s/%s" % (BACKUP_ROOT, service_name, key)
+
+
+def _snapshots(backup_dir):
+    """
+    Returns a sorted list of (date, path) tuples of the backups in a backup
+    directory.
+    """
+    result = []
+    if not os.path.isdir(backup_dir):
+        return result
+
+    for entry in os.listdir(backup_dir):
+        match = SNAPSHOT_PATTERN.match(entry)
+        if match is not None:
+            result.append((match.group(1), "%s/%s" % (backup_dir, entry)))
+    return sorted(result)
+
+
+def _latest_snapshot(backup_dir, before=None):
+    existing = [(d, p) for d, p in _snapshots(backup_dir) if before is None or d < before]
+    return existing[-1] if len(existing) > 0 else None
+
+
+def _link_unchanged_files(previous, current):
+    """
+    Replaces files in `current` that are identical to the same file in
+    `previous` with hardlinks to the file in `previous`.
+
+    :return: The number of bytes that were saved
+    """
+    saved = 0
+    for root, dirs, files in os.walk(current):
+        relative_root = os.path.relpath(root, current)
+        for f in files:
+            current_file = os.path.join(root, f)
+            previous_file = os.path.normpath(os.path.join(previous, relative_root, f))
+            if os.path.islink(current_file) or not os.path.isfile(previous_file) or os.path.islink(previous_file):
+                continue
+            if not filecmp.cmp(current_file, previous_file, shallow=False):
+                continue
+
+            linked = current_file + ".link"
+            os.link(previous_file, linked)
+            os.rename(linked, current_file)
+            saved += os.path.getsize(current_file)
+    return saved
+
+
+def _run_image_backup(source_container, backup_config, target):
+    command = [
+        "docker", "run", "--rm",
+        "--link", "%s:source" % source_container,
+        "-v", "%s:/target" % target,
+        "--volumes-from", source_container,
+        backup_config["docker_image"]
+    ]
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Exception('Backup container failed with exit code %d: %s' % (proc.returncode, output))
+
+
+def _stream_command(source_container, backup_config):
+    if "command" in backup_config:
+        # The command's own output goes to stderr, so that stdout carries only
+        # the tar archive of whatever the command wrote into /target.
+        script = "mkdir -p /target && (%s) 1>&2 && tar -cf - -C /target ." % backup_config["command"]
+        return [
+            "docker", "run", "--rm",
+            "--link", "%s:source" % source_container,
+            "--volumes-from", source_container,
+            backup_config["docker_image"],
+            "bash", "-c", script
+        ]
+
+    paths = _container_volume_paths(source_container)
+    if len(paths) == 0:
+        raise Exception('Container %s has no volumes to back up' % source_container)
+
+    return [
+        "docker", "run", "--rm",
+        "--volumes-from", source_container,
+        __salt__['config.get']('mwbackup.helper_image', 'busybox'),
+        "tar", "-cf", "-", "-C", "/"
+    ] + [p.lstrip('/') for p in paths]
+
+
+def _run_stream_backup(source_container, backup_config, target):
+    command = _stream_command(source_container, backup_config)
+    compress_level = int(backup_config.get("compress_level", 6))
+    partial = target + ".part"
+    size = 0
+
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+    try:
+        with open(partial, 'wb') as f:
+            archive = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compress_level)
+            try:
+                while True:
+                    chunk = proc.stdout.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    archive.write(chunk)
+                    size += len(chunk)
+            finally:
+                archive.close()
+
+        if proc.wait() != 0:
+            errors.seek(0)
+            raise Exception('Streaming backup of %s failed with exit code %d: %s' % (
+                source_container, proc.returncode, errors.read()))
+    except Exception:
+        if proc.poll() is None:
+            proc.kill()
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+    finally:
+        errors.close()
+
+    os.rename(partial, target)
+    return size, os.path.getsize(target)
+
+
+def _run_incremental_stream_backup(source_container, backup_config, backup_dir, target):
+    command = _stream_command(source_container, backup_config)
+    store = "%s/store" % backup_dir
+
+    previous_members = {}
+    previous = _latest_snapshot(backup_dir, before=time.strftime('%Y%m%d'))
+    if previous is not None and previous[1].endswith('.manifest.json.gz'):
+        for member in _read_manifest(previous[1])['members']:
+            previous_members[member['name']] = member
+
+    members = []
+    size = 0
+    written = 0
+
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as archive:
+            for info in archive:
+                member = {
+                    'name': info.name,
+                    'type': info.type.decode('ascii') if isinstance(info.type, bytes) else info.type,
+                    'mode': info.mode,
+                    'uid': info.uid,
+                    'gid': info.gid,
+                    'uname': info.uname,
+                    'gname': info.gname,
+                    'mtime': info.mtime,
+                    'size': info.size,
+                    'linkname': info.linkname
+                }
+
+                if info.isfile():
+                    size += info.size
+                    unchanged = previous_members.get(info.name)
+                    if unchanged is not None and unchanged['size'] == info.size and \
+                            unchanged['mtime'] == info.mtime and os.path.exists(_blob_path(store, unchanged['digest'])):
+                        member['digest'] = unchanged['digest']
+                    else:
+                        member['digest'], blob_size = _store_blob(store, archive.extractfile(info),
+                                                                  int(backup_config.get("compress_level", 6)))
+                        written += blob_size
+
+                members.append(member)
+
+        if proc.wait() != 0:
+            errors.seek(0)
+            raise Exception('Streaming backup of %s failed with exit code %d: %s' % (
+                source_container, proc.returncode, errors.read()))
+    except Exception:
+        if proc.poll() is None:
+            proc.kill()
+        raise
+    finally:
+        errors.close()
+
+    partial = target + ".part"
+    with gzip.open(partial, 'wb') as f:
+        f.write(json.dumps({'members': members}).encode('utf-8'))
+    os.rename(partial, target)
+
+    return size, written + os.path.getsize(target)
+
+
+def _blob_path(store, digest):
+    return "%s/%s/%s" % (store, digest[:2], digest)
+
+
+def _store_blob(store, source, compress_level):
+    """
+    Stores the contents of a file object in the content-addressed store.
+
+    :return: A tuple of the content digest and the number of bytes written
+        (which is 0 when the content was already present)
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    digest = hashlib.sha256()
+    fd, partial = tempfile.mkstemp(dir=store, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            blob = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compress_level)
+            try:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    blob.write(chunk)
+            finally:
+                blob.close()
+
+        path = _blob_path(store, digest.hexdigest())
+        if os.path.exists(path):
+            os.unlink(partial)
+            return digest.hexdigest(), 0
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(partial, path)
+        return digest.hexdigest(), os.path.getsize(path)
+    except Exception:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+
+def _read_manifest(path):
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _tarinfo_from_manifest(member):
+    info = tarfile.TarInfo(member['name'])
+    info.type = member['type'].encode('ascii') if not isinstance(tarfile.REGTYPE, str) else member['type']
+    for attr in ('mode', 'uid', 'gid', 'uname', 'gname', 'mtime', 'linkname'):
+        setattr(info, attr, member[attr])
+    info.size = member['size'] if 'digest' in member else 0
+    return info
+
+
+def _write_archive_from_manifest(manifest, store, target):
+    with tarfile.open(target, 'w:gz') as archive:
+        for member in manifest['members']:
+            info = _tarinfo_from_manifest(member)
+            if 'digest' in member:
+                with gzip.open(_blob_path(store, member['digest']), 'rb') as blob:
+                    archive.addfile(info, blob)
+            else:
+                archive.addfile(info)
+
+
+def _restore_path(target, name):
+    """
+    Returns the path at which an archive member is restored, after making sure
+    that neither the path itself nor any (already restored) symlink along it
+    leads out of `target`. Absolute member names are refused; the archives
+    written by `backup` only contain relative names.
+    """
+    if os.path.isabs(name):
+        raise Exception('Refusing to restore absolute path %s' % name)
+
+    root = os.path.realpath(target)
+    path = os.path.normpath(os.path.join(root, name))
+    if path == root:
+        return path
+
+    # Symlinks are resolved before "..", so the parent directory is checked as
+    # it was given, too (like "link/../name", where "link" points to ".").
+    for parent in (os.path.dirname(path), os.path.dirname(os.path.join(root, name))):
+        parent = os.path.realpath(parent)
+        if parent != root and not parent.startswith(root + os.sep):
+            raise Exception('Refusing to restore %s outside of %s' % (name, target))
+    return path
+
+
+def _check_member(target, info):
+    _restore_path(target, info.name)
+    if info.islnk():
+        _restore_path(target, info.linkname)
+    elif info.issym():
+        if os.path.isabs(info.linkname):
+            raise Exception('Refusing to restore absolute link %s -> %s' % (info.name, info.linkname))
+        _restore_path(target, os.path.join(os.path.dirname(info.name), info.linkname))
+
+
+def _extract_archive(archive, target):
+    if hasattr(tarfile, 'data_filter'):
+        def restore_filter(info, path):
+            _check_member(target, info)
+            return tarfile.data_filter(info, path)
+
+        archive.extractall(target, filter=restore_filter)
+        return
+
+    # Each member is checked right before it is extracted, so that symlinks
+    # restored by earlier members are taken into account.
+    def checked_members():
+        for info in archive:
+            _check_member(target, info)
+            yield info
+
+    archive.extractall(target, checked_members())
+
+
+def _extract_manifest(manifest, store, target):
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    directories = []
+    for member in manifest['members']:
+        info = _tarinfo_from_manifest(member)
+        _check_member(target, info)
+        path = _restore_path(target, info.name)
+
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        if info.isdir():
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            directories.append((path, info))
+            continue
+        elif info.issym():
+            os.symlink(info.linkname, path)
+            continue
+        elif info.islnk():
+            os.link(_restore_path(target, info.linkname), path)
+            continue
+        elif 'digest' in member:
+            with gzip.open(_blob_path(store, member['digest']), 'rb') as blob:
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(blob, f, CHUNK_SIZE)
+        else:
+            log.warning("Not restoring special file %s" % info.name)
+            continue
+
+        os.chmod(path, info.mode)
+        os.utime(path, (info.mtime, info.mtime))
+
+    for path, info in reversed(directories):
+        os.chmod(path, info.mode)
+        os.utime(path, (info.mtime, info.mtime))
+
+
+def _collect_garbage(backup_dir, store):
+    used = set()
+    for date, path in _snapshots(backup_dir):
+        if path.endswith('.manifest.json.gz'):
+            for member in _read_manifest(path)['members']:
+                if 'digest' in member:
+                    used.add(member['digest'])
+
+    for root, dirs, files in os.walk(store):
+        for f in files:
+            if f not in used and not f.endswith('.part'):
+                os.unlink(os.path.join(root, f))
+
+
+def _container_volume_paths(name):
+    info = __salt__['mwdocker.inspect_container'](name)
+    if info is None:
+        raise Exception('Container %s does not exist' % name)
+
+    if info.get('Mounts'):
+        return sorted(m['Destination'] for m in info['Mounts'])
+    return sorted((info.get('Volumes') or {}).keys())
+
+
+def _directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
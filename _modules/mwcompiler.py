@@ -0,0 +1,460 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Compiles the `microservices` pillar into the states used by the
+`mwms.services` and `mwms.backup` SLS files.
+
+The containers that run each instance (see `microservice.instances`) are
+determined by the microservice module; this module only turns them into
+states, without changing anything on the host.
+"""
+
+BALANCE_METHODS = ('round_robin', 'least_conn', 'ip_hash', 'random')
+HAPROXY_BALANCE_METHODS = ('roundrobin', 'static-rr', 'leastconn', 'first', 'source', 'uri', 'random')
+HAPROXY_HTTP_REUSE = ('never', 'safe', 'aggressive', 'always')
+HAPROXY_TIMEOUTS = ('connect', 'server', 'queue', 'http-keep-alive', 'http-request', 'tunnel')
+
+
+def compiled_states(services=None):
+    """
+    Compiles the states of all (or some) services.
+
+    Each service is compiled from its own pillar subtree only, and at most once
+    per state run: the result is memoized in `__context__` (which Salt creates
+    for each state run), so that both SLS files share one compilation.
+
+    :param services: An optional list of service names to limit the result to
+    :return: A dictionary mapping each service name to a dictionary with the
+        keys `states` (the service's states), `backup` (the service's backup
+        states), `haproxy` (the service's HAProxy backends), `standbys` (the
+        states of the service's standby containers), `refill_standbys`
+        (`True` when standby containers are missing) and `images` (the list
+        of images used by the service)
+    """
+    service_definitions = __salt__['pillar.get']('microservices', {})
+    if services is None:
+        services = list(service_definitions.keys())
+
+    compiled = __context__.setdefault('mwcompiler.compiled_states', {})
+    missing = [name for name in services if name in service_definitions and name not in compiled]
+    if len(missing) > 0:
+        instances = __salt__['microservice.instances'](services=missing)
+        for service_name in missing:
+            compiled[service_name] = service_states(service_name, service_definitions[service_name],
+                                                    instances[service_name])
+
+    return dict((name, compiled[name]) for name in services if name in compiled)
+
+
+def service_states(service_name, service_config=None, instances=None):
+    """
+    Compiles the states of a single service, without memoizing them. This is
+    used by `microservice.redeploy` to switch traffic to a new set of
+    containers.
+
+    :param service_name: The service name
+    :param service_config: The service definition (defaults to the service's
+        pillar)
+    :param instances: The service's containers, as returned by
+        `microservice.instances` (defaults to the current containers)
+    :return: A dictionary with the keys `states`, `backup`, `haproxy`,
+        `standbys`, `refill_standbys` and `images` (see `compiled_states`)
+    """
+    if service_config is None:
+        service_config = __salt__['pillar.get']('microservices:%s' % service_name)
+    if instances is None:
+        instances = __salt__['microservice.instances'](services=[service_name])[service_name]
+    return _compile_service(service_name, service_config, _shared_inputs(), instances)
+
+
+def _shared_inputs():
+    if 'mwcompiler.shared_inputs' not in __context__:
+        __context__['mwcompiler.shared_inputs'] = {
+            'dns_ip': __salt__['grains.get']('ip4_interfaces:eth0')[0],
+            'consul_upstreams': __salt__['pillar.get']('nginx:consul_upstreams', False),
+            'load_balancer': __salt__['pillar.get']('mwms:load_balancer', 'nginx'),
+            'parallel': __salt__['pillar.get']('mwms:parallel', False),
+            'concurrency': int(__salt__['pillar.get']('mwms:concurrency', 4)),
+        }
+    return __context__['mwcompiler.shared_inputs']
+
+
+def _nginx_options(service_name, service_config):
+    upstream = dict(service_config.get('upstream', {}))
+    proxy = dict(service_config.get('proxy', {}))
+
+    balance = upstream.get('balance', 'round_robin')
+    if balance not in BALANCE_METHODS and not balance.startswith('hash '):
+        raise ValueError("Unsupported balancing method for service %s: %s" % (service_name, balance))
+
+    # Upstream keepalive connections only work with HTTP/1.1 and an empty
+    # "Connection" header.
+    if upstream.get('keepalive'):
+        proxy.setdefault('http_version', '1.1')
+        proxy['keepalive'] = True
+
+    return upstream, proxy
+
+
+def _haproxy_options(service_name, service_config):
+    options = service_config.get('haproxy', {})
+
+    balance = options.get('balance', 'roundrobin')
+    if balance.split(' ')[0] not in HAPROXY_BALANCE_METHODS:
+        raise ValueError("Unsupported balancing algorithm for service %s: %s" % (service_name, balance))
+
+    http_reuse = options.get('http_reuse')
+    if http_reuse is not None and http_reuse not in HAPROXY_HTTP_REUSE:
+        raise ValueError("Unsupported http-reuse mode for service %s: %s" % (service_name, http_reuse))
+
+    timeouts = dict(options.get('timeouts', {}))
+    for timeout in timeouts:
+        if timeout not in HAPROXY_TIMEOUTS:
+            raise ValueError("Unsupported backend timeout for service %s: %s" % (service_name, timeout))
+
+    # Re-using backend connections requires keep-alive connections; by
+    # default, each request still uses its own connection.
+    return {
+        "balance": balance,
+        "keepalive": bool(options.get('keepalive', http_reuse not in (None, 'never'))),
+        "http_reuse": http_reuse,
+        "maxconn": options.get('maxconn'),
+        "timeouts": timeouts,
+    }
+
+
+def _first_instance(service_name, instances, key):
+    """
+    Determines the container of the first instance of another container of the
+    same service (for links and `volumes_from`).
+    """
+    for container in instances:
+        if container["key"] == key and len(container["instances"]) > 0:
+            return container["instances"][0]["container"]
+    return "%s-%s-0" % (service_name, key)
+
+
+def _compile_service(service_name, service_config, shared, instances):
+    config = {}
+    backup = {}
+    images = set()
+    consul_service_ids = []
+    has_http = False
+    previous_container = None
+    servers = []
+    haproxy_backends = []
+    cpu_allocation = {}
+    standbys = {}
+    refill_standbys = False
+    use_nginx = shared['load_balancer'] == 'nginx'
+
+    upstream_file = "/etc/nginx/upstreams/service_%s.conf" % service_name
+    vhost_file = "/etc/nginx/sites-available/service_%s.conf" % service_name
+    vhost_link = "/etc/nginx/sites-enabled/service_%s.conf" % service_name
+    log_dir = "/var/log/services/%s" % service_name
+    check_path = service_config['check_url'] if 'check_url' in service_config else '/status'
+    check_interval = service_config.get('check_interval', '10s')
+    deregister_after = service_config.get('deregister_critical_service_after', '30m')
+
+    for container in instances:
+        key = container["key"]
+        container_config = service_config['containers'][key]
+        container_name = "%s-%s" % (service_name, key)
+        images.add(container_config['docker_image'])
+
+        volumes = []
+        volume_requirements = []
+        for dir, mount, mode in container_config.get('volumes', ()):
+            source_dir = "/var/lib/services/%s/%s" % (service_name, dir)
+            config[source_dir] = {
+                "file.directory": [
+                    {"mode": "0777"},
+                    {"makedirs": True}
+                ]
+            }
+            volumes.append("%s:%s:%s" % (source_dir, mount, mode))
+            volume_requirements.append({"file": source_dir})
+
+        links = {}
+        link_requirements = []
+        for linked_container, alias in sorted(container_config.get('links', {}).items()):
+            linked_container_name = _first_instance(service_name, instances, linked_container)
+            links[linked_container_name] = alias
+            link_requirements.append({"mwdocker": linked_container_name})
+
+        volumes_from = []
+        volumes_from_requirements = []
+        for volume_container in container_config.get('volumes_from', ()):
+            volume_container_name = _first_instance(service_name, instances, volume_container)
+            volumes_from.append(volume_container_name)
+            volumes_from_requirements.append({"mwdocker": volume_container_name})
+
+        is_http = 'http' in container_config and container_config['http']
+        has_http = has_http or is_http
+        container_port = container_config.get('http_internal_port', 80)
+
+        backend_servers = []
+        # Standby containers are started just like instances, but are not
+        # registered with Consul or added to the load balancer. They are
+        # managed by the mwms.standbys state, which is applied in the
+        # background (see the mwms.reactor.standbys reactor SLS).
+        slots = list(enumerate(container["instances"]))
+        slots += [(None, standby) for standby in container["standbys"]]
+        refill_standbys = refill_standbys or any(standby["missing"] for standby in container["standbys"])
+
+        for container_number, instance in slots:
+            container_instance_name = instance["container"]
+            standby = container_number is None
+
+            if standby:
+                requirements = [{"mwdocker": "microservice-standby-images"}]
+            else:
+                requirements = [
+                    {"service": "docker"},
+                    {"mwdocker": "microservice-images"}
+                ]
+
+            container_state = [
+                {"image": container_config['docker_image']},
+                {"stateful": container_config["stateful"]},
+                {"dns": [shared['dns_ip']]},
+                {"domain": "consul"},
+                {"labels": {
+                    "service": service_name,
+                    "service_group": "%s-%s" % (service_name, container_name)
+                }}
+            ]
+
+            if is_http:
+                host_port = instance["port"]
+                container_state.append({"tcp_ports": [{"address": "0.0.0.0", "port": container_port, "host_port": host_port}]})
+
+                check_url = "http://localhost:%d%s" % (host_port, check_path)
+                container_state.append({"check_url": check_url})
+
+            elif 'ports' in container_config:
+                container_state.append({"tcp_ports": container_config['ports']})
+
+            if is_http and not standby:
+                servers.append("localhost:%d" % host_port)
+                backend_servers.append({
+                    "name": "%s-%d" % (container_name, container_number),
+                    "address": "localhost:%d" % host_port
+                })
+                service_id = "%s-%d" % (service_name, container_number)
+
+                if use_nginx:
+                    container_state.append({"watch_in": [
+                        {"file": upstream_file},
+                        {"file": vhost_file},
+                        {"file": vhost_link}
+                    ]})
+
+                checks = list(service_config.get("checks", []))
+                checks.append({
+                    "name": "HTTP connectivity",
+                    "http": check_url,
+                    "interval": check_interval,
+                    "deregister_critical_service_after": deregister_after
+                })
+
+                consul_service_ids.append(service_id)
+                config["consul-service-%s" % service_id] = {
+                    "consul.service_registered": [
+                        {"name": service_name},
+                        {"service_id": service_id},
+                        {"port": host_port},
+                        {"checks": checks},
+                        {"require": [{"mwdocker": container_instance_name}]}
+                    ]
+                }
+
+                # Services used to be registered using configuration files
+                config["/etc/consul/service-%s.json" % service_id] = {
+                    "file.absent": [
+                        {"watch_in": [{"cmd": "consul-reload"}]}
+                    ]
+                }
+
+            # A running standby takes over an instance that does not have a
+            # container yet; its container state then only has to register it.
+            if not standby and instance["promoted"]:
+                promotion = "microservice-promote-%s-%d" % (container_name, container_number)
+                config[promotion] = {
+                    "microservice.standby_promoted": [
+                        {"service": service_name},
+                        {"key": key},
+                        {"instance": container_number},
+                        {"container": container_instance_name},
+                        {"port": instance["port"]}
+                    ]
+                }
+                requirements.append({"microservice": promotion})
+
+            # Standbys are only created when the service's containers exist
+            if not standby:
+                requirements += link_requirements
+            if len(links) > 0:
+                container_state.append({"links": links})
+
+            if not standby:
+                requirements += volumes_from_requirements
+            if len(volumes_from) > 0:
+                container_state.append({"volumes_from": volumes_from})
+
+            for p in ("environment", "restart", "user", "command"):
+                if p in container_config:
+                    container_state.append({p: container_config[p]})
+
+            if instance["resources"] is not None:
+                container_state.append({"resources": instance["resources"]})
+
+            # The CPUs assigned to an instance are recorded before its
+            # container is created.
+            if instance["pinning"] is not None:
+                cpu_allocation.setdefault(key, {})[str(container_number)] = instance["pinning"]
+                requirements.append({"microservice": "microservice-cpus-%s" % service_name})
+
+            if len(volumes) > 0:
+                if not standby:
+                    requirements += volume_requirements
+                container_state.append({"volumes": volumes})
+
+            # In parallel mode, the containers of different services are
+            # started concurrently, while the containers of one service are
+            # still started one after another (in dependency order).
+            if shared['parallel'] and not standby:
+                container_state.append({"parallel": True})
+                container_state.append({"concurrency": shared['concurrency']})
+                if previous_container is not None and {"mwdocker": previous_container} not in requirements:
+                    requirements.append({"mwdocker": previous_container})
+                previous_container = container_instance_name
+
+            container_state.append({"require": requirements})
+
+            (standbys if standby else config)[container_instance_name] = {
+                "mwdocker.running": container_state
+            }
+
+        if is_http:
+            backend = {
+                "name": "%s_%s" % (service_name, key),
+                "hostnames": [service_config["hostname"], "%s.service.consul" % service_name],
+                "servers": backend_servers
+            }
+            backend.update(_haproxy_options(service_name, service_config))
+            haproxy_backends.append(backend)
+
+        if "backup" in container_config:
+            backup_dir = "/var/backups/service/%s/%s" % (service_name, key)
+            backup[backup_dir] = {
+                "file.directory": [
+                    {"makedirs": True}
+                ]
+            }
+
+            # Backups used to be run by one cron job per container; these are
+            # now all run by the mwbackup module.
+            backup["backup-%s" % container_name] = {
+                "cron.absent": [
+                    {"identifier": "backup-%s" % container_name},
+                    {"user": "root"}
+                ]
+            }
+
+    if len(cpu_allocation) > 0:
+        config["microservice-cpus-%s" % service_name] = {
+            "microservice.cpus_allocated": [
+                {"service": service_name},
+                {"allocation": cpu_allocation}
+            ]
+        }
+
+    if "hostname" in service_config:
+        config[service_config["hostname"]] = {
+            "host.present": [
+                {"ip": "127.0.0.1"}
+            ]
+        }
+
+    config["/etc/consul/service-%s.json" % service_name] = {
+        "file.absent": [
+            {"watch_in": [{"cmd": "consul-reload"}]}
+        ]
+    }
+
+    config["consul-service-%s-obsolete" % service_name] = {
+        "consul.service_deregistered": [
+            {"name": service_name},
+            {"keep": consul_service_ids}
+        ]
+    }
+
+    if has_http and use_nginx:
+        config[log_dir] = {
+            "file.directory": [
+                {"makedirs": True},
+                {"user": "www-data"},
+                {"group": "www-data"}
+            ]
+        }
+
+        # When the consul_upstreams engine is used, the upstream servers
+        # are maintained from the Consul health state by that engine, and
+        # are only initialized here.
+        upstream_options, proxy_options = _nginx_options(service_name, service_config)
+        config[upstream_file] = {
+            "file.managed": [
+                {"source": "salt://mwms/nginx/files/upstream.j2"},
+                {"template": "jinja"},
+                {"makedirs": True},
+                {"replace": not shared['consul_upstreams']},
+                {"context": {
+                    "service_name": service_name,
+                    "service_config": service_config,
+                    "upstream": upstream_options,
+                    "servers": servers
+                }},
+                {"watch_in": [{"service": "nginx"}]}
+            ]
+        }
+
+        config[vhost_file] = {
+            "file.managed": [
+                {"source": "salt://mwms/nginx/files/vhost.j2"},
+                {"template": "jinja"},
+                {"context": {
+                    "service_name": service_name,
+                    "service_config": service_config,
+                    "proxy": proxy_options
+                }},
+                {"require": [
+                    {"file": log_dir},
+                    {"file": upstream_file}
+                ]},
+                {"watch_in": [{"service": "nginx"}]}
+            ]
+        }
+
+        config[vhost_link] = {
+            "file.symlink": [
+                {"target": vhost_file},
+                {"require": [
+                    {"file": vhost_file}
+                ]},
+                {"watch_in": [{"service": "nginx"}]}
+            ]
+        }
+
+    return {
+        "states": config,
+        "backup": backup,
+        "haproxy": haproxy_backends,
+        "standbys": standbys,
+        "refill_standbys": refill_standbys,
+        "images": sorted(images)
+    }
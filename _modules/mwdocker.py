@@ -9,17 +9,245 @@ try:
     import docker
     import docker.utils
     import docker.errors
+    import requests
 except ImportError:
     def __virtual__():
         return False, ["The docker-py package is not installed"]
 
+try:
+    from docker.transport.unixconn import UnixAdapter, UnixHTTPConnectionPool
+except ImportError:
+    UnixAdapter = None
+
+import hashlib
 import json
 import logging
+import os
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 
 log = logging.getLogger(__name__)
 
+__shared_client = None
+__shared_client_pid = None
+__shared_client_lock = threading.Lock()
+__api_calls_lock = threading.Lock()
+__image_index_lock = threading.RLock()
+__container_snapshot_lock = threading.RLock()
+__spec_hash_label = 'mwms.spec-hash'
+__manifest_media_types = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+)
+
+# Maps the supported resource limits (as named by `create_host_config`) to the
+# respective fields of the HostConfig reported by `inspect_container`.
+RESOURCE_LIMITS = {
+    'mem_limit': 'Memory',
+    'memswap_limit': 'MemorySwap',
+    'mem_reservation': 'MemoryReservation',
+    'cpu_shares': 'CpuShares',
+    'cpu_period': 'CpuPeriod',
+    'cpu_quota': 'CpuQuota',
+    'cpuset_cpus': 'CpusetCpus',
+    'cpuset_mems': 'CpusetMems',
+    'shm_size': 'ShmSize',
+    'ulimits': 'Ulimits',
+}
+# Resource limits that are changed on existing containers (see
+# `update_resources`) instead of re-creating them.
+UPDATABLE_LIMITS = ('cpuset_cpus', 'cpuset_mems')
+# Resource limits that are set in the HostConfig directly: docker-py's
+# `create_host_config` has no argument for `cpuset_mems` and names the
+# `cpuset_cpus` field "CpuSetCpus".
+__raw_host_config_limits = ('cpuset_cpus', 'cpuset_mems')
+__memory_limits = ('mem_limit', 'memswap_limit', 'mem_reservation', 'shm_size')
+__byte_units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def _client():
+    """
+    Returns the Docker API client shared by all functions of this module.
+
+    The client is created lazily on first use and is then re-used for the
+    remainder of the process, so that all API calls share the same keep-alive
+    connections to the Docker socket. The socket URL, the number of
+    connections that are kept alive and the timeout can be configured using
+    the `mwdocker.base_url`, `mwdocker.pool_size` and `mwdocker.timeout`
+    minion options.
+
+    Forked processes (like the ones in which Salt applies parallel states)
+    get a client of their own: a connection inherited from the parent process
+    would be shared with it, so that each process could read the other's
+    responses.
+
+    :return: A `docker.Client` instance
+    """
+    global __shared_client, __shared_client_pid
+
+    # Records the process of the current run (see `_forked`)
+    _forked()
+
+    with __shared_client_lock:
+        if __shared_client is None or __shared_client_pid != os.getpid():
+            base_url = __salt__['config.get']('mwdocker.base_url', 'unix://var/run/docker.sock')
+            pool_size = int(__salt__['config.get']('mwdocker.pool_size', 10))
+            timeout = int(__salt__['config.get']('mwdocker.timeout', 60))
+
+            client = docker.Client(base_url=base_url, timeout=timeout)
+            if UnixAdapter is not None and isinstance(getattr(client, '_custom_adapter', None), UnixAdapter):
+                client._custom_adapter = _PooledUnixAdapter(client._custom_adapter.socket_path, timeout, pool_size)
+                client.mount('http+docker://', client._custom_adapter)
+
+            client.hooks['response'].append(_count_api_call)
+            __shared_client = client
+            __shared_client_pid = os.getpid()
+
+    return __shared_client
+
+
+if UnixAdapter is not None:
+    class _PooledUnixAdapter(UnixAdapter):
+        """
+        Transport adapter for the Docker socket that sends all API calls
+        through a single connection pool, which keeps up to `pool_maxsize`
+        connections alive. docker-py's own adapter creates a connection pool
+        for each request URL (and keeps only `num_pools` of them), so that,
+        for example, inspecting each container opens a new connection.
+        """
+        def __init__(self, socket_path, timeout, pool_maxsize):
+            super(_PooledUnixAdapter, self).__init__('http+unix://' + socket_path, timeout)
+            self.pool_maxsize = pool_maxsize
+
+        def get_connection(self, url, proxies=None):
+            with self.pools.lock:
+                pool = self.pools.get(self.socket_path)
+                if pool:
+                    return pool
+
+                pool = UnixHTTPConnectionPool(url, self.socket_path, self.timeout, maxsize=self.pool_maxsize)
+                self.pools[self.socket_path] = pool
+
+            return pool
+
+
+def _count_api_call(response, *args, **kwargs):
+    method = response.request.method
+    with __api_calls_lock:
+        calls = __context__.setdefault('mwdocker.api_calls', {'total': 0})
+        calls['total'] += 1
+        calls[method] = calls.get(method, 0) + 1
+
+
+def api_calls(reset=False):
+    """
+    Returns the number of Docker API round-trips that have been made by this
+    module in the current run (for example, the current `state.highstate` or
+    `salt-call` run), grouped by HTTP method. The counters are kept in the
+    run's context, so each run starts counting at zero.
+
+    :param reset: Set to `True` to reset the counters after reading them
+    :return: A dictionary with the total number of API calls and the number of
+        calls per HTTP method
+    """
+    with __api_calls_lock:
+        calls = dict(__context__.get('mwdocker.api_calls', {'total': 0}))
+        if reset:
+            __context__.pop('mwdocker.api_calls', None)
+    return calls
+
+
+def inspect_container(name):
+    """
+    Inspects a Docker container. All containers that carry a `service` label
+    are inspected in one batch when this function is first called in a run;
+    subsequent calls in the same run are answered from that snapshot, which is
+    kept in the run's context. Containers that are created, started or deleted
+    using this module are refreshed in the snapshot. Processes that are forked
+    during a run (like the ones in which Salt applies parallel states) only
+    inspect the containers they look up.
+
+    :param name: The container name
+    :return: The container's inspection data, or `None` if no such container
+        exists
+    """
+    with __container_snapshot_lock:
+        snapshot = _container_snapshot()
+        if name in snapshot:
+            return snapshot[name]
+
+    # Containers without a `service` label are not part of the snapshot.
+    info = _inspect_container(name)
+    _update_container_snapshot(name, info)
+    return info
+
+
+def refresh_containers():
+    """
+    Discards the container snapshot used by `inspect_container`. The snapshot
+    will be rebuilt from the Docker API on the next lookup. Use this when
+    containers were changed without using this module.
+    """
+    with __container_snapshot_lock:
+        __context__.pop('mwdocker.containers', None)
+        __context__.pop('mwdocker.containers_pid', None)
+
+
+def _inspect_container(name):
+    try:
+        return _client().inspect_container(name)
+    except docker.errors.NotFound:
+        return None
+
+
+def _container_snapshot():
+    with __container_snapshot_lock:
+        if __context__.get('mwdocker.containers_pid') != os.getpid():
+            if _forked():
+                # Each process that Salt forks for a parallel state handles a
+                # single container; listing and inspecting all containers in
+                # each of them would take O(n^2) API calls per run. The
+                # snapshot inherited from the parent process is not used, as
+                # the other processes may have changed containers since.
+                # Containers are added to the snapshot as they are inspected.
+                snapshot = {}
+            else:
+                containers = _client().containers(all=True, filters={'label': 'service'})
+                names = [c['Names'][0].lstrip('/') for c in containers if c.get('Names')]
+
+                workers = int(__salt__['config.get']('mwdocker.pool_size', 10))
+                pool = ThreadPool(max(1, min(workers, len(names))))
+                try:
+                    infos = pool.map(_inspect_container, names)
+                finally:
+                    pool.close()
+                    pool.join()
+
+                snapshot = dict(zip(names, infos))
+
+            __context__['mwdocker.containers'] = snapshot
+            __context__['mwdocker.containers_pid'] = os.getpid()
+        return __context__['mwdocker.containers']
+
+
+def _update_container_snapshot(name, info):
+    with __container_snapshot_lock:
+        if __context__.get('mwdocker.containers_pid') == os.getpid():
+            __context__['mwdocker.containers'][name] = info
+
+
+def _forked():
+    """
+    Checks if this process was forked during the current run (like the
+    processes in which Salt applies parallel states). The process of a run is
+    recorded by the run's first Docker API call.
+    """
+    return __context__.setdefault('mwdocker.pid', os.getpid()) != os.getpid()
+
 
 def container_ip(name):
     """
@@ -28,8 +256,7 @@ def container_ip(name):
     :param name: The container name
     :return: The container's internal IP address
     """
-    client = docker.Client(base_url='unix://var/run/docker.sock')
-    info = client.inspect_container(name)
+    info = _client().inspect_container(name)
     return info['NetworkSettings']['IPAddress']
 
 
@@ -41,34 +268,130 @@ def container_published_port(name, container_port):
     :param int: The internal container port
     :return: The host port that the container port is mapped on
     """
-    client = docker.Client(base_url='unix://var/run/docker.sock')
-    info = client.inspect_container(name)
+    info = _client().inspect_container(name)
     return info['NetworkSettings']['Ports'][container_port]['HostPort']
 
 
-def start_container(name, warmup_wait=60):
+def start_container(name, warmup_wait=60, check_url=None, min_running=None):
     """
-    Starts a Docker container. This function will wait for a defined amount of
-    time to check if the container actually stays up after being started. If the
-    container status is not "up" after the `warmup_wait` has expired, this
-    function will raise an exception.
+    Starts a Docker container and waits for it to become ready. If a
+    `check_url` is given, the container is ready as soon as that URL responds
+    with a non-error HTTP status. Otherwise, if the container's image defines a
+    health check, the container is ready as soon as Docker reports it as
+    healthy; containers without either are ready after they have been running
+    for `min_running` seconds. The container status is polled with
+    exponentially increasing intervals. If the container is restarted, stops or
+    becomes unhealthy in the meantime, or if it is not ready after
+    `warmup_wait` seconds, this function will raise an exception.
 
     :param name: The container name
-    :param int: How long this function should wait to check the container status
+    :param int warmup_wait: How long this function should wait at most for the
+        container to become ready
+    :param str check_url: An optional HTTP URL that must respond successfully
+        for the container to be considered ready
+    :param min_running: How long (in seconds) a container without `check_url`
+        and health check must stay running to be considered ready. Defaults to
+        the `mwdocker.min_running` minion option (or 10, if that is not set),
+        but never exceeds `warmup_wait`
+    :return: The number of seconds it took for the container to become ready
     """
+    if min_running is None:
+        min_running = float(__salt__['config.get']('mwdocker.min_running', 10))
+
     log.info("Starting container %s" % name)
-    client = docker.Client(base_url='unix://var/run/docker.sock')
+    client = _client()
+    start_called = time.time()
     client.start(name)
+    start_duration = time.time() - start_called
+
+    # We need to wait for the application to actually come up to prevent race
+    # conditions on application startup (for example, Flow applications that
+    # do a doctrine:migrate on startup).
+    log.info("Waiting up to %d seconds for container to start" % warmup_wait)
+    started = time.time()
+    deadline = started + warmup_wait
+    running_until = started + min(min_running, warmup_wait)
+    interval = 0.5
+    initial_status = None
+    container_status = None
+
+    try:
+        while True:
+            container_status = client.inspect_container(name)
+            state = container_status["State"]
+
+            if initial_status is None:
+                initial_status = container_status
 
-    # We need to sleep to prevent race conditions on application startup.
-    # For example, Flow applications that do a doctrine:migrate on startup.
-    log.info("Waiting %d seconds for container to start" % warmup_wait)
-    time.sleep(warmup_wait)
+            restarted = state["StartedAt"] != initial_status["State"]["StartedAt"] or \
+                container_status.get("RestartCount", 0) != initial_status.get("RestartCount", 0)
 
-    container_status = client.inspect_container(name)
-    if not container_status["State"]["Running"] or container_status["State"]["Restarting"]:
-        raise Exception('Container %s is not running after %d seconds. Status is: %s' % (
-            name, warmup_wait, container_status["State"]))
+            if state["Restarting"] or restarted or not state["Running"]:
+                raise Exception('Container %s did not stay up after being started. Status is: %s' % (name, state))
+
+            wake_at = None
+            if check_url is not None:
+                if _check_http(check_url, timeout=max(1, min(5, deadline - time.time()))):
+                    break
+            elif _has_healthcheck(container_status):
+                health = (state.get("Health") or {}).get("Status")
+                if health == "healthy":
+                    break
+                if health == "unhealthy":
+                    raise Exception('Container %s is unhealthy after being started. Status is: %s' % (name, state))
+            elif time.time() >= running_until:
+                break
+            else:
+                wake_at = running_until
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception('Container %s is not ready after %d seconds. Status is: %s' % (
+                    name, warmup_wait, state))
+
+            delay = min(interval, remaining)
+            if wake_at is not None:
+                delay = min(delay, max(0, wake_at - time.time()))
+            time.sleep(delay)
+            interval = min(interval * 2, 8)
+    finally:
+        if container_status is not None:
+            _update_container_snapshot(name, container_status)
+
+    waited = time.time() - started
+    log.info("Container %s is ready after %.1f seconds" % (name, waited))
+
+    service_name = (container_status["Config"].get("Labels") or {}).get("service", "")
+    observe_metric('container_start_duration_seconds', start_duration, service_name)
+    observe_metric('container_warmup_seconds', waited, service_name)
+    return waited
+
+
+def observe_metric(metric, value, service=None):
+    """
+    Records a deployment metric using the `mwmetrics` module. Metrics are
+    informational only, so errors are logged instead of raised.
+
+    :param metric: The metric name (see `mwmetrics.observe`)
+    :param value: The observed value
+    :param service: The name of the service the observation belongs to
+    """
+    try:
+        __salt__['mwmetrics.observe'](metric, value, service=service or '')
+    except Exception as e:
+        log.warning("Could not record metric %s: %s" % (metric, e))
+
+
+def _has_healthcheck(container_status):
+    test = ((container_status.get("Config") or {}).get("Healthcheck") or {}).get("Test") or []
+    return len(test) > 0 and test[0] != "NONE"
+
+
+def _check_http(url, timeout=5):
+    try:
+        return requests.get(url, timeout=timeout).status_code < 400
+    except requests.RequestException:
+        return False
 
 
 def image_id(image):
@@ -78,16 +401,65 @@ def image_id(image):
     :param image: The image name
     :return: The image ID
     """
-    if ':' not in image:
-        image += ":latest"
+    image = _with_tag(image)
+
+    return _image_index().get(image)
+
+
+def remove_image(image, force=False):
+    """
+    Removes (or untags) an image and updates the image index accordingly.
 
-    client = docker.Client(base_url='unix://var/run/docker.sock')
-    images = client.images()
+    :param image: The image name or ID
+    :param force: Set to `True` to force the removal
+    """
+    if image not in _image_index().values():
+        image = _with_tag(image)
+
+    log.info("Removing image %s" % image)
+    _client().remove_image(image, force=force)
+
+    with __image_index_lock:
+        index = _image_index()
+        for tag, existing_id in list(index.items()):
+            if tag == image or existing_id == image:
+                del index[tag]
+
+
+def invalidate_image_index():
+    """
+    Discards the in-memory image index. The index will be rebuilt from the
+    Docker API on the next lookup. Use this when images were pulled or removed
+    without using this module.
+    """
+    with __image_index_lock:
+        __context__.pop('mwdocker.images', None)
 
-    for existing_image in images:
-        if image in existing_image['RepoTags']:
-            return existing_image['Id']
-    return None
+
+def _image_index():
+    """
+    Returns a dictionary mapping image tags (in the format "<repository>:<tag>")
+    to image IDs. The index is built from a single image listing the first
+    time it is needed in a run (it is kept in the run's context) and kept up
+    to date by the functions of this module that pull or remove images.
+    """
+    with __image_index_lock:
+        if 'mwdocker.images' not in __context__:
+            index = {}
+            for existing_image in _client().images():
+                for tag in existing_image['RepoTags'] or ():
+                    index[tag] = existing_image['Id']
+            __context__['mwdocker.images'] = index
+        return __context__['mwdocker.images']
+
+
+def _update_image_index(image):
+    info = _client().inspect_image(image)
+    with __image_index_lock:
+        index = _image_index()
+        index[image] = info['Id']
+        for tag in info.get('RepoTags') or ():
+            index[tag] = info['Id']
 
 
 def delete_container(name, timeout=10, with_volumes=False):
@@ -99,20 +471,23 @@ def delete_container(name, timeout=10, with_volumes=False):
     :param bool with_volumes: TRUE to also delete volumes
     """
     log.info("Deleting container %s" % name)
-    client = docker.Client(base_url='unix://var/run/docker.sock')
+    client = _client()
 
     try:
         client.inspect_container(name)
     except docker.errors.NotFound:
         log.info("Container %s was not present in the first place." % name)
+        _update_container_snapshot(name, None)
         return
 
     client.stop(name, timeout=timeout)
     client.remove_container(name, v=with_volumes)
+    _update_container_snapshot(name, None)
 
 
 def create_container(name, image, command=None, environment=None, volumes=(), udp_ports=None, tcp_ports=None,
-                     restart=True, dns=None, domain=None, volumes_from=None, links=None, user=None, labels=None, test=False):
+                     restart=True, dns=None, domain=None, volumes_from=None, links=None, user=None, labels=None,
+                     resources=None, test=False):
     """
     Creates a new container.
 
@@ -134,11 +509,22 @@ def create_container(name, image, command=None, environment=None, volumes=(), ud
     :param links: A dictionary of containers to link (using the container name
         as index and the alias as value)
     :param user: The user under which to start the container
-    :param dict labels: A dictionary of labels to attach to this container
+    :param dict labels: A dictionary of labels to attach to this container.
+        Labels starting with `mwms.` are reserved; this function records a
+        hash of the container specification (see `spec_hash`) in the
+        `mwms.spec-hash` label.
+    :param dict resources: Resource limits of the container (see
+        `resource_host_config`); only the given limits are set
     :param test: Set to `True` to not actually do anything
     """
 
-    client = docker.Client(base_url='unix://var/run/docker.sock')
+    client = _client()
+
+    labels = dict(labels or {})
+    labels[__spec_hash_label] = spec_hash(image, command=command, environment=environment, volumes=volumes,
+                                          udp_ports=udp_ports, tcp_ports=tcp_ports, restart=restart, dns=dns,
+                                          domain=domain, volumes_from=volumes_from, links=links, user=user,
+                                          labels=labels, resources=resources)
 
     pull_image(image, force=False, test=test)
 
@@ -152,6 +538,10 @@ def create_container(name, image, command=None, environment=None, volumes=(), ud
             "Name": "always"
         }
 
+    limits = resource_host_config(resources)
+    resource_arguments = dict((key, limits[field]) for key, field in RESOURCE_LIMITS.items()
+                              if field in limits and key not in __raw_host_config_limits)
+
     host_config = docker.utils.create_host_config(
         binds=hostconfig_binds,
         port_bindings=hostconfig_ports,
@@ -159,9 +549,14 @@ def create_container(name, image, command=None, environment=None, volumes=(), ud
         dns=dns,
         dns_search=[domain],
         volumes_from=volumes_from,
-        links=links
+        links=links,
+        **resource_arguments
     )
 
+    for key in __raw_host_config_limits:
+        if RESOURCE_LIMITS[key] in limits:
+            host_config[RESOURCE_LIMITS[key]] = limits[RESOURCE_LIMITS[key]]
+
     if test:
         log.info("Would create container %s" % name)
         return None
@@ -178,42 +573,424 @@ def create_container(name, image, command=None, environment=None, volumes=(), ud
         user=user,
         labels=labels
     )
+    _update_container_snapshot(name, _inspect_container(name))
     return container['Id']
 
 
-def pull_image(image, force=False, test=False):
+def spec_hash(image, command=None, environment=None, volumes=(), udp_ports=None, tcp_ports=None, restart=True,
+              dns=None, domain=None, volumes_from=None, links=None, user=None, labels=None, resources=None):
+    """
+    Computes a hash of a container specification. The parameters are the same
+    as for `create_container`, which records this hash as a container label.
+    Two specifications that result in the same container configuration have
+    the same hash, regardless of (for example) the order of environment
+    variables or whether empty values are given as `None` or as empty list.
+
+    :return: The specification hash as hex string
+    """
+    image = _with_tag(image)
+
+    def normalize_ports(port_definitions):
+        return sorted(
+            (p['address'], int(p['port']), int(p['host_port'] if 'host_port' in p else p['port']))
+            for p in port_definitions or ()
+        )
+
+    if type(command) is list:
+        command = " ".join(command)
+
+    spec = {
+        'image': image,
+        'command': command,
+        'environment': sorted(("%s=%s" % (k, v)) for k, v in (environment or {}).items()),
+        'volumes': sorted(volumes or ()),
+        'udp_ports': normalize_ports(udp_ports),
+        'tcp_ports': normalize_ports(tcp_ports),
+        'restart': bool(restart),
+        'dns': list(dns or ()),
+        'domain': domain,
+        'volumes_from': list(volumes_from or ()),
+        'links': sorted((links or {}).items()),
+        'user': user,
+        'labels': sorted((k, v) for k, v in (labels or {}).items() if not k.startswith('mwms.')),
+    }
+
+    # Adding resource limits must not change the hash of existing containers
+    # without limits. Limits that can be updated in place are not part of the
+    # hash.
+    resources = dict((k, v) for k, v in (resources or {}).items() if k not in UPDATABLE_LIMITS)
+    if resources:
+        spec['resources'] = sorted(resource_host_config(resources).items())
+
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def resource_host_config(resources):
+    """
+    Converts resource limits into the fields of a container's HostConfig, as
+    reported by `inspect_container`.
+
+    :param dict resources: The resource limits. Supported keys are `mem_limit`,
+        `memswap_limit`, `mem_reservation` and `shm_size` (in bytes or with a
+        unit suffix like "512m"), `cpu_shares`, `cpu_period` and `cpu_quota`
+        (integers), `cpuset_cpus` and `cpuset_mems` (like "0-3" or "0,2") and
+        `ulimits` (a dictionary mapping each limit name to a number or to a
+        dictionary with the keys `soft` and `hard`)
+    :return: A dictionary mapping HostConfig fields to their values
+    """
+    host_config = {}
+    for key, value in (resources or {}).items():
+        if key not in RESOURCE_LIMITS:
+            raise ValueError("Unsupported resource limit: %s" % key)
+
+        if key in __memory_limits:
+            value = _parse_bytes(value)
+        elif key in ('cpuset_cpus', 'cpuset_mems'):
+            value = str(value)
+        elif key == 'ulimits':
+            value = _ulimit_definitions(value)
+        else:
+            value = int(value)
+        host_config[RESOURCE_LIMITS[key]] = value
+
+    return host_config
+
+
+def update_resources(name, resources, test=False):
+    """
+    Changes the resource limits of an existing container that can be changed
+    without re-creating it (`cpuset_cpus` and `cpuset_mems`), for example when
+    a standby container is promoted to an instance with dedicated CPUs.
+
+    :param name: The container name
+    :param dict resources: The container's resource limits (see
+        `resource_host_config`); other limits are ignored
+    :param test: Set to `True` to only report the changes
+    :return: A dictionary mapping the changed HostConfig fields to their old
+        and new values
+    """
+    info = inspect_container(name)
+    if info is None:
+        raise Exception("Container %s does not exist" % name)
+
+    updatable = dict((k, v) for k, v in (resources or {}).items() if k in UPDATABLE_LIMITS)
+    limits = resource_host_config(updatable)
+
+    changes = {}
+    arguments = {}
+    for key in UPDATABLE_LIMITS:
+        field = RESOURCE_LIMITS[key]
+        current = info['HostConfig'].get(field) or ''
+        new = limits.get(field, '')
+        if current != new:
+            changes[field] = {'old': current, 'new': new}
+            arguments[key] = new
+
+    if len(changes) > 0 and not test:
+        log.info("Updating resources of container %s: %s" % (name, changes))
+        _client().update_container(name, **arguments)
+        _update_container_snapshot(name, _inspect_container(name))
+
+    return changes
+
+
+def container_spec_hash(name):
+    """
+    Gets the specification hash that was recorded for a container when it was
+    created (see `spec_hash`).
+
+    :param name: The container name
+    :return: The specification hash, or `None` if the container does not exist
+        or was not created by this module
+    """
+    info = inspect_container(name)
+    if info is None:
+        return None
+    return (info['Config'].get('Labels') or {}).get(__spec_hash_label)
+
+
+def pull_image(image, force=False, test=False, service=None):
     """
     Pulls the current version of an image.
 
     :param image: The image name. If no tag is specified, the `latest` tag is assumed
     :param force: Set to `True` to pull even when a local image of the same name exists
     :param test: Set to `True` to not actually do anything
+    :param service: The name of the service that uses the image (used for metrics)
     """
-    client = docker.Client(base_url='unix://var/run/docker.sock')
-
-    if ':' not in image:
-        image += ":latest"
+    image = _with_tag(image)
 
-    images = client.images()
+    present = image in _image_index()
 
-    present = False
-    for existing_image in images:
-        if image in existing_image['RepoTags']:
-            present = True
-
-    repository, tag = image.split(':')
+    repository, tag = image.rsplit(':', 1)
 
     if not present or force:
         if test:
             log.info("Would pull image %s:%s" % (repository, tag))
         else:
-            # noinspection PyUnresolvedReferences
-            log.info("Pulling image %s:%s" % (repository, tag))
-            pull_stream = client.pull(repository, tag, stream=True)
-            for line in pull_stream:
-                j = json.loads(line)
-                if 'error' in j:
-                    raise Exception("Could not pull image %s:%s: %s" % (repository, tag, j['errorDetail']))
+            _pull(repository, tag, service)
+
+
+def pull_images(images, force=False, workers=None, test=False, services=None):
+    """
+    Pulls a set of images concurrently. Each image is pulled only once, even
+    when it is listed several times.
+
+    :param images: A list of image names. If no tag is specified, the `latest`
+        tag is assumed
+    :param force: Set to `True` to pull even when a local image of the same name exists
+    :param workers: The maximum number of concurrent pulls. Defaults to the
+        `mwdocker.pull_workers` minion option (or 4, if that is not set)
+    :param test: Set to `True` to not actually do anything
+    :param services: An optional dictionary mapping image names to the names
+        of the services using them (used for metrics)
+    :return: The list of images that were (or, in test mode, would have been)
+        pulled
+    """
+    if services is None:
+        services = {}
+
+    if workers is None:
+        workers = int(__salt__['config.get']('mwdocker.pull_workers', 4))
+
+    unique_images = set()
+    image_services = {}
+    for image in images:
+        service = services.get(image)
+        image = _with_tag(image)
+        unique_images.add(image)
+        image_services[image] = service
+
+    index = _image_index()
+    to_pull = sorted(i for i in unique_images if force or i not in index)
+
+    if test or len(to_pull) == 0:
+        for image in to_pull:
+            log.info("Would pull image %s" % image)
+        return to_pull
+
+    def pull(image):
+        repository, tag = image.rsplit(':', 1)
+        try:
+            _pull(repository, tag, image_services[image])
+        except Exception as e:
+            return image, e
+        return image, None
+
+    pool = ThreadPool(max(1, min(workers, len(to_pull))))
+    try:
+        results = pool.map(pull, to_pull)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = ["%s (%s)" % (image, e) for image, e in results if e is not None]
+    if len(errors) > 0:
+        raise Exception("Could not pull images: %s" % ", ".join(errors))
+
+    return to_pull
+
+
+def image_digests(image):
+    """
+    Gets the registry digests of a local image.
+
+    :param image: The image name. If no tag is specified, the `latest` tag is assumed
+    :return: A list of digests (like "sha256:..."), or `None` if the image is not present
+    """
+    image = _with_tag(image)
+
+    try:
+        info = _client().inspect_image(image)
+    except docker.errors.NotFound:
+        return None
+
+    return [d.split('@', 1)[1] for d in info.get('RepoDigests') or () if '@' in d]
+
+
+def remote_digest(image):
+    """
+    Gets the digest of an image's manifest from the image's registry without
+    pulling the image. Registries that are listed in the
+    `mwdocker.insecure_registries` minion option are accessed using plain HTTP.
+
+    :param image: The image name. If no tag is specified, the `latest` tag is assumed
+    :return: The manifest digest (like "sha256:..."), or `None` if the digest
+        could not be determined
+    """
+    registry, repository, tag = _parse_image_name(image)
+    insecure = __salt__['config.get']('mwdocker.insecure_registries', [])
+    scheme = 'http' if registry in insecure else 'https'
+    url = '%s://%s/v2/%s/manifests/%s' % (scheme, registry, repository, tag)
+    headers = {'Accept': ', '.join(__manifest_media_types)}
+
+    try:
+        r = requests.head(url, headers=headers, timeout=10)
+        if r.status_code == 401:
+            token = _registry_token(r.headers.get('WWW-Authenticate', ''))
+            if token is None:
+                return None
+            headers['Authorization'] = 'Bearer %s' % token
+            r = requests.head(url, headers=headers, timeout=10)
+    except requests.RequestException as e:
+        log.warning("Could not determine remote digest of image %s: %s" % (image, e))
+        return None
+
+    if r.status_code != 200:
+        log.warning("Could not determine remote digest of image %s: status %d" % (image, r.status_code))
+        return None
+    return r.headers.get('Docker-Content-Digest')
+
+
+def image_up_to_date(image):
+    """
+    Checks if the local copy of an image matches the image in its registry by
+    comparing the remote manifest digest with the local image's digests.
+
+    :param image: The image name. If no tag is specified, the `latest` tag is assumed
+    :return: `True` if the local image is known to be current, `False` otherwise
+    """
+    local_digests = image_digests(image)
+    if not local_digests:
+        return False
+
+    digest = remote_digest(image)
+    return digest is not None and digest in local_digests
+
+
+def _parse_image_name(image):
+    registry = 'registry-1.docker.io'
+    name = image
+
+    first, _, rest = image.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, name = first, rest
+
+    if ':' in name:
+        name, tag = name.rsplit(':', 1)
+    else:
+        tag = 'latest'
+
+    if registry == 'registry-1.docker.io' and '/' not in name:
+        name = 'library/' + name
+
+    return registry, name, tag
+
+
+def _registry_token(challenge):
+    if not challenge.startswith('Bearer '):
+        return None
+
+    params = {}
+    for part in challenge[len('Bearer '):].split(','):
+        k, _, v = part.strip().partition('=')
+        params[k] = v.strip('"')
+
+    if 'realm' not in params:
+        return None
+
+    realm = params.pop('realm')
+    r = requests.get(realm, params=params, timeout=10)
+    if r.status_code != 200:
+        return None
+
+    j = r.json()
+    return j.get('token') or j.get('access_token')
+
+
+def _with_tag(image, tag='latest'):
+    # Only the last path component can contain a tag; a colon before it
+    # separates a registry's host name and port.
+    if ':' in image.rsplit('/', 1)[-1]:
+        return image
+    return "%s:%s" % (image, tag)
+
+
+def _mirror_repository(repository):
+    """
+    Determines the repository name of an image on the mirror of its registry,
+    as configured by the `mwdocker.registry_mirrors` minion option, which maps
+    registry names (use `docker.io` for the Docker Hub) to mirrors.
+
+    :return: The repository name on the mirror, or `None` if the registry is
+        not mirrored
+    """
+    mirrors = __salt__['config.get']('mwdocker.registry_mirrors', {})
+    if not mirrors:
+        return None
+
+    registry, name, _ = _parse_image_name(repository)
+    mirror = mirrors.get(registry)
+    if mirror is None and registry == 'registry-1.docker.io':
+        mirror = mirrors.get('docker.io')
+    if mirror is None:
+        return None
+    return "%s/%s" % (mirror, name)
+
+
+def _pull(repository, tag, service=None):
+    started = time.time()
+    layer_sizes = {}
+
+    # Pulling from a mirror (usually one per datacenter) is tried first; the
+    # image is then tagged with its original name, so that it is used just as
+    # if it was pulled from its own registry.
+    pulled = False
+    mirror = _mirror_repository(repository)
+    if mirror is not None:
+        try:
+            _pull_stream(mirror, tag, layer_sizes)
+            _client().tag("%s:%s" % (mirror, tag), repository, tag, force=True)
+            pulled = True
+        except Exception as e:
+            log.warning("Could not pull image %s:%s from mirror %s, pulling from registry: %s" %
+                        (repository, tag, mirror, e))
+            layer_sizes.clear()
+
+        if pulled:
+            try:
+                _client().remove_image("%s:%s" % (mirror, tag))
+            except Exception as e:
+                log.warning("Could not remove tag %s:%s: %s" % (mirror, tag, e))
+
+    if not pulled:
+        _pull_stream(repository, tag, layer_sizes)
+    _update_image_index("%s:%s" % (repository, tag))
+
+    observe_metric('image_pull_duration_seconds', time.time() - started, service)
+    observe_metric('image_pull_bytes', sum(layer_sizes.values()), service)
+
+
+def _pull_stream(repository, tag, layer_sizes):
+    # noinspection PyUnresolvedReferences
+    log.info("Pulling image %s:%s" % (repository, tag))
+    pull_stream = _client().pull(repository, tag, stream=True)
+    for line in pull_stream:
+        j = json.loads(line)
+        if 'error' in j:
+            raise Exception("Could not pull image %s:%s: %s" % (repository, tag, j['errorDetail']))
+        if j.get('status') == 'Downloading' and 'id' in j:
+            layer_sizes[j['id']] = j.get('progressDetail', {}).get('total', 0)
+
+
+def _parse_bytes(value):
+    value = str(value).strip().lower()
+    if len(value) > 1 and value.endswith('b') and value[-2] in __byte_units:
+        value = value[:-1]
+    if value and value[-1] in __byte_units:
+        return int(float(value[:-1]) * __byte_units[value[-1]])
+    return int(value)
+
+
+def _ulimit_definitions(ulimits):
+    definitions = []
+    for name, limit in sorted(ulimits.items()):
+        if isinstance(limit, dict):
+            soft, hard = int(limit['soft']), int(limit.get('hard', limit['soft']))
+        else:
+            soft = hard = int(limit)
+        definitions.append({'Name': name, 'Soft': soft, 'Hard': hard})
+    return definitions
 
 
 def _create_port_definitions(udp_ports, tcp_ports):
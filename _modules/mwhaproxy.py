@@ -0,0 +1,164 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Changes HAProxy backend servers at runtime using HAProxy's admin socket, so
+that servers can be drained, disabled and re-enabled without reloading (and
+thereby resetting) HAProxy.
+
+The socket path can be configured using the `mwhaproxy.socket` minion option
+(default: `/run/haproxy/admin.sock`, as configured in
+`mwms/haproxy/files/haproxy.conf.j2`).
+"""
+
+import logging
+import os
+import socket
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def available():
+    """
+    Checks if the HAProxy admin socket exists.
+
+    :return: `True` if HAProxy can be controlled using its admin socket
+    """
+    return os.path.exists(_socket_path())
+
+
+def servers(backend=None):
+    """
+    Lists the servers of all (or one) backends with their current status.
+
+    :param backend: An optional backend name
+    :return: A dictionary mapping "<backend>/<server>" to a dictionary with the
+        keys `status`, `weight`, `current_sessions` and `queued`
+    """
+    lines = _command('show stat').splitlines()
+    if len(lines) == 0 or not lines[0].startswith('# '):
+        raise Exception("Unexpected response from HAProxy: %s" % '\n'.join(lines[:1]))
+
+    fields = lines[0][2:].split(',')
+    result = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        row = dict(zip(fields, line.split(',')))
+        if row['svname'] in ('FRONTEND', 'BACKEND'):
+            continue
+        if backend is not None and row['pxname'] != backend:
+            continue
+        result['%s/%s' % (row['pxname'], row['svname'])] = {
+            'status': row['status'],
+            'weight': int(row['weight'] or 0),
+            'current_sessions': int(row['scur'] or 0),
+            'queued': int(row['qcur'] or 0),
+        }
+    return result
+
+
+def enable_server(backend, server):
+    """
+    Puts a server (back) into rotation.
+
+    :param backend: The backend name
+    :param server: The server name
+    """
+    _set_server(backend, server, 'state ready')
+
+
+def disable_server(backend, server):
+    """
+    Takes a server out of rotation immediately (maintenance mode). Existing
+    connections to the server are not closed.
+
+    :param backend: The backend name
+    :param server: The server name
+    """
+    _set_server(backend, server, 'state maint')
+
+
+def drain_server(backend, server, timeout=30):
+    """
+    Stops sending new connections to a server and waits until its current
+    sessions are finished (or `timeout` seconds have passed).
+
+    :param backend: The backend name
+    :param server: The server name
+    :param timeout: How long to wait for the server to become idle
+    :return: `True` if the server became idle, `False` if the timeout expired
+    """
+    _set_server(backend, server, 'state drain')
+
+    deadline = time.time() + timeout
+    name = '%s/%s' % (backend, server)
+    while True:
+        status = servers(backend).get(name)
+        if status is None or status['current_sessions'] + status['queued'] == 0:
+            return True
+        if time.time() >= deadline:
+            log.warning("Server %s still has %d sessions after %d seconds" %
+                        (name, status['current_sessions'], timeout))
+            return False
+        time.sleep(0.5)
+
+
+def set_weight(backend, server, weight):
+    """
+    Sets the weight of a server.
+
+    :param backend: The backend name
+    :param server: The server name
+    :param weight: The new weight (0-256), or a percentage of the configured
+        weight (like "50%")
+    """
+    _set_server(backend, server, 'weight %s' % weight)
+
+
+def set_address(backend, server, address, port):
+    """
+    Changes the address of a server (requires HAProxy 1.8 or newer).
+
+    :param backend: The backend name
+    :param server: The server name
+    :param address: The new IP address
+    :param port: The new port
+    """
+    _set_server(backend, server, 'addr %s port %d' % (address, int(port)))
+
+
+def _set_server(backend, server, arguments):
+    response = _command('set server %s/%s %s' % (backend, server, arguments)).strip()
+    # Successful commands respond with an empty line or, for address changes,
+    # with a description of the change.
+    if response and not response.startswith('IP changed') and not response.startswith('no need to change'):
+        raise Exception("HAProxy rejected changing server %s/%s: %s" % (backend, server, response))
+
+
+def _socket_path():
+    return __salt__['config.get']('mwhaproxy.socket', '/run/haproxy/admin.sock')
+
+
+def _command(command):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(10)
+        s.connect(_socket_path())
+        s.sendall((command + '\n').encode('utf-8'))
+
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+
+    return b''.join(chunks).decode('utf-8')
@@ -0,0 +1,171 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Records performance metrics of deployments as Prometheus histograms.
+
+Since each `salt-call` runs in a separate process, observations are
+accumulated in a JSON state file (`mwmetrics.state_file`). After each
+observation, all histograms are written to a file in the Prometheus text
+exposition format (`mwmetrics.textfile`), which can be read by the node
+exporter's textfile collector or served via HTTP (see the
+`mwms.monitoring.metrics` SLS).
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__name__)
+
+__lock = threading.Lock()
+
+METRIC_PREFIX = 'mwms_'
+METRICS = {
+    'image_pull_duration_seconds': (
+        'Duration of image pulls',
+        (1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    ),
+    'image_pull_bytes': (
+        'Number of bytes downloaded per image pull',
+        (1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9)
+    ),
+    'container_start_duration_seconds': (
+        'Duration of the Docker API call starting a container',
+        (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    ),
+    'container_warmup_seconds': (
+        'Time until a started container was ready',
+        (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    ),
+    'spec_check_duration_seconds': (
+        'Time needed to compare an existing container with its specification',
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+    ),
+    'redeploy_duration_seconds': (
+        'Duration of service redeployments',
+        (5, 10, 30, 60, 120, 300, 600, 1200)
+    ),
+}
+
+
+def observe(metric, value, service=''):
+    """
+    Records an observation of a histogram metric.
+
+    :param metric: The metric name (without the `mwms_` prefix), for example
+        `image_pull_duration_seconds`
+    :param value: The observed value
+    :param service: The name of the service the observation belongs to
+    """
+    if metric not in METRICS:
+        raise ValueError("Unknown metric: %s" % metric)
+
+    if not __salt__['config.get']('mwmetrics.enabled', True):
+        return
+
+    buckets = METRICS[metric][1]
+    value = float(value)
+
+    def update(state):
+        series = state.setdefault(metric, {}).setdefault(service or '', {
+            'buckets': [0] * len(buckets),
+            'count': 0,
+            'sum': 0.0
+        })
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['count'] += 1
+        series['sum'] += value
+
+    _update_state(update)
+
+
+def render():
+    """
+    Renders all recorded metrics in the Prometheus text exposition format.
+
+    :return: The metrics as string
+    """
+    return _render(_read_state(_state_file()))
+
+
+def reset():
+    """
+    Discards all recorded observations.
+    """
+    _update_state(lambda state: state.clear())
+
+
+def _state_file():
+    return __salt__['config.get']('mwmetrics.state_file', '/var/lib/mwms/metrics.json')
+
+
+def _textfile():
+    return __salt__['config.get']('mwmetrics.textfile', '/var/lib/mwms/metrics/mwms.prom')
+
+
+def _update_state(update):
+    state_file = _state_file()
+    textfile = _textfile()
+
+    for directory in set([os.path.dirname(state_file), os.path.dirname(textfile)]):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # The state file is shared by all Salt processes on this host; the lock
+    # file serializes read-modify-write cycles between them.
+    with __lock:
+        with open(state_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = _read_state(state_file)
+                update(state)
+                _write_atomically(state_file, json.dumps(state))
+                _write_atomically(textfile, _render(state))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        log.warning("Discarding corrupt metrics state file %s" % state_file)
+        return {}
+
+
+def _write_atomically(path, content):
+    partial = path + '.tmp'
+    with open(partial, 'w') as f:
+        f.write(content)
+    os.rename(partial, path)
+
+
+def _render(state):
+    lines = []
+    for metric in sorted(METRICS):
+        help_text, buckets = METRICS[metric]
+        name = METRIC_PREFIX + metric
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % name)
+
+        for service, series in sorted(state.get(metric, {}).items()):
+            label = 'service="%s"' % service.replace('\\', '\\\\').replace('"', '\\"')
+            for bound, count in zip(buckets, series['buckets']):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, repr(float(bound)), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label, series['count']))
+            lines.append('%s_sum{%s} %s' % (name, label, repr(float(series['sum']))))
+            lines.append('%s_count{%s} %d' % (name, label, series['count']))
+
+    return '\n'.join(lines) + '\n'
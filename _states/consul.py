@@ -7,7 +7,6 @@
 
 import requests
 import json
-import salt.states.file
 
 
 def node(name, address, datacenter=None, service=None):
@@ -75,6 +74,83 @@ def node(name, address, datacenter=None, service=None):
     return ret
 
 
+def nodes(name, nodes):
+    """
+    This state registers a number of external nodes using the Consul REST API.
+    In contrast to the `consul.node` state, the catalog of each datacenter is
+    read only once for all nodes, and only nodes that differ from the catalog
+    are written (in as few requests as possible).
+
+    :param name: An arbitrary state name
+    :param nodes: A dictionary of node definitions indexed by node name. Each
+        node definition may contain the keys `address` (required), `datacenter`
+        and `service` (see the `consul.node` state).
+    """
+    ret = {
+        'name': name,
+        'result': True,
+        'changes': {},
+        'comment': ''
+    }
+
+    # Catalogs of the nodes' datacenters (`None` is the agent's datacenter)
+    existing_nodes = {}
+    existing_services = {}
+
+    registrations = []
+    for node_name, node_config in sorted(nodes.items()):
+        repr = {
+            "Node": node_name,
+            "Address": node_config['address']
+        }
+
+        if node_config.get('datacenter') is not None:
+            repr["Datacenter"] = node_config['datacenter']
+
+        service = node_config.get('service')
+        if service is not None:
+            repr["Service"] = dict(service)
+            repr["Service"]["Address"] = ""
+            if "Tags" not in repr["Service"]:
+                repr["Service"]["Tags"] = None
+
+        datacenter = node_config.get('datacenter')
+        if datacenter not in existing_nodes:
+            existing_nodes[datacenter] = __salt__['consul.catalog_nodes'](datacenter=datacenter)
+
+        existing = existing_nodes[datacenter].get(node_name)
+        changed = existing is None or existing['Address'] != repr['Address']
+
+        if not changed and service is not None:
+            service_name = service.get('Service', service['ID'])
+            if (datacenter, service_name) not in existing_services:
+                existing_services[(datacenter, service_name)] = dict(
+                    ((s['Node'], s['ServiceID']), s)
+                    for s in __salt__['consul.catalog_service'](service_name, datacenter=datacenter)
+                )
+            existing_service = existing_services[(datacenter, service_name)].get((node_name, service['ID']))
+            changed = existing_service is None or \
+                existing_service.get('ServicePort') != service.get('Port') or \
+                (existing_service.get('ServiceTags') or None) != (service.get('Tags') or None)
+
+        if changed:
+            registrations.append(repr)
+            ret['changes'][node_name] = {"old": existing, "new": repr}
+
+    if len(registrations) == 0:
+        ret['comment'] = 'All nodes are up to spec'
+        return ret
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would register %d nodes' % len(registrations)
+        return ret
+
+    __salt__['consul.catalog_register'](registrations)
+    ret['comment'] = 'Registered %d nodes' % len(registrations)
+    return ret
+
+
 def service(name, config_dir='/etc/consul', port=80, check_type=None, check_url=None, check_script=None,
             check_interval="1m", check_name='default health check'):
     """
@@ -132,4 +208,89 @@ def service(name, config_dir='/etc/consul', port=80, check_type=None, check_url=
     service_json = json.dumps(service_definition)
     service_file = '%s/service-%s.json' % (config_dir, name)
 
+    # Imported here, so that the other states can be used without Salt's
+    # state modules (for example, in tests)
+    import salt.states.file
     return salt.states.file.managed(name=service_file, contents=service_json)
+
+
+def service_registered(name, service_id=None, port=None, tags=None, checks=None):
+    """
+    This state registers a service (and its health checks) with the local
+    Consul agent using the agent's HTTP API. In contrast to the
+    `consul.service` state, this does not require the Consul configuration to
+    be reloaded, and the agent is not contacted at all if the service is
+    already registered with the same definition.
+
+    :param name: The service name
+    :param service_id: The service ID (defaults to the service name)
+    :param port: The port that the service is available on
+    :param tags: A list of service tags
+    :param checks: A list of health check definitions (see [1])
+
+    [1] https://www.consul.io/docs/agent/checks.html
+    """
+    definition = {'name': name, 'id': service_id or name}
+    if port is not None:
+        definition['port'] = port
+    if tags is not None:
+        definition['tags'] = tags
+    if checks:
+        definition['checks'] = checks
+
+    ret = {
+        'name': name,
+        'result': True,
+        'changes': {},
+        'comment': ''
+    }
+
+    if __salt__['consul.service_registered'](definition):
+        ret['comment'] = 'Service %s is registered and up to spec' % definition['id']
+        return ret
+
+    ret['changes'] = {'service': {'old': __salt__['consul.agent_services']().get(definition['id']), 'new': definition}}
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would register service %s' % definition['id']
+        return ret
+
+    __salt__['consul.service_register'](definition)
+    ret['comment'] = 'Registered service %s' % definition['id']
+    return ret
+
+
+def service_deregistered(name, keep=()):
+    """
+    This state deregisters all instances of a service from the local Consul
+    agent, except for the instances whose IDs are listed in `keep`.
+
+    :param name: The service name
+    :param keep: A list of service IDs that should stay registered
+    """
+    ret = {
+        'name': name,
+        'result': True,
+        'changes': {},
+        'comment': ''
+    }
+
+    obsolete = sorted(
+        service_id for service_id, service in __salt__['consul.agent_services']().items()
+        if service.get('Service') == name and service_id not in keep
+    )
+
+    if len(obsolete) == 0:
+        ret['comment'] = 'No obsolete instances of service %s are registered' % name
+        return ret
+
+    ret['changes'] = {'deregistered': obsolete}
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would deregister %s' % ', '.join(obsolete)
+        return ret
+
+    for service_id in obsolete:
+        __salt__['consul.service_deregister'](service_id)
+    ret['comment'] = 'Deregistered %s' % ', '.join(obsolete)
+    return ret
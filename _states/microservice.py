@@ -0,0 +1,77 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+
+def cpus_allocated(name, service, allocation):
+    """
+    Records the CPUs assigned to the instances of a service in the placement
+    file (see `microservice.record_cpu_allocation`). This state is generated
+    by the `mwms.services` state when the `mwms:cpu_pinning` pillar is set.
+
+    :param name: An arbitrary state name
+    :param service: The service name
+    :param allocation: A dictionary mapping container key and (as string)
+        instance number to the instance's `cpuset_cpus` and `cpuset_mems`
+    """
+    changes = __salt__['microservice.record_cpu_allocation'](service, allocation, test=__opts__['test'])
+
+    ret = {
+        'name': name,
+        'result': True,
+        'changes': changes,
+        'comment': 'CPU allocation is up to spec'
+    }
+
+    if len(changes) > 0:
+        if __opts__['test']:
+            ret['result'] = None
+            ret['comment'] = 'CPU allocation of %d instances would be recorded' % len(changes)
+        else:
+            ret['comment'] = 'Recorded CPU allocation of %d instances' % len(changes)
+
+    return ret
+
+
+def standby_promoted(name, service, key, instance, container, port):
+    """
+    Promotes a running warm standby container to an instance of a service's
+    container (see `microservice.record_promotion`). This state is generated
+    by the `mwms.services` state for each instance without a container that a
+    standby takes over.
+
+    :param name: An arbitrary state name
+    :param service: The service name
+    :param key: The container name (within the service)
+    :param instance: The instance number
+    :param container: The standby container's name
+    :param port: The standby container's host port
+    """
+    ret = {
+        'name': name,
+        'result': True,
+        'changes': {},
+        'comment': ''
+    }
+
+    try:
+        promotion = __salt__['microservice.record_promotion'](service, key, instance, container, port,
+                                                              test=__opts__['test'])
+    except Exception as e:
+        ret['result'] = False
+        ret['comment'] = str(e)
+        return ret
+
+    if len(promotion) == 0:
+        ret['comment'] = 'Container %s already runs this instance' % container
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Standby %s would be promoted' % container
+        ret['changes']['container'] = promotion
+    else:
+        ret['comment'] = 'Promoted standby %s' % container
+        ret['changes']['container'] = promotion
+
+    return ret
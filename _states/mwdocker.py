@@ -5,9 +5,11 @@
 # This code is MIT-licensed. See the LICENSE.txt for more information
 
 
-import docker.errors
-import docker
+import contextlib
+import fcntl
 import logging
+import os
+import time
 
 
 log = logging.getLogger(__name__)
@@ -21,7 +23,8 @@ if not '__salt__' in globals():
 
 
 def running(name, image, volumes=(), restart=True, tcp_ports=(), udp_ports=(), environment=None, command=None, dns=None,
-            domain=None, volumes_from=None, links=None, user=None, warmup_wait=60, stateful=False, labels=None):
+            domain=None, volumes_from=None, links=None, user=None, warmup_wait=60, stateful=False, labels=None,
+            check_url=None, concurrency=None, resources=None, min_running=None):
     """
     Asserts that a container matching the provided specification is up and
     running.
@@ -39,9 +42,139 @@ def running(name, image, volumes=(), restart=True, tcp_ports=(), udp_ports=(), e
     :param list     volumes_from: A list of container names from which to use the volumes
     :param dict     links       : A dictionary of containers to link (using the container name as index and the alias as value)
     :param str      user        : The user under which to start the container
-    :param int      warmup_wait : The amount of time to wait for the container to start
+    :param int      warmup_wait : The maximum amount of time to wait for the container to start
     :param bool     stateful    : Set to `True` to prevent this container from automatic deletion
     :param dict     labels      : A dictionary of labels that should be attached to the container
+    :param str      check_url   : An HTTP URL that must respond successfully for the container to be considered started
+    :param int      concurrency : The maximum number of `mwdocker.running` states (with the same `concurrency`) that
+                                  may be applied at the same time; used with `parallel: True`
+    :param dict     resources   : Resource limits of the container, like `mem_limit` or `cpuset_cpus` (see
+                                  `mwdocker.resource_host_config`)
+    :param int      min_running : How long a container without `check_url` and image health check must stay running
+                                  to be considered started (see `mwdocker.start_container`)
+    """
+    with __concurrency_slot(concurrency):
+        ret = {
+            'name': name,
+            'result': True,
+            'changes': {},
+            'comment': ''
+        }
+
+        # A colon before the last slash separates a registry's host name and port
+        if ':' not in image.rsplit('/', 1)[-1]:
+            image += ":latest"
+
+        service_name = (labels or {}).get('service')
+
+        # noinspection PyCallingNonCallable
+        __salt__['mwdocker.pull_image'](image, force=False, test=__opts__['test'], service=service_name)
+
+        # noinspection PyCallingNonCallable
+        existing = __salt__['mwdocker.inspect_container'](name)
+
+        if existing is not None:
+            spec_check_started = time.time()
+
+            # noinspection PyCallingNonCallable
+            expected_hash = __salt__['mwdocker.spec_hash'](image, command=command, environment=environment,
+                                                           volumes=volumes, udp_ports=udp_ports, tcp_ports=tcp_ports,
+                                                           restart=restart, dns=dns, domain=domain,
+                                                           volumes_from=volumes_from, links=links, user=user,
+                                                           labels=labels, resources=resources)
+
+            # The recorded specification hash covers all settings (including ones
+            # that the detailed comparison does not look at, like the user or
+            # removed resource limits), so it decides whether the container is up
+            # to spec; the detailed comparison is only needed to describe changes.
+            # noinspection PyCallingNonCallable
+            recorded_hash = __salt__['mwdocker.container_spec_hash'](name)
+            # noinspection PyCallingNonCallable
+            if recorded_hash == expected_hash and existing['Image'] == __salt__['mwdocker.image_id'](image):
+                matches_spec = True
+            else:
+                matches_spec = __does_existing_container_matches_spec(ret, existing, name, image, tcp_ports=tcp_ports,
+                                                                      volumes=volumes, udp_ports=udp_ports,
+                                                                      environment=environment, command=command, dns=dns,
+                                                                      volumes_from=volumes_from, links=links,
+                                                                      domain=domain, labels=labels, user=user,
+                                                                      resources=resources)
+                if recorded_hash is not None and recorded_hash != expected_hash:
+                    if matches_spec:
+                        ret['changes']['spec_hash'] = {'old': recorded_hash, 'new': expected_hash}
+                    matches_spec = False
+
+            # noinspection PyCallingNonCallable
+            __salt__['mwdocker.observe_metric']('spec_check_duration_seconds', time.time() - spec_check_started,
+                                                service_name)
+
+            if not matches_spec and stateful:
+                ret['comment'] += "Deleting old version of container %s with gracious timeout, keeping volumes\n" % name
+                if not __opts__['test']:
+                    # noinspection PyCallingNonCallable
+                    __salt__['mwdocker.delete_container'](name, timeout=60, with_volumes=False)
+                return ret
+            elif not matches_spec:
+                ret['comment'] += "Deleting old version of container %s\n" % name
+                if not __opts__['test']:
+                    # noinspection PyCallingNonCallable
+                    __salt__['mwdocker.delete_container'](name, with_volumes=True)
+            else:
+                # noinspection PyCallingNonCallable
+                updated = __salt__['mwdocker.update_resources'](name, resources, test=__opts__['test'])
+                if len(updated) > 0:
+                    ret['changes']['resources'] = updated
+                    ret['comment'] += 'Updated resources of container %s.\n' % name
+                    if __opts__['test']:
+                        ret['result'] = None
+                else:
+                    ret['comment'] += 'Container exists and is up to spec.\n'
+                return ret
+
+        if not __opts__['test']:
+            # noinspection PyCallingNonCallable
+            container_id = __salt__['mwdocker.create_container'](
+                name=name,
+                image=image,
+                command=command,
+                environment=environment,
+                links=links,
+                volumes=volumes,
+                volumes_from=volumes_from,
+                udp_ports=udp_ports,
+                tcp_ports=tcp_ports,
+                restart=restart,
+                dns=dns,
+                domain=domain,
+                user=user,
+                labels=labels,
+                resources=resources,
+                test=__opts__['test']
+            )
+
+            ret['changes']['container'] = {'new': container_id}
+            ret['changes']['running'] = {'old': False, 'new': True}
+
+            __salt__['mwdocker.start_container'](name, warmup_wait=warmup_wait, check_url=check_url,
+                                                 min_running=min_running)
+        else:
+            ret['changes']['container'] = {'new': '<NEW-CONTAINER-ID>'}
+            ret['changes']['running'] = {'old': False, 'new': True}
+
+        return ret
+
+
+def images_present(name, images, force=False, workers=None, services=None):
+    """
+    Asserts that a set of images is present on the host. Missing images are
+    pulled concurrently, which is considerably faster than letting each
+    `mwdocker.running` state pull its image one after another.
+
+    :param str  name   : An arbitrary state name
+    :param list images : A list of image names. If no tag is specified, the `latest` tag is assumed
+    :param bool force  : Set to `True` to pull images even when they are already present
+    :param int  workers: The maximum number of concurrent pulls
+    :param dict services: An optional dictionary mapping image names to the names of the services using them
     """
     ret = {
         'name': name,
@@ -49,75 +182,67 @@ def running(name, image, volumes=(), restart=True, tcp_ports=(), udp_ports=(), e
         'changes': {},
         'comment': ''
     }
-    client = docker.Client(base_url='unix://var/run/docker.sock')
-
-    if ':' not in image:
-        image += ":latest"
 
     # noinspection PyCallingNonCallable
-    __salt__['mwdocker.pull_image'](image, force=False, test=__opts__['test'])
-
-    try:
-        existing = client.inspect_container(name)
-    except docker.errors.NotFound:
-        existing = None
-
-    if existing is not None:
-        matches_spec = __does_existing_container_matches_spec(client, ret, existing, name, image, tcp_ports=tcp_ports,
-                                                              volumes=volumes, udp_ports=udp_ports,
-                                                              environment=environment, command=command, dns=dns,
-                                                              volumes_from=volumes_from, links=links, domain=domain,
-                                                              labels=labels)
-
-        if not matches_spec and stateful:
-            ret['comment'] += "Deleting old version of container %s with gracious timeout, keeping volumes\n" % name
-            if not __opts__['test']:
-                # noinspection PyCallingNonCallable
-                __salt__['mwdocker.delete_container'](name, timeout=60, with_volumes=False)
-            return ret
-        elif not matches_spec:
-            ret['comment'] += "Deleting old version of container %s\n" % name
-            if not __opts__['test']:
-                # noinspection PyCallingNonCallable
-                __salt__['mwdocker.delete_container'](name, with_volumes=True)
-        else:
-            ret['comment'] += 'Container exists and is up to spec.\n'
-            return ret
-
-    if not __opts__['test']:
-        # noinspection PyCallingNonCallable
-        container_id = __salt__['mwdocker.create_container'](
-            name=name,
-            image=image,
-            command=command,
-            environment=environment,
-            links=links,
-            volumes=volumes,
-            volumes_from=volumes_from,
-            udp_ports=udp_ports,
-            tcp_ports=tcp_ports,
-            restart=restart,
-            dns=dns,
-            domain=domain,
-            user=user,
-            labels=labels,
-            test=__opts__['test']
-        )
-
-        ret['changes']['container'] = {'new': container_id}
-        ret['changes']['running'] = {'old': False, 'new': True}
-
-        __salt__['mwdocker.start_container'](name, warmup_wait=warmup_wait)
+    pulled = __salt__['mwdocker.pull_images'](images, force=force, workers=workers, test=__opts__['test'],
+                                                services=services)
+
+    if len(pulled) == 0:
+        ret['comment'] = 'All images are present.'
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would pull images %s' % ', '.join(pulled)
+        ret['changes']['pulled'] = pulled
     else:
-        ret['changes']['container'] = {'new': '<NEW-CONTAINER-ID>'}
-        ret['changes']['running'] = {'old': False, 'new': True}
+        ret['comment'] = 'Pulled images %s' % ', '.join(pulled)
+        ret['changes']['pulled'] = pulled
 
     return ret
 
 
-def __does_existing_container_matches_spec(client, ret, existing, name, image, volumes=(), restart=True, tcp_ports=(),
+@contextlib.contextmanager
+def __concurrency_slot(concurrency):
+    """
+    Holds one of `concurrency` slots while the block runs; without a
+    `concurrency`, no slot is needed.
+    """
+    if not concurrency:
+        yield
+        return
+
+    # Parallel states are applied in separate processes, so the slots are
+    # lock files that are shared between them.
+    slot_dir = os.path.join(__opts__['cachedir'], 'mwms', 'slots')
+    if not os.path.isdir(slot_dir):
+        try:
+            os.makedirs(slot_dir)
+        except OSError:
+            # Another process may have created the directory in the meantime
+            pass
+
+    slot = None
+    while slot is None:
+        for i in range(int(concurrency)):
+            candidate = open(os.path.join(slot_dir, 'slot-%d.lock' % i), 'a')
+            try:
+                fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                slot = candidate
+                break
+            except IOError:
+                candidate.close()
+        else:
+            time.sleep(0.2)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        slot.close()
+
+
+def __does_existing_container_matches_spec(ret, existing, name, image, volumes=(), restart=True, tcp_ports=(),
                                            udp_ports=(), environment=None, command=None, dns=None, volumes_from=None,
-                                           links=None, domain=None, labels=None):
+                                           links=None, domain=None, labels=None, user=None, resources=None):
     up_to_spec = True
     image_id = __salt__['mwdocker.image_id'](image)
 
@@ -208,8 +333,27 @@ def __does_existing_container_matches_spec(client, ret, existing, name, image, v
             ret['changes']['domain'] = {'old': existing['HostConfig']['DnsSearch'], 'new': [domain]}
             up_to_spec = False
 
-    if existing['Config']['Labels'] != labels:
-        ret['changes']['labels'] = {'old': existing['Config']['Labels'], 'new': labels}
+    if (existing['Config'].get('User') or None) != (user or None):
+        ret['changes']['user'] = {'old': existing['Config'].get('User') or None, 'new': user}
+        up_to_spec = False
+
+    if resources is not None:
+        # noinspection PyCallingNonCallable
+        for field, value in sorted(__salt__['mwdocker.resource_host_config'](resources).items()):
+            # CPU sets are updated in place (see mwdocker.update_resources)
+            if field in ('CpusetCpus', 'CpusetMems'):
+                continue
+            current = existing['HostConfig'].get(field)
+            if field == 'Ulimits':
+                current = sorted(current or [], key=lambda ulimit: ulimit['Name'])
+            if current != value:
+                ret['changes']['resources/%s' % field] = {'old': current, 'new': value}
+                up_to_spec = False
+
+    # Labels starting with "mwms." are managed by the mwdocker module itself
+    existing_labels = dict((k, v) for k, v in (existing['Config']['Labels'] or {}).items() if not k.startswith('mwms.'))
+    if existing_labels != labels:
+        ret['changes']['labels'] = {'old': existing_labels, 'new': labels}
         up_to_spec = False
 
     return up_to_spec
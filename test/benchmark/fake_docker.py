@@ -0,0 +1,504 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+A fake Docker daemon that serves the subset of the Docker remote API used by
+the `mwdocker` module on a unix socket. Containers are not actually run; the
+daemon only keeps track of images and containers in memory and counts the API
+calls made against it.
+
+Run it standalone with:
+
+    python test/benchmark/fake_docker.py --socket /tmp/docker.sock --images 10 --containers 100 --latency 0.002
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+
+LAYERS_PER_IMAGE = 3
+LAYER_SIZE = 20 * 1024 * 1024
+
+
+def _digest(*parts):
+    return 'sha256:' + hashlib.sha256(':'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+class FakeDockerDaemon(object):
+    """
+    In-memory state of the fake Docker daemon.
+
+    :param latency: Artificial latency (in seconds) added to each API call
+    :param pull_latency: Additional latency (in seconds) of each image pull
+    """
+
+    def __init__(self, latency=0.0, pull_latency=0.0):
+        self.latency = latency
+        self.pull_latency = pull_latency
+        self.images = {}
+        self.containers = {}
+        self.calls = {}
+        # Repositories whose pulls fail, like images missing on a mirror
+        self.unavailable = set()
+        self.pulled = []
+        self.connections = 0
+        self.lock = threading.RLock()
+        self.generation = 0
+
+    def add_image(self, tag):
+        with self.lock:
+            self.generation += 1
+            image_id = _digest(tag, self.generation)
+            for existing in self.images.values():
+                if tag in existing['RepoTags']:
+                    existing['RepoTags'].remove(tag)
+            repository = tag.rsplit(':', 1)[0]
+            self.images[image_id] = {
+                'Id': image_id,
+                'RepoTags': [tag],
+                'RepoDigests': ['%s@%s' % (repository, _digest('manifest', image_id))],
+                'Created': int(time.time()),
+                'Size': LAYERS_PER_IMAGE * LAYER_SIZE
+            }
+            return image_id
+
+    def tag_image(self, name, repository, tag):
+        with self.lock:
+            image = self.find_image(name)
+            if image is None:
+                raise NotFound('No such image: %s' % name)
+            new_tag = '%s:%s' % (repository, tag or 'latest')
+            for existing in self.images.values():
+                if new_tag in existing['RepoTags']:
+                    existing['RepoTags'].remove(new_tag)
+            image['RepoTags'].append(new_tag)
+
+    def remove_image(self, name):
+        """
+        Removes a tag of an image, or the image itself when it has no other
+        tags (or is referenced by ID).
+
+        :return: The Docker API's list of untagged and deleted references
+        """
+        with self.lock:
+            image = self.find_image(name)
+            if image is None:
+                raise NotFound('No such image: %s' % name)
+            tag = name if ':' in name.rsplit('/', 1)[-1] else name + ':latest'
+            if tag in image['RepoTags'] and len(image['RepoTags']) > 1:
+                image['RepoTags'].remove(tag)
+                return [{'Untagged': tag}]
+            del self.images[image['Id']]
+            return [{'Deleted': image['Id']}]
+
+    def add_container(self, name, image, labels=None, running=True):
+        info = self.create_container(name, {'Image': image, 'Labels': labels or {}, 'HostConfig': {}})
+        if running:
+            self.start_container(name)
+        return info['Id']
+
+    def preload(self, images=0, containers=0):
+        """
+        Creates `images` images and `containers` running containers that carry
+        a `service` label.
+        """
+        for i in range(images):
+            self.add_image('localhost/bench-%d:latest' % i)
+        for i in range(containers):
+            self.add_container('preloaded-%d' % i, 'localhost/bench-%d:latest' % (i % max(1, images)),
+                               labels={'service': 'preloaded-%d' % (i // 5), 'service_group': 'preloaded'})
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    def reset_calls(self):
+        with self.lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def find_image(self, name):
+        if name in self.images:
+            return self.images[name]
+        if ':' not in name.rsplit('/', 1)[-1]:
+            name += ':latest'
+        for image in self.images.values():
+            if name in image['RepoTags']:
+                return image
+        return None
+
+    def find_container(self, name_or_id):
+        if name_or_id in self.containers:
+            return self.containers[name_or_id]
+        for container in self.containers.values():
+            if container['Id'].startswith(name_or_id):
+                return container
+        return None
+
+    def create_container(self, name, config):
+        with self.lock:
+            if name in self.containers:
+                raise Conflict('Conflict. The name "%s" is already in use' % name)
+            image = self.find_image(config['Image'])
+            if image is None:
+                raise NotFound('No such image: %s' % config['Image'])
+
+            config = dict(config)
+            host_config = config.pop('HostConfig', None) or {}
+            config.setdefault('Labels', {})
+            container = {
+                'Id': _digest('container', name, time.time())[7:],
+                'Name': '/' + name,
+                'Image': image['Id'],
+                'Created': time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime()),
+                'Config': config,
+                'HostConfig': host_config,
+                'State': {'Running': False, 'Restarting': False, 'Paused': False, 'Pid': 0, 'ExitCode': 0,
+                          'StartedAt': '0001-01-01T00:00:00Z'},
+                'RestartCount': 0,
+                'NetworkSettings': {'IPAddress': '', 'Ports': {}},
+                'Mounts': []
+            }
+            self.containers[name] = container
+            return container
+
+    def start_container(self, name_or_id):
+        with self.lock:
+            container = self.find_container(name_or_id)
+            if container is None:
+                raise NotFound('No such container: %s' % name_or_id)
+            container['State'].update({
+                'Running': True,
+                'Pid': 1000 + len(self.containers),
+                'StartedAt': time.strftime('%Y-%m-%dT%H:%M:%S.', time.gmtime()) + '%09dZ' % (time.time() % 1 * 1e9)
+            })
+            if (container['Config'].get('Healthcheck') or {}).get('Test'):
+                container['State']['Health'] = {'Status': 'starting'}
+            ports = {}
+            for port, bindings in (container['HostConfig'].get('PortBindings') or {}).items():
+                ports[port] = [{'HostIp': b.get('HostIp', ''), 'HostPort': str(b.get('HostPort', ''))}
+                               for b in bindings]
+            container['NetworkSettings'] = {'IPAddress': '172.17.0.%d' % (len(self.containers) % 250 + 2),
+                                            'Ports': ports}
+
+    def set_health(self, name_or_id, status):
+        """
+        Sets the health status of a container with a health check, like
+        Docker does when the check succeeds or fails.
+        """
+        with self.lock:
+            self.find_container(name_or_id)['State']['Health'] = {'Status': status}
+
+    def update_container(self, name_or_id, resources):
+        with self.lock:
+            container = self.find_container(name_or_id)
+            if container is None:
+                raise NotFound('No such container: %s' % name_or_id)
+            container['HostConfig'].update(resources)
+
+    def stop_container(self, name_or_id):
+        with self.lock:
+            container = self.find_container(name_or_id)
+            if container is None:
+                raise NotFound('No such container: %s' % name_or_id)
+            container['State']['Running'] = False
+
+    def remove_container(self, name_or_id):
+        with self.lock:
+            container = self.find_container(name_or_id)
+            if container is None:
+                raise NotFound('No such container: %s' % name_or_id)
+            del self.containers[container['Name'].lstrip('/')]
+
+    def list_containers(self, all_containers, label_filters):
+        with self.lock:
+            result = []
+            for name, container in sorted(self.containers.items()):
+                if not all_containers and not container['State']['Running']:
+                    continue
+                labels = container['Config'].get('Labels') or {}
+                if not all(_label_matches(labels, f) for f in label_filters):
+                    continue
+                result.append({
+                    'Id': container['Id'],
+                    'Names': ['/' + name],
+                    'Image': container['Config']['Image'],
+                    'ImageID': container['Image'],
+                    'Labels': labels,
+                    'State': 'running' if container['State']['Running'] else 'exited',
+                    'Status': 'Up' if container['State']['Running'] else 'Exited (0)'
+                })
+            return result
+
+
+def _label_matches(labels, label_filter):
+    key, _, value = label_filter.partition('=')
+    return key in labels and (not value or labels[key] == value)
+
+
+class NotFound(Exception):
+    status = 404
+
+
+class Conflict(Exception):
+    status = 409
+
+
+class _Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    # Concurrent pulls and container inspections open many connections at once
+    request_queue_size = 128
+
+
+def _make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def address_string(self):
+            return 'unix'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with daemon.lock:
+                daemon.connections += 1
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+        def do_HEAD(self):
+            self._dispatch('HEAD')
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            path = re.sub(r'^/v[0-9.]+', '', url.path)
+            query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+
+            if daemon.latency:
+                time.sleep(daemon.latency)
+
+            for pattern_method, pattern, handler in ROUTES:
+                match = re.match(pattern, path)
+                if pattern_method == method and match:
+                    daemon.count('%s %s' % (method, handler.__name__.lstrip('_')))
+                    try:
+                        handler(self, daemon, query, body, *match.groups())
+                    except (NotFound, Conflict) as e:
+                        self._send_json(e.status, {'message': str(e)})
+                    return
+
+            daemon.count('%s <unknown>' % method)
+            self._send_json(404, {'message': 'page not found: %s %s' % (method, path)})
+
+        def _send_json(self, status, data):
+            payload = json.dumps(data).encode('utf-8') if data is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_stream(self, status, messages):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for message in messages:
+                chunk = json.dumps(message).encode('utf-8') + b'\r\n'
+                self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+def _ping(handler, daemon, query, body):
+    payload = b'OK'
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/plain')
+    handler.send_header('Content-Length', str(len(payload)))
+    handler.end_headers()
+    handler.wfile.write(payload)
+
+
+def _version(handler, daemon, query, body):
+    handler._send_json(200, {'Version': '1.9.1', 'ApiVersion': '1.21', 'Os': 'linux', 'Arch': 'amd64'})
+
+
+def _images(handler, daemon, query, body):
+    with daemon.lock:
+        handler._send_json(200, list(daemon.images.values()))
+
+
+def _inspect_image(handler, daemon, query, body, name):
+    with daemon.lock:
+        image = daemon.find_image(name)
+        if image is None:
+            raise NotFound('No such image: %s' % name)
+        handler._send_json(200, image)
+
+
+def _remove_image(handler, daemon, query, body, name):
+    handler._send_json(200, daemon.remove_image(name))
+
+
+def _tag_image(handler, daemon, query, body, name):
+    daemon.tag_image(name, query['repo'], query.get('tag'))
+    handler._send_json(201, None)
+
+
+def _pull(handler, daemon, query, body):
+    tag = '%s:%s' % (query['fromImage'], query.get('tag', 'latest'))
+    if daemon.pull_latency:
+        time.sleep(daemon.pull_latency)
+
+    if query['fromImage'] in daemon.unavailable:
+        message = 'manifest for %s not found' % tag
+        handler._send_stream(200, [{'error': message, 'errorDetail': {'message': message}}])
+        return
+
+    with daemon.lock:
+        daemon.pulled.append(tag)
+
+    # Every pull yields a new image, as if a new version had been released.
+    image_id = daemon.add_image(tag)
+    messages = [{'status': 'Pulling from %s' % query['fromImage'], 'id': query.get('tag', 'latest')}]
+    for layer in range(LAYERS_PER_IMAGE):
+        layer_id = _digest(image_id, layer)[7:19]
+        messages.append({'status': 'Pulling fs layer', 'id': layer_id, 'progressDetail': {}})
+        messages.append({'status': 'Downloading', 'id': layer_id,
+                         'progressDetail': {'current': LAYER_SIZE, 'total': LAYER_SIZE}})
+        messages.append({'status': 'Pull complete', 'id': layer_id, 'progressDetail': {}})
+    messages.append({'status': 'Status: Downloaded newer image for %s' % tag})
+    handler._send_stream(200, messages)
+
+
+def _containers(handler, daemon, query, body):
+    filters = json.loads(query.get('filters') or '{}')
+    label_filters = filters.get('label', [])
+    if not isinstance(label_filters, list):
+        label_filters = [k for k, v in label_filters.items() if v]
+    handler._send_json(200, daemon.list_containers(query.get('all') in ('1', 'True', 'true'), label_filters))
+
+
+def _create_container(handler, daemon, query, body):
+    container = daemon.create_container(query['name'], json.loads(body.decode('utf-8')))
+    handler._send_json(201, {'Id': container['Id'], 'Warnings': None})
+
+
+def _inspect_container(handler, daemon, query, body, name):
+    with daemon.lock:
+        container = daemon.find_container(name)
+        if container is None:
+            raise NotFound('No such container: %s' % name)
+        handler._send_json(200, container)
+
+
+def _start_container(handler, daemon, query, body, name):
+    daemon.start_container(name)
+    handler._send_json(204, None)
+
+
+def _update_container(handler, daemon, query, body, name):
+    daemon.update_container(name, json.loads(body.decode('utf-8')))
+    handler._send_json(200, {'Warnings': None})
+
+
+def _stop_container(handler, daemon, query, body, name):
+    daemon.stop_container(name)
+    handler._send_json(204, None)
+
+
+def _remove_container(handler, daemon, query, body, name):
+    daemon.remove_container(name)
+    handler._send_json(204, None)
+
+
+ROUTES = [
+    ('GET', r'^/_ping$', _ping),
+    ('GET', r'^/version$', _version),
+    ('GET', r'^/images/json$', _images),
+    ('GET', r'^/images/(.+)/json$', _inspect_image),
+    ('POST', r'^/images/create$', _pull),
+    ('POST', r'^/images/(.+)/tag$', _tag_image),
+    ('DELETE', r'^/images/(.+)$', _remove_image),
+    ('GET', r'^/containers/json$', _containers),
+    ('POST', r'^/containers/create$', _create_container),
+    ('GET', r'^/containers/([^/]+)/json$', _inspect_container),
+    ('POST', r'^/containers/([^/]+)/start$', _start_container),
+    ('POST', r'^/containers/([^/]+)/update$', _update_container),
+    ('POST', r'^/containers/([^/]+)/stop$', _stop_container),
+    ('DELETE', r'^/containers/([^/]+)$', _remove_container),
+]
+
+
+def serve(daemon, socket_path):
+    """
+    Serves the fake Docker API of `daemon` on a unix socket in a background
+    thread.
+
+    :return: The server; call `shutdown()` on it to stop serving
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = _Server(socket_path, _make_handler(daemon))
+    thread = threading.Thread(target=server.serve_forever, name='fake-docker')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Docker daemon for benchmarks')
+    parser.add_argument('--socket', default='/tmp/fake-docker.sock', help='Path of the unix socket')
+    parser.add_argument('--images', type=int, default=0, help='Number of images to create')
+    parser.add_argument('--containers', type=int, default=0, help='Number of containers to create')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of each API call in seconds')
+    parser.add_argument('--pull-latency', type=float, default=0.0, help='Additional latency of image pulls')
+    args = parser.parse_args()
+
+    daemon = FakeDockerDaemon(latency=args.latency, pull_latency=args.pull_latency)
+    daemon.preload(images=args.images, containers=args.containers)
+    serve(daemon, args.socket)
+    print("Serving fake Docker API on %s (%d images, %d containers)" % (
+        args.socket, len(daemon.images), len(daemon.containers)))
+
+    try:
+        while True:
+            time.sleep(10)
+            print("API calls: %s" % json.dumps(daemon.calls, sort_keys=True))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+Benchmarks the `mwms.services` SLS renderer, the `mwdocker` states and
+`microservice.redeploy` against a fake Docker daemon (see `fake_docker.py`).
+
+For each size, a pillar with the given number of containers is generated and
+the following scenarios are run, each in a freshly loaded set of modules (just
+like each `salt-call` starts with fresh modules):
+
+*   `render`: rendering the `mwms.services` and `mwms.backup` SLS files
+*   `highstate-create`: applying the `mwdocker` states to an empty host
+*   `highstate-noop`: applying the same states again
+*   `redeploy`: redeploying all services, pulling a new image for each
+
+The modules' dependencies (like docker-py) are imported before the scenarios
+are run, so the wall times do not include importing them. The peak memory
+usage is only traced with `--memory`, since tracing slows the scenarios down
+considerably.
+
+Run it with:
+
+    python test/benchmark/run.py --sizes 10 100 1000 --latency 0.001
+
+To compare with another version of the modules, check that version out (for
+example, using `git worktree add`) and pass its path using `--repo`. Versions
+that do not support the `mwdocker.base_url` option always connect to
+`/var/run/docker.sock`; use `--socket /var/run/docker.sock` for them.
+
+This requires docker-py and requests, just like the modules themselves.
+"""
+
+import argparse
+import inspect
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_docker
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+INSTANCES_PER_SERVICE = 5
+SCENARIOS = ('render', 'highstate-create', 'highstate-noop', 'redeploy')
+
+
+def generate_pillar(containers, images, base_port):
+    """
+    Generates a `microservices` pillar with `containers` HTTP containers,
+    grouped into services of up to five instances each.
+    """
+    services = {}
+    remaining = containers
+    i = 0
+    while remaining > 0:
+        name = 'bench-%04d' % i
+        instances = min(INSTANCES_PER_SERVICE, remaining)
+        services[name] = {
+            'hostname': '%s.bench.local' % name,
+            'containers': {
+                'app': {
+                    'instances': instances,
+                    'docker_image': 'localhost/bench-%d:latest' % (i % images),
+                    'stateful': False,
+                    'http': True,
+                    'base_port': base_port,
+                    'environment': {'SERVICE': name}
+                }
+            }
+        }
+        remaining -= instances
+        i += 1
+    return {'microservices': services, 'nginx': {'consul_upstreams': False}}
+
+
+def _traverse(data, key, default=None):
+    for part in key.split(':'):
+        if isinstance(data, dict) and part in data:
+            data = data[part]
+        elif isinstance(data, list) and part.isdigit() and int(part) < len(data):
+            data = data[int(part)]
+        else:
+            return default
+    return data
+
+
+class Loader(object):
+    """
+    A minimal replacement for the Salt loader that loads the modules of a
+    repository and injects the `__salt__`, `__opts__`, `__pillar__`,
+    `__grains__` and `__context__` dunders. Modules that do not exist in the
+    repository (like in older versions) are skipped.
+    """
+
+    def __init__(self, opts, pillar, grains, repo_root=REPO_ROOT):
+        self.repo_root = repo_root
+        self.opts = opts
+        self.pillar = pillar
+        self.grains = grains
+        self.salt = {
+            'config.get': lambda key, default='': _traverse(self.opts, key, default),
+            'pillar.get': lambda key, default='': _traverse(self.pillar, key, default),
+            'grains.get': lambda key, default='': _traverse(self.grains, key, default),
+        }
+        self.states = {}
+        self.context = {}
+
+        for name in ('mwdocker', 'microservice', 'mwcompiler', 'mwmetrics', 'mwhaproxy'):
+            self._load(os.path.join(repo_root, '_modules', name + '.py'), name, self.salt)
+        self._load(os.path.join(repo_root, '_states', 'mwdocker.py'), 'mwdocker', self.states)
+
+    def _load(self, path, name, functions):
+        if not os.path.exists(path):
+            return
+
+        module = types.ModuleType('bench_%s_%s' % (os.path.basename(os.path.dirname(path)), name))
+        module.__file__ = path
+        module.__dict__.update({
+            '__salt__': self.salt,
+            '__opts__': self.opts,
+            '__pillar__': self.pillar,
+            '__grains__': self.grains,
+            '__context__': self.context,
+        })
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), module.__dict__)
+
+        for function_name, function in list(module.__dict__.items()):
+            if function_name.startswith('_') or not inspect.isfunction(function):
+                continue
+            if function.__code__.co_filename == path:
+                functions['%s.%s' % (name, function_name)] = function
+
+    def render_sls(self, sls):
+        path = os.path.join(self.repo_root, 'mwms', sls + '.sls')
+        namespace = {'salt': self.salt, 'pillar': self.pillar, 'grains': self.grains, 'opts': self.opts,
+                     '__salt__': self.salt, '__pillar__': self.pillar, '__grains__': self.grains,
+                     '__opts__': self.opts}
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), namespace)
+        return namespace['run']()
+
+    def apply(self, high_data):
+        """
+        Applies the `mwdocker` states of a rendered SLS in definition order
+        (images first); states of other modules are ignored. Requisites are
+        not evaluated.
+        """
+        results = {}
+        ordered = sorted(high_data.items(), key=lambda item: (
+            'mwdocker.images_present' not in item[1] if isinstance(item[1], dict) else True, item[0]))
+        for state_id, state in ordered:
+            if not isinstance(state, dict):
+                continue
+            for function, arguments in state.items():
+                if function not in self.states:
+                    continue
+                kwargs = {'name': state_id}
+                for argument in arguments:
+                    kwargs.update(argument)
+                for requisite in ('require', 'require_in', 'watch', 'watch_in', 'onchanges', 'parallel'):
+                    kwargs.pop(requisite, None)
+                results[state_id] = self.states[function](**kwargs)
+                if not results[state_id]['result']:
+                    raise Exception("State %s failed: %s" % (state_id, results[state_id]['comment']))
+        return results
+
+
+class _HealthServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+
+def serve_health_checks(base_port):
+    """
+    Answers the readiness checks of all container instances. Since all
+    generated services use the same base port, one listener per instance
+    number is sufficient.
+    """
+    servers = []
+    for port in range(base_port, base_port + INSTANCES_PER_SERVICE):
+        server = _HealthServer(('127.0.0.1', port), _HealthHandler)
+        thread = threading.Thread(target=server.serve_forever, name='health-%d' % port)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    return servers
+
+
+def measure(daemon, scenario, trace_memory=False):
+    daemon.reset_calls()
+    trace_memory = trace_memory and tracemalloc is not None
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.time()
+    scenario()
+    wall_time = time.time() - started
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    calls = daemon.reset_calls()
+    return {
+        'wall_time': round(wall_time, 3),
+        'api_calls': sum(calls.values()),
+        'api_calls_by_endpoint': calls,
+        'peak_memory': peak,
+    }
+
+
+def run_size(size, args, socket_path, repo_root):
+    image_count = args.images or max(1, size // INSTANCES_PER_SERVICE)
+    daemon = fake_docker.FakeDockerDaemon(latency=args.latency, pull_latency=args.pull_latency)
+    daemon.preload(images=image_count, containers=args.extra_containers)
+    server = fake_docker.serve(daemon, socket_path)
+
+    pillar = generate_pillar(size, image_count, args.base_port)
+    grains = {'ip4_interfaces': {'eth0': ['10.0.0.1']}, 'fqdn_ip4': ['10.0.0.1']}
+    state_dir = tempfile.mkdtemp(prefix='mwms-bench-')
+    opts = {
+        'test': False,
+        'cachedir': state_dir,
+        'mwdocker.base_url': 'unix://' + socket_path,
+        'mwdocker.insecure_registries': ['localhost'],
+        'mwmetrics.enabled': False,
+        'mwmetrics.state_file': os.path.join(state_dir, 'metrics.json'),
+        'mwmetrics.textfile': os.path.join(state_dir, 'mwms.prom'),
+    }
+
+    results = {}
+    high_data = {}
+
+    def render():
+        # Both SLS files are rendered in the same state run
+        loader = Loader(opts, pillar, grains, repo_root)
+        high_data.update(loader.render_sls('services'))
+        high_data.update(loader.render_sls('backup'))
+
+    def highstate():
+        Loader(opts, pillar, grains, repo_root).apply(high_data)
+
+    def redeploy():
+        loader = Loader(opts, pillar, grains, repo_root)
+        for service_name in sorted(pillar['microservices']):
+            loader.salt['microservice.redeploy'](service_name)
+
+    scenarios = {
+        'render': render,
+        'highstate-create': highstate,
+        'highstate-noop': highstate,
+        'redeploy': redeploy,
+    }
+
+    try:
+        # Imports the modules' dependencies, which a salt-minion process has
+        # imported long before it renders an SLS
+        Loader(opts, pillar, grains, repo_root)
+
+        # Rendering is always needed for the other scenarios
+        results['render'] = measure(daemon, render, args.memory)
+        for scenario in SCENARIOS[1:]:
+            if scenario in args.scenarios:
+                results[scenario] = measure(daemon, scenarios[scenario], args.memory)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    return results
+
+
+def _format_memory(peak):
+    if peak is None:
+        return 'n/a'
+    return '%.1f MiB' % (peak / 1024.0 / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the microservice states against a fake Docker daemon')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='Numbers of containers')
+    parser.add_argument('--images', type=int, default=0,
+                        help='Number of distinct images (default: one per service)')
+    parser.add_argument('--extra-containers', type=int, default=0,
+                        help='Number of additional labelled containers that are not part of the pillar')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of each Docker API call in seconds')
+    parser.add_argument('--pull-latency', type=float, default=0.0, help='Additional latency of image pulls')
+    parser.add_argument('--base-port', type=int, default=18000, help='First port of the readiness check listeners')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+                        help='Scenarios to run (rendering is always run)')
+    parser.add_argument('--memory', action='store_true',
+                        help='Trace the peak memory usage of each scenario (slows the scenarios down)')
+    parser.add_argument('--repo', default=REPO_ROOT, help='Checkout of the modules to benchmark')
+    parser.add_argument('--socket', help='Path of the fake Docker daemon socket (default: a temporary file)')
+    parser.add_argument('--json', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    health_servers = serve_health_checks(args.base_port)
+    socket_dir = tempfile.mkdtemp(prefix='mwms-bench-')
+    all_results = {}
+
+    try:
+        print('%-8s %-18s %10s %10s %12s' % ('size', 'scenario', 'wall (s)', 'API calls', 'peak memory'))
+        for size in args.sizes:
+            socket_path = args.socket or os.path.join(socket_dir, 'docker.sock')
+            results = run_size(size, args, socket_path, os.path.abspath(args.repo))
+            all_results[size] = results
+            for scenario in SCENARIOS:
+                if scenario not in results:
+                    continue
+                r = results[scenario]
+                print('%-8d %-18s %10.3f %10d %12s' % (size, scenario, r['wall_time'], r['api_calls'],
+                                                       _format_memory(r['peak_memory'])))
+    finally:
+        for server in health_servers:
+            server.shutdown()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+    print('max RSS: %.1f MiB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
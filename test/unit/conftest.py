@@ -0,0 +1,148 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import types
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+TEST_ROOT = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(TEST_ROOT, '..', '..'))
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'test', 'benchmark'))
+sys.path.insert(0, TEST_ROOT)
+
+import fake_consul
+import fake_docker
+from run import Loader
+
+
+def load_module(path, opts):
+    """
+    Loads a single execution module of this repository with a `__salt__`
+    dunder that only provides `config.get` (answered from `opts`).
+    """
+    module = types.ModuleType('test_%s' % os.path.splitext(os.path.basename(path))[0])
+    module.__file__ = os.path.join(REPO_ROOT, path)
+    module.__dict__.update({
+        '__salt__': {'config.get': lambda key, default=None: opts.get(key, default)},
+        '__opts__': opts,
+        '__context__': {},
+    })
+    with open(module.__file__) as f:
+        exec(compile(f.read(), module.__file__, 'exec'), module.__dict__)
+    return module
+
+
+@pytest.fixture
+def docker_daemon():
+    """
+    A fake Docker daemon (see `test/benchmark/fake_docker.py`), served on a
+    unix socket whose URL is the daemon's `base_url` attribute.
+    """
+    # Unix socket paths are limited in length, so pytest's tmp_path may not fit
+    socket_dir = tempfile.mkdtemp(prefix='mwms-')
+    daemon = fake_docker.FakeDockerDaemon()
+    server = fake_docker.serve(daemon, os.path.join(socket_dir, 'docker.sock'))
+    daemon.base_url = 'unix://%s/docker.sock' % socket_dir
+    yield daemon
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(socket_dir)
+
+
+@pytest.fixture
+def salt_modules(docker_daemon, tmp_path):
+    """
+    Returns a function that loads the `mwdocker`, `microservice` and related
+    modules (see `Loader` in `test/benchmark/run.py`) for the given minion
+    options and pillar, connected to the fake Docker daemon.
+    """
+    def load(opts=None, pillar=None):
+        options = {
+            'mwdocker.base_url': docker_daemon.base_url,
+            'microservice.placement_file': str(tmp_path / 'placement.json'),
+            'mwdocker.min_running': 0,
+        }
+        options.update(opts or {})
+        return Loader(options, pillar or {}, {'ip4_interfaces': {'eth0': ['127.0.0.1']}})
+    return load
+
+
+@pytest.fixture
+def registry():
+    """
+    A fake registry that answers manifest HEAD requests with the digests in
+    its `digests` dictionary (indexed by repository and tag).
+    """
+    digests = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            match = re.match(r'^/v2/(.+)/manifests/([^/]+)$', self.path)
+            digest = digests.get(match.groups()) if match else None
+            self.send_response(200 if digest else 404)
+            if digest:
+                self.send_header('Docker-Content-Digest', digest)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    server.host = '127.0.0.1:%d' % server.server_port
+    server.digests = digests
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def consul_agent():
+    """
+    A fake Consul agent (see `fake_consul.py`), whose URL is the agent's
+    `url` attribute.
+    """
+    consul = fake_consul.FakeConsul()
+    server = fake_consul.serve(consul)
+    consul.url = 'http://127.0.0.1:%d' % server.server_port
+    yield consul
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def consul_module(consul_agent):
+    """
+    The `consul` execution module, talking to the fake Consul agent.
+    """
+    return load_module(os.path.join('_modules', 'consul.py'), {'consul.url': consul_agent.url})
+
+
+@pytest.fixture
+def consul_state(consul_agent, consul_module):
+    """
+    The `consul` state module, using the `consul` execution module.
+    """
+    state = load_module(os.path.join('_states', 'consul.py'), {'consul.url': consul_agent.url, 'test': False})
+    state.__salt__.update(('consul.%s' % name, getattr(consul_module, name))
+                          for name in ('catalog_nodes', 'catalog_service', 'catalog_register'))
+    return state
@@ -0,0 +1,212 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+"""
+A fake Consul agent that serves the subset of the Consul HTTP API used by the
+`consul` module. The catalogs of all datacenters and the agent's services are
+kept in memory, and the requests made against the agent are recorded.
+"""
+
+import json
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+class FakeConsul(object):
+    """
+    In-memory state of the fake Consul agent.
+
+    :param transactions: Set to `False` to answer `/v1/txn` with 404, like
+        Consul versions without transaction support
+    :param service_meta: Set to `False` to omit the `Meta` field of the
+        agent's services, like Consul versions without service metadata
+    :param datacenter: The agent's datacenter
+    """
+
+    def __init__(self, transactions=True, service_meta=True, datacenter='dc1'):
+        self.transactions = transactions
+        self.service_meta = service_meta
+        self.datacenter = datacenter
+        # Both indexed by datacenter and node name (and service ID)
+        self.nodes = {}
+        self.catalog_services = {}
+        self.agent_services = {}
+        self.requests = []
+        self.lock = threading.RLock()
+
+    def register(self, registration, datacenter=None):
+        """
+        Registers a node (and its service) in the catalog of `datacenter`,
+        which defaults to the registration's datacenter.
+        """
+        with self.lock:
+            datacenter = datacenter or registration.get('Datacenter') or self.datacenter
+            node = {'Node': registration['Node'], 'Address': registration['Address'], 'Datacenter': datacenter}
+            self.nodes[(datacenter, node['Node'])] = node
+            if registration.get('Service') is not None:
+                self.set_service(datacenter, node['Node'], registration['Service'])
+
+    def set_service(self, datacenter, node_name, service):
+        with self.lock:
+            self.catalog_services[(datacenter, node_name, service['ID'])] = {
+                'Node': node_name,
+                'ServiceID': service['ID'],
+                'ServiceName': service.get('Service', service['ID']),
+                'ServicePort': service.get('Port'),
+                'ServiceTags': service.get('Tags')
+            }
+
+    def requested(self, method, path, datacenter=None):
+        """
+        :return: The bodies of all requests of `method` to `path` (and, if
+            given, for `datacenter`)
+        """
+        with self.lock:
+            return [body for m, p, query, body in self.requests
+                    if m == method and p == path and (datacenter is None or query.get('dc') == datacenter)]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _make_handler(consul):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            path = url.path
+            query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+            with consul.lock:
+                consul.requests.append((method, path, query, body))
+
+            for pattern_method, pattern, handler in ROUTES:
+                match = re.match(pattern, path)
+                if pattern_method == method and match:
+                    status, data = handler(consul, query.get('dc') or consul.datacenter, body, *match.groups())
+                    self._send_json(status, data)
+                    return
+            self._send_json(404, None)
+
+        def _send_json(self, status, data):
+            payload = json.dumps(data).encode('utf-8') if data is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def _txn(consul, datacenter, ops):
+    if not consul.transactions:
+        return 404, None
+
+    # Like Consul, the operations are applied in the requested datacenter
+    results = []
+    with consul.lock:
+        for op in ops:
+            if 'Node' in op:
+                consul.register(op['Node']['Node'], datacenter)
+                results.append({'Node': op['Node']['Node']})
+            elif 'Service' in op:
+                consul.set_service(datacenter, op['Service']['Node'], op['Service']['Service'])
+                results.append({'Service': op['Service']['Service']})
+    return 200, {'Results': results, 'Errors': None}
+
+
+def _catalog_register(consul, datacenter, registration):
+    # Registrations are forwarded to the datacenter they name
+    consul.register(registration)
+    return 200, True
+
+
+def _catalog_nodes(consul, datacenter, body):
+    with consul.lock:
+        return 200, [n for key, n in sorted(consul.nodes.items()) if key[0] == datacenter]
+
+
+def _catalog_service(consul, datacenter, body, name):
+    with consul.lock:
+        return 200, [s for key, s in sorted(consul.catalog_services.items())
+                     if key[0] == datacenter and s['ServiceName'] == name]
+
+
+def _agent_services(consul, datacenter, body):
+    with consul.lock:
+        services = {}
+        for service_id, definition in consul.agent_services.items():
+            service = {
+                'ID': service_id,
+                'Service': definition['Name'],
+                'Port': definition.get('Port', 0),
+                'Tags': definition.get('Tags')
+            }
+            if consul.service_meta:
+                service['Meta'] = definition.get('Meta') or {}
+            services[service_id] = service
+        return 200, services
+
+
+def _agent_service_register(consul, datacenter, definition):
+    with consul.lock:
+        consul.agent_services[definition.get('ID', definition['Name'])] = definition
+    return 200, None
+
+
+def _agent_service_deregister(consul, datacenter, body, service_id):
+    with consul.lock:
+        if consul.agent_services.pop(service_id, None) is None:
+            return 404, None
+    return 200, None
+
+
+ROUTES = [
+    ('PUT', r'^/v1/txn$', _txn),
+    ('PUT', r'^/v1/catalog/register$', _catalog_register),
+    ('GET', r'^/v1/catalog/nodes$', _catalog_nodes),
+    ('GET', r'^/v1/catalog/service/([^/]+)$', _catalog_service),
+    ('GET', r'^/v1/agent/services$', _agent_services),
+    ('PUT', r'^/v1/agent/service/register$', _agent_service_register),
+    ('PUT', r'^/v1/agent/service/deregister/([^/]+)$', _agent_service_deregister),
+]
+
+
+def serve(consul):
+    """
+    Serves the fake Consul API of `consul` on a local port in a background
+    thread.
+
+    :return: The server; its URL is `http://127.0.0.1:<server.server_port>`.
+        Call `shutdown()` on it to stop serving
+    """
+    server = _Server(('127.0.0.1', 0), _make_handler(consul))
+    thread = threading.Thread(target=server.serve_forever, name='fake-consul')
+    thread.daemon = True
+    thread.start()
+    return server
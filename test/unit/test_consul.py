@@ -0,0 +1,146 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+
+def registrations(count, service=False):
+    result = []
+    for i in range(count):
+        registration = {'Node': 'node-%03d' % i, 'Address': '10.0.0.%d' % i, 'Datacenter': 'dc1'}
+        if service:
+            registration['Service'] = {'ID': 'web-%03d' % i, 'Service': 'web', 'Port': 80, 'Tags': None}
+        result.append(registration)
+    return result
+
+
+def service_definition(port=8000, checks=None):
+    definition = {'name': 'web', 'id': 'web-0', 'port': port, 'tags': ['http']}
+    if checks is not None:
+        definition['checks'] = checks
+    return definition
+
+
+def test_catalog_register_uses_transactions(consul_agent, consul_module):
+    consul_module.catalog_register(registrations(40, service=True))
+
+    # One node and one service operation per registration, at most 64 each
+    assert [len(ops) for ops in consul_agent.requested('PUT', '/v1/txn')] == [64, 16]
+    assert consul_agent.requested('PUT', '/v1/catalog/register') == []
+    assert sorted(consul_module.catalog_nodes()) == ['node-%03d' % i for i in range(40)]
+    assert len(consul_module.catalog_service('web')) == 40
+
+
+def test_catalog_register_falls_back_without_transactions(consul_agent, consul_module):
+    consul_agent.transactions = False
+
+    consul_module.catalog_register(registrations(3))
+
+    assert len(consul_agent.requested('PUT', '/v1/txn')) == 1
+    assert [r['Node'] for r in consul_agent.requested('PUT', '/v1/catalog/register')] == \
+        ['node-000', 'node-001', 'node-002']
+    assert consul_module.catalog_nodes()['node-002']['Address'] == '10.0.0.2'
+
+
+def test_catalog_register_without_registrations(consul_agent, consul_module):
+    consul_module.catalog_register([])
+
+    assert consul_agent.requests == []
+
+
+def test_service_registered_compares_definition_hash(consul_agent, consul_module):
+    checks = [{'name': 'HTTP connectivity', 'http': 'http://localhost:8000/status', 'interval': '10s'}]
+    assert not consul_module.service_registered(service_definition(checks=checks))
+
+    consul_module.service_register(service_definition(checks=checks))
+    registered = consul_agent.agent_services['web-0']
+    assert registered['Checks'][0]['HTTP'] == 'http://localhost:8000/status'
+    assert registered['Meta'][consul_module.DEFINITION_HASH_META]
+
+    assert consul_module.service_registered(service_definition(checks=checks))
+
+    # Changed checks are only visible through the hash
+    checks[0]['interval'] = '1m'
+    assert not consul_module.service_registered(service_definition(checks=checks))
+
+
+def test_service_registered_reads_agent_services_once(consul_agent, consul_module):
+    consul_module.service_register(service_definition())
+    for i in range(3):
+        assert consul_module.service_registered(service_definition())
+
+    assert len(consul_agent.requested('GET', '/v1/agent/services')) == 1
+
+
+def test_agent_services_are_read_once_per_run(consul_agent, consul_module):
+    consul_module.service_register(service_definition())
+    assert consul_module.service_registered(service_definition())
+
+    # Deregistered by the agent between two runs (deregister_critical_service_after)
+    del consul_agent.agent_services['web-0']
+    assert consul_module.service_registered(service_definition())
+
+    consul_module.__context__.clear()
+    assert not consul_module.service_registered(service_definition())
+
+
+def test_service_registered_without_service_meta(consul_agent, consul_module):
+    consul_agent.service_meta = False
+    consul_module.service_register(service_definition())
+    consul_module.agent_services(refresh=True)
+
+    assert consul_module.service_registered(service_definition())
+    assert not consul_module.service_registered(service_definition(port=8001))
+
+
+def test_service_deregister(consul_agent, consul_module):
+    consul_module.service_register(service_definition())
+    consul_module.service_deregister('web-0')
+
+    assert consul_agent.agent_services == {}
+    assert not consul_module.service_registered(service_definition())
+
+
+def declared_nodes(address='10.0.0.1'):
+    return {
+        'db-local': {'address': address, 'service': {'ID': 'mysql', 'Port': 3306}},
+        'db-remote': {'address': '10.1.0.1', 'datacenter': 'dc2', 'service': {'ID': 'mysql', 'Port': 3306}},
+        'cache-remote': {'address': '10.1.0.2', 'datacenter': 'dc2'},
+    }
+
+
+def test_nodes_state_registers_nodes_per_datacenter(consul_agent, consul_state):
+    ret = consul_state.nodes('external', declared_nodes())
+
+    assert ret['result'] is True
+    assert sorted(ret['changes']) == ['cache-remote', 'db-local', 'db-remote']
+    assert sorted(consul_agent.nodes) == [('dc1', 'db-local'), ('dc2', 'cache-remote'), ('dc2', 'db-remote')]
+    assert len(consul_agent.requested('PUT', '/v1/txn', datacenter='dc2')) == 1
+
+    # The catalog of each datacenter is compared with the declared nodes
+    consul_agent.requests = []
+    ret = consul_state.nodes('external', declared_nodes())
+    assert ret['changes'] == {}
+    assert ret['comment'] == 'All nodes are up to spec'
+    assert len(consul_agent.requested('GET', '/v1/catalog/nodes')) == 2
+    assert len(consul_agent.requested('GET', '/v1/catalog/nodes', datacenter='dc2')) == 1
+    assert consul_agent.requested('PUT', '/v1/txn') == []
+
+
+def test_nodes_state_registers_changed_nodes(consul_agent, consul_state):
+    consul_state.nodes('external', declared_nodes())
+    consul_agent.requests = []
+
+    consul_state.__opts__['test'] = True
+    ret = consul_state.nodes('external', declared_nodes(address='10.0.0.2'))
+    assert ret['result'] is None
+    assert list(ret['changes']) == ['db-local']
+    assert consul_agent.requested('PUT', '/v1/txn') == []
+
+    consul_state.__opts__['test'] = False
+    ret = consul_state.nodes('external', declared_nodes(address='10.0.0.2'))
+    assert ret['result'] is True
+    assert list(ret['changes']) == ['db-local']
+    assert [len(ops) for ops in consul_agent.requested('PUT', '/v1/txn')] == [2]
+    assert consul_agent.nodes[('dc1', 'db-local')]['Address'] == '10.0.0.2'
@@ -0,0 +1,175 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+
+class _HAProxyServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def haproxy():
+    """
+    A fake HAProxy admin socket that records the commands sent to it in its
+    `commands` list. Servers never have any sessions.
+    """
+    socket_dir = tempfile.mkdtemp(prefix='mwms-')
+    commands = []
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            command = self.rfile.readline().decode('utf-8').strip()
+            commands.append(command)
+            if command == 'show stat':
+                self.wfile.write(b'# pxname,svname,scur,qcur,weight,status\n')
+            elif ' addr ' in command:
+                self.wfile.write(b'IP changed\n')
+
+    server = _HAProxyServer(os.path.join(socket_dir, 'admin.sock'), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    server.commands = commands
+    yield server
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(socket_dir)
+
+
+@pytest.fixture
+def status_pages():
+    """
+    Returns a function that starts an HTTP server whose status page responds
+    successfully, and returns its port; used as the host ports of HTTP
+    containers, so that their readiness checks succeed.
+    """
+    servers = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def start():
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server.server_port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def deployment(docker_daemon, salt_modules, registry, haproxy, consul_module, tmp_path):
+    """
+    Returns a function that loads the modules for a service pillar. Images are
+    pulled from the fake registry, whose digests are empty, so that every
+    re-deployment pulls a new image of each container, except for the images
+    in `current_images`.
+    """
+    def load(containers, current_images=()):
+        for key, container in containers.items():
+            container['docker_image'] = '%s/%s' % (registry.host, container['docker_image'])
+        for image in current_images:
+            image_id = docker_daemon.add_image('%s/%s' % (registry.host, image))
+            repository, tag = image.split(':')
+            registry.digests[repository, tag] = docker_daemon.images[image_id]['RepoDigests'][0].split('@')[1]
+
+        pillar = {
+            'nginx': {'consul_upstreams': True},
+            'microservices': {'app': {'hostname': 'app.local', 'containers': containers}}
+        }
+        modules = salt_modules(opts={'mwdocker.insecure_registries': [registry.host],
+                                     'mwhaproxy.socket': haproxy.server_address}, pillar=pillar)
+        modules.salt['consul.service_register'] = consul_module.service_register
+        modules.placements = lambda: json.load(open(str(tmp_path / 'placement.json')))['app']
+        return modules
+    return load
+
+
+def redeploy(modules):
+    modules.context.clear()
+    return modules.salt['microservice.redeploy']('app')
+
+
+def container_links(docker_daemon, name):
+    return docker_daemon.find_container(name)['HostConfig'].get('Links')
+
+
+def test_redeploy_drains_http_containers_in_haproxy(docker_daemon, deployment, haproxy, status_pages):
+    modules = deployment({
+        'web': {'instances': 1, 'stateful': False, 'docker_image': 'app:latest', 'http': True,
+                'base_port': status_pages(), 'drain_wait': 0}
+    })
+    redeploy(modules)
+    created = docker_daemon.find_container('app-web-0')['Id']
+    del haproxy.commands[:]
+
+    redeploy(modules)
+
+    assert docker_daemon.find_container('app-web-0')['Id'] != created
+    assert [c for c in haproxy.commands if c != 'show stat'] == [
+        'set server app_web/app-web-0 state drain',
+        'set server app_web/app-web-0 state ready',
+    ]
+
+
+def test_blue_green_redeploy_switches_generations(docker_daemon, deployment, haproxy, consul_agent,
+                                                  status_pages):
+    blue_port, green_port = status_pages(), status_pages()
+    modules = deployment({
+        'web': {'instances': 1, 'stateful': False, 'docker_image': 'app:latest', 'http': True,
+                'blue_green': True, 'base_port': blue_port, 'green_base_port': green_port, 'drain_wait': 0},
+        'worker': {'instances': 1, 'stateful': False, 'docker_image': 'worker:latest', 'links': {'web': 'web'}},
+    }, current_images=['worker:latest'])
+
+    # Without a current generation, the first deployment starts the green one
+    redeploy(modules)
+    assert modules.placements()['web']['0'] == {'container': 'app-web-0-green', 'port': green_port}
+    assert docker_daemon.find_container('app-web-0') is None
+    green = docker_daemon.find_container('app-web-0-green')['Id']
+    assert container_links(docker_daemon, 'app-worker-0') == ['app-web-0-green:web']
+    del haproxy.commands[:]
+
+    result = redeploy(modules)
+
+    assert modules.placements()['web']['0'] == {'container': 'app-web-0', 'port': blue_port}
+    assert docker_daemon.find_container('app-web-0-green') is None
+    assert result['container_ids']['app-web-0'] == {
+        'old': green, 'new': docker_daemon.find_container('app-web-0')['Id']}
+    assert consul_agent.agent_services['app-0']['Port'] == blue_port
+    assert haproxy.commands == [
+        'set server app_web/app-web-0 addr 127.0.0.1 port %d' % blue_port,
+        'set server app_web/app-web-0 state ready',
+    ]
+
+    # Containers that link to the switched container are re-created, so that
+    # they do not keep using the old generation
+    assert container_links(docker_daemon, 'app-worker-0') == ['app-web-0:web']
@@ -0,0 +1,100 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import json
+import os
+
+import pytest
+
+from conftest import load_module
+
+
+@pytest.fixture
+def service(docker_daemon, salt_modules):
+    """
+    A service with one HTTP instance and two running standbys. The number of
+    instances can be changed in the returned modules' pillar.
+    """
+    docker_daemon.add_image('app:latest')
+    for name in ('app-web-0', 'app-web-standby-0', 'app-web-standby-1'):
+        docker_daemon.add_container(name, 'app:latest', labels={'service': 'app'})
+
+    pillar = {'microservices': {'app': {
+        'hostname': 'app.local',
+        'containers': {'web': {'instances': 1, 'stateful': False, 'docker_image': 'app:latest', 'http': True,
+                               'base_port': 8000, 'standby': 2, 'standby_base_port': 9000}}
+    }}}
+    return salt_modules(opts={'test': False}, pillar=pillar)
+
+
+def web_instances(modules):
+    modules.context.clear()
+    return modules.salt['microservice.instances']()['app'][0]
+
+
+def summary(containers):
+    return [(c['container'], c['port'], c.get('promoted', c.get('missing'))) for c in containers]
+
+
+def test_running_standbys_take_over_new_instances(service, tmp_path):
+    web = web_instances(service)
+    assert summary(web['instances']) == [('app-web-0', 8000, False)]
+    assert summary(web['standbys']) == [('app-web-standby-0', 9000, False), ('app-web-standby-1', 9001, False)]
+
+    service.pillar['microservices']['app']['containers']['web']['instances'] = 4
+    web = web_instances(service)
+
+    # Two of the three new instances are taken over by the standbys; the pool
+    # is refilled with the next free numbers
+    assert summary(web['instances']) == [('app-web-0', 8000, False), ('app-web-standby-0', 9000, True),
+                                         ('app-web-standby-1', 9001, True), ('app-web-3', 8003, False)]
+    assert summary(web['standbys']) == [('app-web-standby-2', 9002, True), ('app-web-standby-3', 9003, True)]
+
+    # Planning the promotions does not record them
+    assert not os.path.exists(str(tmp_path / 'placement.json'))
+
+    states = service.salt['mwcompiler.service_states']('app')['states']
+    assert states['microservice-promote-app-web-1']['microservice.standby_promoted'] == [
+        {'service': 'app'}, {'key': 'web'}, {'instance': 1}, {'container': 'app-web-standby-0'}, {'port': 9000}]
+
+
+def test_stopped_standbys_are_not_promoted(docker_daemon, service):
+    docker_daemon.stop_container('app-web-standby-0')
+    service.pillar['microservices']['app']['containers']['web']['instances'] = 3
+
+    web = web_instances(service)
+
+    assert summary(web['instances']) == [('app-web-0', 8000, False), ('app-web-standby-1', 9001, True),
+                                         ('app-web-2', 8002, False)]
+
+
+def test_standby_promoted_state_records_promotion(docker_daemon, service, tmp_path):
+    state = load_module(os.path.join('_states', 'microservice.py'), service.opts)
+    state.__salt__.update(service.salt)
+    service.pillar['microservices']['app']['containers']['web']['instances'] = 2
+
+    service.opts['test'] = True
+    ret = state.standby_promoted('promote', 'app', 'web', 1, 'app-web-standby-0', 9000)
+    assert ret['result'] is None
+    assert not os.path.exists(str(tmp_path / 'placement.json'))
+
+    service.opts['test'] = False
+    ret = state.standby_promoted('promote', 'app', 'web', 1, 'app-web-standby-0', 9000)
+    assert ret['result'] is True
+    assert ret['changes']['container'] == {'old': None, 'new': 'app-web-standby-0'}
+    with open(str(tmp_path / 'placement.json')) as f:
+        assert json.load(f)['app']['web']['1'] == {'container': 'app-web-standby-0', 'port': 9000}
+
+    # Applying the state again does not change anything
+    assert state.standby_promoted('promote', 'app', 'web', 1, 'app-web-standby-0', 9000)['changes'] == {}
+
+    web = web_instances(service)
+    assert summary(web['instances']) == [('app-web-0', 8000, False), ('app-web-standby-0', 9000, False)]
+    assert summary(web['standbys']) == [('app-web-standby-1', 9001, False), ('app-web-standby-2', 9002, True)]
+
+    # An instance that already has a container is not taken over
+    with pytest.raises(Exception, match='already runs in container app-web-standby-0'):
+        service.salt['microservice.record_promotion']('app', 'web', 1, 'app-web-standby-1', 9001)
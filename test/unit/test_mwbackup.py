@@ -0,0 +1,172 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import gzip
+import io
+import json
+import os
+import tarfile
+import time
+
+import pytest
+
+from conftest import load_module
+
+
+@pytest.fixture
+def mwbackup(tmp_path):
+    """
+    The `mwbackup` module, with its backups in `tmp_path/backups`. Instead of
+    running a container, streamed backups archive the `tmp_path/source`
+    directory.
+    """
+    source = tmp_path / 'source'
+    source.mkdir()
+
+    module = load_module(os.path.join('_modules', 'mwbackup.py'), {})
+    module.__salt__.update({
+        'pillar.get': lambda key, default=None: {'incremental': True},
+        'microservice.instance_container': lambda service_name, key, instance=0: '%s-%s-%d' % (
+            service_name, key, instance),
+    })
+    module.BACKUP_ROOT = str(tmp_path / 'backups')
+    module._stream_command = lambda source_container, backup_config: ['tar', '-cf', '-', '-C', str(source), '.']
+    module.source = source
+    return module
+
+
+def member(name, type=tarfile.REGTYPE, data=b'', linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    info.size = len(data)
+    info.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+    return info, data
+
+
+def write_backup(mwbackup, members, manifest):
+    """
+    Writes a backup of `members` (a list of `member` tuples), either as
+    archive or as manifest with a content-addressed store.
+    """
+    backup_dir = os.path.join(mwbackup.BACKUP_ROOT, 'app', 'data')
+    os.makedirs(backup_dir)
+
+    if not manifest:
+        with tarfile.open(os.path.join(backup_dir, '20240101.tar.gz'), 'w:gz') as archive:
+            for info, data in members:
+                archive.addfile(info, io.BytesIO(data))
+        return
+
+    entries = []
+    for info, data in members:
+        entry = {'name': info.name, 'type': info.type.decode('ascii'), 'mode': info.mode, 'uid': 0, 'gid': 0,
+                 'uname': '', 'gname': '', 'mtime': 0, 'size': info.size, 'linkname': info.linkname}
+        if info.isfile():
+            entry['digest'] = mwbackup._store_blob(os.path.join(backup_dir, 'store'), io.BytesIO(data), 6)[0]
+        entries.append(entry)
+    with gzip.open(os.path.join(backup_dir, '20240101.manifest.json.gz'), 'wb') as f:
+        f.write(json.dumps({'members': entries}).encode('utf-8'))
+
+
+def tree(path):
+    """
+    Describes the files, links and directories below `path`.
+    """
+    result = {}
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            relative = os.path.relpath(full, path)
+            if os.path.islink(full):
+                result[relative] = ('link', os.readlink(full))
+            elif os.path.isdir(full):
+                result[relative] = ('dir', oct(os.stat(full).st_mode & 0o777))
+            else:
+                with open(full, 'rb') as f:
+                    result[relative] = ('file', f.read(), oct(os.stat(full).st_mode & 0o777),
+                                        int(os.stat(full).st_mtime))
+    return result
+
+
+OUTSIDE = '/tmp/mwbackup-outside-%d' % os.getpid()
+
+UNSAFE_BACKUPS = {
+    'parent-directory': [member('../evil', data=b'evil')],
+    'nested-parent-directory': [member('data/../../evil', data=b'evil')],
+    'absolute-path': [member(OUTSIDE, data=b'evil')],
+    'absolute-symlink': [member('link', tarfile.SYMTYPE, linkname=OUTSIDE)],
+    'relative-symlink': [member('link', tarfile.SYMTYPE, linkname='../evil')],
+    'file-through-symlink': [member('link', tarfile.SYMTYPE, linkname='.'),
+                             member('link/../evil', data=b'evil')],
+    'directory-symlink': [member('data', tarfile.DIRTYPE), member('data/up', tarfile.SYMTYPE, linkname='..'),
+                          member('data/up/up', tarfile.SYMTYPE, linkname='..'),
+                          member('data/up/up/evil', data=b'evil')],
+    'hardlink': [member('hard', tarfile.LNKTYPE, linkname='../evil')],
+    'absolute-hardlink': [member('hard', tarfile.LNKTYPE, linkname=OUTSIDE)],
+}
+
+
+@pytest.mark.parametrize('backup_format', ['archive', 'archive-without-data-filter', 'manifest'])
+@pytest.mark.parametrize('case', sorted(UNSAFE_BACKUPS))
+def test_restore_refuses_members_outside_of_target(mwbackup, tmp_path, monkeypatch, case, backup_format):
+    if backup_format == 'archive-without-data-filter':
+        # Python versions before 3.11.4 (and 2.7) do not have extraction filters
+        monkeypatch.delattr(tarfile, 'data_filter', raising=False)
+    write_backup(mwbackup, UNSAFE_BACKUPS[case], backup_format == 'manifest')
+    target = tmp_path / 'restore' / 'target'
+    target.parent.mkdir()
+    with open(OUTSIDE, 'w') as f:
+        f.write('outside')
+
+    try:
+        with pytest.raises(Exception, match='(?i)refus|outside|absolute|link'):
+            mwbackup.restore('app', 'data', str(target))
+
+        assert os.listdir(str(target.parent)) in ([], ['target'])
+        assert not os.path.lexists(str(tmp_path / 'evil'))
+        with open(OUTSIDE) as f:
+            assert f.read() == 'outside'
+    finally:
+        os.unlink(OUTSIDE)
+
+
+def test_incremental_backup_and_restore(mwbackup, tmp_path, monkeypatch):
+    source = mwbackup.source
+    (source / 'data').mkdir()
+    (source / 'data' / 'large.bin').write_bytes(os.urandom(256 * 1024))
+    (source / 'data' / 'small.txt').write_bytes(b'first version')
+    (source / 'data' / 'script.sh').write_bytes(b'#!/bin/sh\n')
+    os.chmod(str(source / 'data' / 'script.sh'), 0o750)
+    os.symlink('small.txt', str(source / 'data' / 'current'))
+    os.link(str(source / 'data' / 'small.txt'), str(source / 'data' / 'hardlink.txt'))
+    first_tree = tree(str(source))
+
+    monkeypatch.setattr(time, 'strftime', lambda format: '20240101')
+    first = mwbackup.backup('app', 'data')
+
+    (source / 'data' / 'small.txt').write_bytes(b'second version')
+    os.utime(str(source / 'data' / 'small.txt'), (time.time() + 10, time.time() + 10))
+    second_tree = tree(str(source))
+    monkeypatch.setattr(time, 'strftime', lambda format: '20240102')
+    second = mwbackup.backup('app', 'data')
+
+    assert first['target'].endswith('20240101.manifest.json.gz')
+    assert mwbackup.snapshots('app', 'data') == ['20240101', '20240102']
+    # The unchanged large file is not stored again
+    assert second['bytes'] == first['bytes'] - len(b'first version') + len(b'second version')
+    assert second['bytes_written'] < 16 * 1024 < first['bytes_written']
+
+    mwbackup.restore('app', 'data', str(tmp_path / 'first'), snapshot='20240101')
+    mwbackup.restore('app', 'data', str(tmp_path / 'second'))
+    assert tree(str(tmp_path / 'first')) == first_tree
+    assert tree(str(tmp_path / 'second')) == second_tree
+    assert os.stat(str(tmp_path / 'second' / 'data' / 'small.txt')).st_ino == \
+        os.stat(str(tmp_path / 'second' / 'data' / 'hardlink.txt')).st_ino
+
+    mwbackup.restore('app', 'data', str(tmp_path / 'second.tar.gz'))
+    with tarfile.open(str(tmp_path / 'second.tar.gz'), 'r:gz') as archive:
+        assert archive.extractfile('./data/small.txt').read() == b'second version'
@@ -0,0 +1,45 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+
+def test_container_snapshot_is_built_once_per_run(docker_daemon, salt_modules):
+    docker_daemon.add_image('app:latest')
+    docker_daemon.add_container('app-web-0', 'app:latest', labels={'service': 'app'})
+    docker_daemon.add_container('app-web-1', 'app:latest', labels={'service': 'app'})
+    modules = salt_modules()
+    salt = modules.salt
+
+    assert salt['mwdocker.inspect_container']('app-web-0') is not None
+    docker_daemon.reset_calls()
+    assert salt['mwdocker.inspect_container']('app-web-1') is not None
+    assert docker_daemon.reset_calls() == {}
+
+    # Removed by hand between two runs
+    docker_daemon.remove_container('app-web-0')
+    assert salt['mwdocker.inspect_container']('app-web-0') is not None
+
+    modules.context.clear()
+    assert salt['mwdocker.inspect_container']('app-web-0') is None
+    assert salt['mwdocker.inspect_container']('app-web-1') is not None
+
+
+def test_image_index_is_built_once_per_run(docker_daemon, salt_modules):
+    image_id = docker_daemon.add_image('app:latest')
+    modules = salt_modules()
+    salt = modules.salt
+
+    assert salt['mwdocker.image_id']('app') == image_id
+    docker_daemon.reset_calls()
+    assert salt['mwdocker.image_id']('app:latest') == image_id
+    assert docker_daemon.reset_calls() == {}
+
+    # Pulled and removed outside of Salt between two runs
+    new_image_id = docker_daemon.add_image('app:latest')
+    docker_daemon.remove_image(image_id)
+    assert salt['mwdocker.image_id']('app') == image_id
+
+    modules.context.clear()
+    assert salt['mwdocker.image_id']('app') == new_image_id
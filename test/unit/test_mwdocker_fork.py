@@ -0,0 +1,79 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import os
+
+
+def container_ips(salt, expected, names, rounds=50):
+    """
+    Looks up the IP addresses of the given containers over and over again.
+
+    :return: The number of wrong answers
+    """
+    errors = 0
+    for i in range(rounds):
+        name = names[i % len(names)]
+        try:
+            if salt['mwdocker.container_ip'](name) != expected[name]:
+                errors += 1
+        except Exception:
+            errors += 1
+    return errors
+
+
+def test_forked_processes_use_their_own_connections(docker_daemon, salt_modules):
+    docker_daemon.add_image('app:latest')
+    names = ['app-web-%d' % i for i in range(5)]
+    for name in names:
+        docker_daemon.add_container(name, 'app:latest', labels={'service': 'app'})
+    expected = dict((name, docker_daemon.find_container(name)['NetworkSettings']['IPAddress']) for name in names)
+    salt = salt_modules(opts={'mwdocker.timeout': 5}).salt
+
+    # Leaves a keep-alive connection in the pool, like `images_present` does
+    # before Salt forks the processes of parallel states
+    salt['mwdocker.container_ip'](names[0])
+    assert docker_daemon.connections == 1
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(min(container_ips(salt, expected, names), 100))
+        finally:
+            os._exit(100)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    # The child must not have used the connection that the parent keeps
+    assert docker_daemon.connections == 2
+    assert container_ips(salt, expected, list(reversed(names))) == 0
+    assert docker_daemon.connections == 2
+
+
+def test_forked_processes_only_inspect_their_containers(docker_daemon, salt_modules):
+    docker_daemon.add_image('app:latest')
+    for i in range(5):
+        docker_daemon.add_container('app-web-%d' % i, 'app:latest', labels={'service': 'app'})
+    salt = salt_modules().salt
+
+    # The snapshot of the parent process, built before the states are forked
+    assert salt['mwdocker.inspect_container']('app-web-0') is not None
+    # Deleted by another process in the meantime
+    docker_daemon.remove_container('app-web-1')
+    docker_daemon.reset_calls()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = salt['mwdocker.inspect_container']('app-web-1') is None and \
+                salt['mwdocker.inspect_container']('app-web-2') is not None and \
+                salt['mwdocker.container_spec_hash']('app-web-2') is None
+            os._exit(0 if ok else 1)
+        finally:
+            os._exit(100)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    assert docker_daemon.reset_calls() == {'GET inspect_container': 2}
@@ -0,0 +1,102 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+MIRRORS = {'docker.io': 'mirror.local:5000'}
+
+
+def service_pillar(image):
+    return {'microservices': {'app': {
+        'hostname': 'app.local',
+        'containers': {'web': {'instances': 1, 'docker_image': image, 'stateful': False}}
+    }}}
+
+
+def deploy(docker_daemon, image):
+    image_id = docker_daemon.add_image(image)
+    docker_daemon.add_container('app-web-0', image, labels={'service': 'app'})
+    return image_id
+
+
+def test_pull_uses_registry_mirror(docker_daemon, salt_modules):
+    salt = salt_modules(opts={'mwdocker.registry_mirrors': MIRRORS}).salt
+
+    salt['mwdocker.pull_image']('nginx')
+
+    assert docker_daemon.pulled == ['mirror.local:5000/library/nginx:latest']
+    assert docker_daemon.find_image('mirror.local:5000/library/nginx:latest') is None
+    assert salt['mwdocker.image_id']('nginx') == docker_daemon.find_image('nginx:latest')['Id']
+
+
+def test_pull_falls_back_to_registry_when_mirror_fails(docker_daemon, salt_modules):
+    docker_daemon.unavailable.add('mirror.local:5000/library/nginx')
+    salt = salt_modules(opts={'mwdocker.registry_mirrors': MIRRORS}).salt
+
+    salt['mwdocker.pull_image']('nginx:1.25')
+
+    assert docker_daemon.pulled == ['nginx:1.25']
+    assert salt['mwdocker.image_id']('nginx:1.25') == docker_daemon.find_image('nginx:1.25')['Id']
+
+
+def test_pull_of_unmirrored_registry_goes_to_registry(docker_daemon, salt_modules):
+    salt = salt_modules(opts={'mwdocker.registry_mirrors': MIRRORS}).salt
+
+    salt['mwdocker.pull_image']('quay.io/example/app')
+
+    assert docker_daemon.pulled == ['quay.io/example/app:latest']
+
+
+def test_pull_skips_present_images(docker_daemon, salt_modules):
+    docker_daemon.add_image('nginx:latest')
+    salt = salt_modules(opts={'mwdocker.registry_mirrors': MIRRORS}).salt
+
+    salt['mwdocker.pull_image']('nginx')
+    assert docker_daemon.pulled == []
+
+    salt['mwdocker.pull_image']('nginx', force=True)
+    assert docker_daemon.pulled == ['mirror.local:5000/library/nginx:latest']
+
+
+def test_image_up_to_date_compares_registry_digest(docker_daemon, salt_modules, registry):
+    image = '%s/app:latest' % registry.host
+    salt = salt_modules(opts={'mwdocker.insecure_registries': [registry.host]}).salt
+    assert not salt['mwdocker.image_up_to_date'](image)
+
+    image_id = docker_daemon.add_image(image)
+    assert not salt['mwdocker.image_up_to_date'](image)
+
+    registry.digests['app', 'latest'] = docker_daemon.images[image_id]['RepoDigests'][0].split('@')[1]
+    assert salt['mwdocker.image_up_to_date'](image)
+
+    registry.digests['app', 'latest'] = 'sha256:0123'
+    assert not salt['mwdocker.image_up_to_date'](image)
+
+
+def test_redeploy_skips_pull_when_registry_digest_matches(docker_daemon, salt_modules, registry):
+    image = '%s/app:latest' % registry.host
+    image_id = deploy(docker_daemon, image)
+    registry.digests['app', 'latest'] = docker_daemon.images[image_id]['RepoDigests'][0].split('@')[1]
+    salt = salt_modules(opts={'mwdocker.insecure_registries': [registry.host]}, pillar=service_pillar(image)).salt
+
+    result = salt['microservice.redeploy']('app')
+
+    assert result['unchanged']
+    assert docker_daemon.pulled == []
+    assert docker_daemon.find_container('app-web-0')['Image'] == image_id
+
+
+def test_redeploy_pulls_and_recreates_when_registry_digest_differs(docker_daemon, salt_modules, registry):
+    image = '%s/app:latest' % registry.host
+    old_image_id = deploy(docker_daemon, image)
+    registry.digests['app', 'latest'] = 'sha256:0123'
+    salt = salt_modules(opts={'mwdocker.insecure_registries': [registry.host]}, pillar=service_pillar(image)).salt
+
+    result = salt['microservice.redeploy']('app')
+
+    assert not result['unchanged']
+    assert docker_daemon.pulled == [image]
+    new_image_id = docker_daemon.find_image(image)['Id']
+    assert new_image_id != old_image_id
+    assert docker_daemon.find_container('app-web-0')['Image'] == new_image_id
@@ -0,0 +1,41 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+
+def test_create_container_with_pinned_cpus(docker_daemon, salt_modules):
+    docker_daemon.add_image('app:latest')
+    salt = salt_modules().salt
+
+    salt['mwdocker.create_container']('app-web-0', 'app:latest', labels={'service': 'app'}, tcp_ports=[], udp_ports=[],
+                                      resources={'cpuset_cpus': '2,3', 'cpuset_mems': '1', 'mem_limit': '512m'})
+
+    host_config = docker_daemon.find_container('app-web-0')['HostConfig']
+    assert host_config['CpusetCpus'] == '2,3'
+    assert host_config['CpusetMems'] == '1'
+    assert host_config['Memory'] == 512 * 1024 ** 2
+    assert salt['mwdocker.update_resources']('app-web-0', {'cpuset_cpus': '2,3', 'cpuset_mems': '1'}) == {}
+
+
+def test_redeploy_creates_containers_on_allocated_numa_node(docker_daemon, salt_modules):
+    docker_daemon.add_image('app:latest')
+    pillar = {
+        'mwms': {'cpu_pinning': True},
+        'microservices': {'app': {
+            'hostname': 'app.local',
+            'containers': {'web': {'instances': 2, 'docker_image': 'app:latest', 'stateful': False,
+                                   'resources': {'cpus': 1}}}
+        }}
+    }
+    salt = salt_modules(pillar=pillar).salt
+
+    salt['microservice.redeploy']('app')
+
+    allocation = salt['mwcompiler.compiled_states']()['app']['states']['microservice-cpus-app']
+    allocation = allocation['microservice.cpus_allocated'][1]['allocation']['web']
+    for container_number in ('0', '1'):
+        host_config = docker_daemon.find_container('app-web-%s' % container_number)['HostConfig']
+        assert host_config['CpusetCpus'] == allocation[container_number]['cpuset_cpus']
+        assert host_config['CpusetMems'] == allocation[container_number]['cpuset_mems']
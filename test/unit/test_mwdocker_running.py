@@ -0,0 +1,90 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import pytest
+
+
+@pytest.fixture
+def running(docker_daemon, salt_modules):
+    """
+    Applies the `mwdocker.running` state for an `app-web-0` container; each
+    call is a new state run.
+    """
+    docker_daemon.add_image('app:latest')
+    modules = salt_modules(opts={'test': False})
+
+    def apply(test=False, **kwargs):
+        modules.context.clear()
+        modules.opts['test'] = test
+        arguments = {'name': 'app-web-0', 'image': 'app:latest', 'labels': {'service': 'app'},
+                     'environment': {'APP_ENV': 'production'}, 'warmup_wait': 5}
+        arguments.update(kwargs)
+        return modules.states['mwdocker.running'](**arguments)
+    return apply
+
+
+def container_id(docker_daemon):
+    return docker_daemon.find_container('app-web-0')['Id']
+
+
+def test_running_skips_comparison_when_spec_hash_matches(docker_daemon, running):
+    assert 'container' in running()['changes']
+    created = container_id(docker_daemon)
+    docker_daemon.reset_calls()
+
+    # Not recorded in the specification hash, so the container is not
+    # compared in detail
+    docker_daemon.find_container('app-web-0')['Config']['Env'] = ['APP_ENV=development']
+    ret = running()
+
+    assert ret['result'] is True
+    assert ret['changes'] == {}
+    assert 'up to spec' in ret['comment']
+    assert container_id(docker_daemon) == created
+    assert [call for call in docker_daemon.reset_calls() if not call.startswith('GET')] == []
+
+
+def test_running_recreates_container_when_spec_hash_differs(docker_daemon, running):
+    running(resources={'mem_limit': '256m'})
+    created = container_id(docker_daemon)
+
+    # Removed limits are not looked at by the detailed comparison, but change
+    # the hash
+    ret = running()
+
+    assert ret['changes']['spec_hash']['old'] != ret['changes']['spec_hash']['new']
+    assert container_id(docker_daemon) != created
+    assert not docker_daemon.find_container('app-web-0')['HostConfig'].get('Memory')
+
+
+def test_running_recreates_container_when_resource_limits_change(docker_daemon, running):
+    running(resources={'mem_limit': '256m', 'cpuset_cpus': '0'})
+    created = container_id(docker_daemon)
+
+    running(resources={'mem_limit': '512m', 'cpuset_cpus': '0'})
+
+    assert container_id(docker_daemon) != created
+    assert docker_daemon.find_container('app-web-0')['HostConfig']['Memory'] == 512 * 1024 ** 2
+
+
+def test_running_updates_cpu_pinning_in_place(docker_daemon, running):
+    running(resources={'mem_limit': '256m', 'cpuset_cpus': '0', 'cpuset_mems': '0'})
+    created = container_id(docker_daemon)
+    pinned = {'mem_limit': '256m', 'cpuset_cpus': '2,3', 'cpuset_mems': '1'}
+
+    ret = running(test=True, resources=pinned)
+    assert ret['result'] is None
+    assert ret['changes']['resources']['CpusetCpus'] == {'old': '0', 'new': '2,3'}
+    assert docker_daemon.find_container('app-web-0')['HostConfig']['CpusetCpus'] == '0'
+
+    ret = running(resources=pinned)
+    assert ret['result'] is True
+    assert sorted(ret['changes']) == ['resources']
+    assert container_id(docker_daemon) == created
+    host_config = docker_daemon.find_container('app-web-0')['HostConfig']
+    assert (host_config['CpusetCpus'], host_config['CpusetMems']) == ('2,3', '1')
+
+    assert running(resources=pinned)['changes'] == {}
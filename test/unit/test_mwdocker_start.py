@@ -0,0 +1,121 @@
+# Copyright (c) 2015 Martin Helmich <m.helmich@mittwald.de>
+#                    Mittwald CM Service GmbH & Co. KG
+#
+# Docker-based microservice deployment with service discovery
+# This code is MIT-licensed. See the LICENSE.txt for more information
+
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+HEALTHCHECK = {'Test': ['CMD', 'true'], 'Interval': 1000000000}
+
+
+@pytest.fixture
+def status_page():
+    """
+    A fake status page that responds with 503 until its `ready` event is set.
+    """
+    ready = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200 if ready.is_set() else 503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    server.url = 'http://127.0.0.1:%d/status' % server.server_port
+    server.ready = ready
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_container(docker_daemon, name, healthcheck=None):
+    docker_daemon.add_image('app:latest')
+    config = {'Image': 'app:latest', 'Labels': {'service': 'app'}, 'HostConfig': {}}
+    if healthcheck is not None:
+        config['Healthcheck'] = healthcheck
+    docker_daemon.create_container(name, config)
+
+
+def later(delay, function, *args):
+    timer = threading.Timer(delay, function, args)
+    timer.start()
+    return timer
+
+
+def test_start_container_waits_for_minimum_running_time(docker_daemon, salt_modules):
+    create_container(docker_daemon, 'app-web-0')
+    salt = salt_modules().salt
+
+    waited = salt['mwdocker.start_container']('app-web-0', warmup_wait=5, min_running=0.6)
+
+    assert 0.6 <= waited < 2
+    assert docker_daemon.find_container('app-web-0')['State']['Running']
+
+
+def test_start_container_fails_when_container_stops(docker_daemon, salt_modules):
+    create_container(docker_daemon, 'app-web-0')
+    salt = salt_modules().salt
+
+    later(0.2, docker_daemon.stop_container, 'app-web-0')
+    with pytest.raises(Exception, match='did not stay up'):
+        salt['mwdocker.start_container']('app-web-0', warmup_wait=5, min_running=3)
+
+
+def test_start_container_waits_for_health_check(docker_daemon, salt_modules):
+    create_container(docker_daemon, 'app-web-0', healthcheck=HEALTHCHECK)
+    salt = salt_modules().salt
+
+    # The minimum running time does not apply to containers with health checks
+    later(0.6, docker_daemon.set_health, 'app-web-0', 'healthy')
+    waited = salt['mwdocker.start_container']('app-web-0', warmup_wait=5, min_running=30)
+
+    assert 0.6 <= waited < 3
+
+
+def test_start_container_fails_when_unhealthy(docker_daemon, salt_modules):
+    create_container(docker_daemon, 'app-web-0', healthcheck=HEALTHCHECK)
+    salt = salt_modules().salt
+
+    later(0.2, docker_daemon.set_health, 'app-web-0', 'unhealthy')
+    with pytest.raises(Exception, match='unhealthy'):
+        salt['mwdocker.start_container']('app-web-0', warmup_wait=5)
+
+
+def test_start_container_fails_when_not_ready_in_time(docker_daemon, salt_modules):
+    create_container(docker_daemon, 'app-web-0', healthcheck=HEALTHCHECK)
+    salt = salt_modules().salt
+
+    started = time.time()
+    with pytest.raises(Exception, match='not ready after 1 seconds'):
+        salt['mwdocker.start_container']('app-web-0', warmup_wait=1)
+    assert time.time() - started < 3
+
+
+def test_start_container_waits_for_check_url(docker_daemon, salt_modules, status_page):
+    # The check URL takes precedence over the health check
+    create_container(docker_daemon, 'app-web-0', healthcheck=HEALTHCHECK)
+    docker_daemon.set_health('app-web-0', 'healthy')
+    salt = salt_modules().salt
+
+    later(0.6, status_page.ready.set)
+    waited = salt['mwdocker.start_container']('app-web-0', warmup_wait=5, check_url=status_page.url)
+
+    assert 0.6 <= waited < 3